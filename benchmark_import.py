@@ -0,0 +1,63 @@
+'''
+Benchmark the cold-start cost of importing teiko_technical.
+
+Each repetition starts a fresh interpreter, imports one module and reports the
+wall time of the import and which of the heavy plotting and statistics
+dependencies it pulled in. teiko_technical is measured next to numpy,
+matplotlib.pyplot and scipy.stats on their own, for comparison. Run it from
+the repository directory.
+
+Usage: python benchmark_import.py [--repeat 5]
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+MODULES = ['teiko_technical', 'numpy', 'matplotlib.pyplot', 'scipy.stats']
+HEAVY_MODULES = ['matplotlib', 'scipy']
+
+# run in the child; the marker separates the result from anything the import prints
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print("IMPORT_BENCHMARK", elapsed, *(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+'''
+Import module in a fresh interpreter and return (seconds, heavy modules loaded).
+'''
+def time_import(module: str) -> tuple:
+    env = dict(os.environ, MPLBACKEND="Agg")
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        capture_output=True, text=True, check=True,
+    )
+    for line in result.stdout.splitlines():
+        if line.startswith("IMPORT_BENCHMARK "):
+            _, elapsed, *loaded = line.split()
+            return float(elapsed), loaded
+    raise RuntimeError(f"no timing reported for {module}:\n{result.stderr}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the import time of teiko_technical")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="fresh interpreters per module, the median is reported (default: %(default)s)")
+    args = parser.parse_args()
+
+    print(f"{'module':<20} {'median s':>10} {'min s':>10}  loads")
+    for module in MODULES:
+        runs = [time_import(module) for _ in range(args.repeat)]
+        times = [elapsed for elapsed, _ in runs]
+        loaded = ", ".join(runs[-1][1]) or "-"
+        print(f"{module:<20} {statistics.median(times):>10.3f} {min(times):>10.3f}  {loaded}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+'''
+Benchmark the unpivot strategies of overview() on synthetic sample tables.
+
+For every size a table of that many samples is generated directly in SQLite,
+then the overview is built from it once per strategy and the build time is
+printed. Sizes are given in samples; the 100M case needs roughly 10 GB of
+free disk for the database and its overview.
+
+Usage: python benchmark_overview.py [--sizes 1000000,10000000,100000000]
+                                    [--repeat 1] [--db PATH]
+'''
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from teiko_technical import OVERVIEW_STRATEGIES, _build_overview, _create_wide_table
+
+
+'''
+(Re)create table_name with `samples` synthetic rows in the cell-count CSV
+layout. Counts are random so the percentages are not all identical.
+'''
+def generate_samples(conn: sqlite3.Connection, table_name: str, samples: int) -> None:
+    cursor = conn.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+    _create_wide_table(cursor, table_name)
+    cursor.execute(f"""
+        INSERT INTO {table_name}
+        WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+        SELECT
+            'prj' || (i % 3),
+            'sbj' || (i / 3),
+            CASE i % 3 WHEN 0 THEN 'melanoma' WHEN 1 THEN 'carcinoma' ELSE 'healthy' END,
+            40 + i % 40,
+            CASE i % 2 WHEN 0 THEN 'M' ELSE 'F' END,
+            CASE i % 3 WHEN 0 THEN 'miraclib' WHEN 1 THEN 'phauximab' ELSE 'none' END,
+            CASE i % 4 WHEN 0 THEN 'yes' ELSE 'no' END,
+            's' || i,
+            'PBMC',
+            (i % 3) * 7,
+            1 + abs(random() % 50000),
+            1 + abs(random() % 50000),
+            1 + abs(random() % 50000),
+            1 + abs(random() % 50000),
+            1 + abs(random() % 50000)
+        FROM n
+    """, (samples - 1,))
+    conn.commit()
+
+
+'''
+Build the overview of table_name with one strategy and return the seconds it
+took, leaving no overview table behind.
+'''
+def time_strategy(conn: sqlite3.Connection, table_name: str, strategy: str) -> float:
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    _build_overview(cursor, table_name, "overview_benchmark", strategy)
+    conn.commit()
+    elapsed = time.perf_counter() - start
+    cursor.execute("DROP TABLE overview_benchmark")
+    conn.commit()
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the overview() unpivot strategies")
+    parser.add_argument("--sizes", default="1000000,10000000,100000000",
+                        help="comma-separated sample counts (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="builds per strategy and size, the fastest is reported (default: %(default)s)")
+    parser.add_argument("--db", help="database file to use (default: a temporary file)")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), "benchmark_overview.db")
+    conn = sqlite3.connect(db_path)
+
+    print(f"{'samples':>12} {'strategy':>12} {'seconds':>10} {'samples/sec':>14}")
+    try:
+        for samples in (int(size) for size in args.sizes.split(",")):
+            generate_samples(conn, "sample_data", samples)
+            for strategy in OVERVIEW_STRATEGIES:
+                elapsed = min(time_strategy(conn, "sample_data", strategy) for _ in range(args.repeat))
+                print(f"{samples:>12,} {strategy:>12} {elapsed:>10.2f} {samples / elapsed:>14,.0f}", flush=True)
+    finally:
+        conn.close()
+        if args.db is None:
+            os.remove(db_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,9 @@
 import streamlit as st
 import sqlite3
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
 from scipy import stats
-from teiko_technical import load_csv_to_sqlite
+from teiko_technical import load_csv_to_sqlite, overview, distinct_values, cached_boxplot, CSV_COLUMNS
 
 # Page configuration
 st.set_page_config(page_title="Cell Count Analysis Dashboard", layout="wide")
@@ -15,9 +14,10 @@ db_name = "teiko_technical.db"
 table_name = "sample_data"
 overview_table_name = "overview"
 
-# Load data into SQLite (if not already loaded)
+# Load data into SQLite and build the overview (each skipped when unchanged since the last run)
 if not st.session_state.get('data_loaded'):
-    load_csv_to_sqlite("cell-count.csv", db_name, table_name)
+    load_csv_to_sqlite("cell-count.csv", db_name, table_name, skip_unchanged=True)
+    overview(db_name, table_name, overview_table_name, skip_unchanged=True)
     st.session_state.data_loaded = True
 
 # ============================================================================
@@ -26,14 +26,12 @@ if not st.session_state.get('data_loaded'):
 
 st.sidebar.header("🔍 Data Filters")
 
-conn = sqlite3.connect(db_name)
-
 # Get unique values for filter dropdowns
-projects = sorted(pd.read_sql_query(f"SELECT DISTINCT project FROM {table_name}", conn)['project'].tolist())
-conditions = sorted(pd.read_sql_query(f"SELECT DISTINCT condition FROM {table_name}", conn)['condition'].tolist())
-treatments = sorted(pd.read_sql_query(f"SELECT DISTINCT treatment FROM {table_name}", conn)['treatment'].tolist())
-sex_options = sorted(pd.read_sql_query(f"SELECT DISTINCT sex FROM {table_name}", conn)['sex'].tolist())
-responses = sorted([x for x in pd.read_sql_query(f"SELECT DISTINCT response FROM {table_name}", conn)['response'].tolist() if x])
+projects = distinct_values(db_name, table_name, 'project')
+conditions = distinct_values(db_name, table_name, 'condition')
+treatments = distinct_values(db_name, table_name, 'treatment')
+sex_options = distinct_values(db_name, table_name, 'sex')
+responses = [x for x in distinct_values(db_name, table_name, 'response') if x]
 
 # Create filter widgets
 selected_projects = st.sidebar.multiselect("Project", projects, default=projects, key="project_filter")
@@ -42,8 +40,11 @@ selected_treatments = st.sidebar.multiselect("Treatment", treatments, default=tr
 selected_sex = st.sidebar.multiselect("Sex", sex_options, default=sex_options, key="sex_filter")
 selected_responses = st.sidebar.multiselect("Response", responses, default=responses, key="response_filter")
 
-# Build dynamic filter query
-query = f"SELECT * FROM {table_name} WHERE 1=1"
+conn = sqlite3.connect(db_name)
+
+# Build dynamic filter query; the CSV columns only, so the export below loads back
+# (SELECT * would add the generated total_count column)
+query = f"SELECT {', '.join(CSV_COLUMNS)} FROM {table_name} WHERE 1=1"
 params = []
 
 if selected_projects:
@@ -187,28 +188,12 @@ if len(analysis_data) > 0:
     metric_col1.metric("Responders (Yes)", unique_samples_yes)
     metric_col2.metric("Non-responders (No)", unique_samples_no)
     
-    # Create boxplots
+    # Create boxplots, reusing the image of an unchanged cohort from the cache
     st.subheader("Cell Population Distribution by Response Status")
     
-    fig, axes = plt.subplots(2, 3, figsize=(15, 10))
-    axes = axes.flatten()
-    
-    for idx, cell_type in enumerate(cell_types):
-        yes_data = data_by_population[cell_type]['yes']
-        no_data = data_by_population[cell_type]['no']
-        
-        # Create boxplot
-        axes[idx].boxplot([yes_data, no_data], labels=['Yes', 'No'])
-        axes[idx].set_title(f'{cell_type.replace("_", " ").title()}', fontsize=12, fontweight='bold')
-        axes[idx].set_xlabel('Treatment Response')
-        axes[idx].set_ylabel('Relative Frequency (%)')
-        axes[idx].grid(axis='y', alpha=0.3)
-    
-    # Remove extra subplot
-    fig.delaxes(axes[5])
-    
-    plt.tight_layout()
-    st.pyplot(fig)
+    boxplot_path = cached_boxplot(db_name, table_name, overview_table_name, analysis_treatment, analysis_condition,
+                                  sample_type=sample_type_filter, data=(data_by_population, cell_types))
+    st.image(boxplot_path, use_container_width=True)
     
     # ========================================================================
     # SECTION 6: STATISTICAL TESTING (Welch's t-test with FDR Correction)
@@ -1,25 +1,645 @@
-from itertools import count
+from itertools import count, islice, compress
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+import argparse
 import sqlite3
 import csv
-import matplotlib.pyplot as plt
-from scipy import stats
+import glob
+import io
+import os
+import sys
+import time
+import json
+import hashlib
+import html
+import uuid
+import gzip
+import bz2
+import lzma
+import mmap
+import queue
+import re
+import shutil
+import threading
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+import numpy as np
+# matplotlib and scipy are imported by the functions that plot or test, so
+# loading and querying do not pay for them; see benchmark_import.py
+
+
+'''
+Import matplotlib.pyplot and scipy.stats on first access as module
+attributes, for callers that use teiko_technical.plt or teiko_technical.stats.
+'''
+def __getattr__(name: str):
+    if name == 'plt':
+        import matplotlib.pyplot as plt
+        return plt
+    if name == 'stats':
+        from scipy import stats
+        return stats
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Part 1 ----------------------------------------------------------------------
 
+# columns of the cell-count CSV in file order, and the ones stored as INTEGER
+CSV_COLUMNS = ['project', 'subject', 'condition', 'age', 'sex', 'treatment',
+               'response', 'sample', 'sample_type', 'time_from_treatment_start',
+               'b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
+INTEGER_COLUMNS = ['age', 'time_from_treatment_start',
+                   'b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
+
+# whitespace SQLite ignores around an INTEGER literal
+SQL_WHITESPACE = " \t\n\v\f\r"
+
+# low-cardinality TEXT columns that the dictionary schema stores as codes
+CATEGORICAL_COLUMNS = ['project', 'condition', 'sex', 'treatment', 'response', 'sample_type']
+
+# attributes of a subject that repeat on each of its samples in the CSV
+SUBJECT_COLUMNS = ['project', 'condition', 'age', 'sex', 'treatment', 'response']
+
+# physical layouts load_csv_to_sqlite can store the sample table in
+SCHEMAS = ('wide', 'dictionary', 'normalized')
+
+# sum of the cell counts of a sample, stored once per row as the generated
+# total_count column where SQLite supports generated columns (3.31+)
+TOTAL_COUNT_EXPRESSION = "b_cell + cd8_t_cell + cd4_t_cell + nk_cell + monocyte"
+GENERATED_COLUMNS = sqlite3.sqlite_version_info >= (3, 31, 0)
+
+# size of the newline-aligned byte ranges handed to each parser process
+SHARD_CHUNK_BYTES = 16 * 1024 * 1024
+
+# size of the newline-aligned chunks the memory-mapped reader parses at once
+MMAP_CHUNK_BYTES = 256 * 1024
+
+# bookkeeping table recording what each derived table was built from
+METADATA_TABLE = "ingest_metadata"
+
+# bookkeeping table with the position of the last committed batch of a load
+CHECKPOINT_TABLE = "ingest_checkpoints"
+
+
 '''
-Load CSV data from input file into a table in an SQlite database
+Counters and timings of one load_csv_to_sqlite call, returned when it finishes
+and passed to its progress callback after every batch. parse_seconds is the
+time the writer waited for parsed batches (with a worker pool, the parsing
+that was not overlapped with inserting). peak_memory_bytes is the peak
+resident set size of the process, or None where the platform cannot tell.
 '''
-def load_csv_to_sqlite(input_filename: str, db_name: str, table_name: str) -> None:
-    file = open(input_filename, "r")
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
+@dataclass
+class IngestStats:
+    rows_parsed: int = 0
+    rows_inserted: int = 0
+    rows_rejected: int = 0
+    bytes_read: int = 0
+    parse_seconds: float = 0.0
+    insert_seconds: float = 0.0
+    commit_seconds: float = 0.0
+    index_seconds: float = 0.0
+    elapsed_seconds: float = 0.0
+    peak_memory_bytes: int = None
+    skipped: bool = False
 
-    # overwrite data if it is already present
-    cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_parsed / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
 
-    # define database schema
+
+'''
+Peak resident set size of this process in bytes, or None if unknown.
+'''
+def _peak_memory_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# compressed exports are recognised by extension and streamed through these
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.xz', '.zst')
+
+'''
+Open a Zstandard-compressed file for streaming reads. zstandard is an
+optional dependency that is only needed for .zst exports.
+'''
+def _open_zstd(path: str):
+    try:
+        import zstandard
+    except ImportError as exc:
+        raise ImportError(f"Reading '{path}' requires the zstandard package (pip install zstandard)") from exc
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+
+
+'''
+Read-only binary stream that decompresses a file on a background thread.
+The thread reads ahead by at most max_blocks blocks of block_size bytes, so
+memory stays bounded, and zlib/bz2/lzma/zstd release the GIL while
+decompressing, so it overlaps with parsing and SQLite inserts on the caller.
+'''
+class _ThreadedDecompressor(io.RawIOBase):
+    def __init__(self, path: str, block_size: int = 1024 * 1024, max_blocks: int = 8):
+        super().__init__()
+        openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open, '.zst': _open_zstd}
+        self._opener = openers[os.path.splitext(path)[1]]
+        self._path = path
+        self._block_size = block_size
+        self._blocks = queue.Queue(maxsize=max_blocks)
+        self._stopped = threading.Event()
+        self._current = memoryview(b"")
+        self._finished = False
+        self._thread = threading.Thread(target=self._decompress, name=f"decompress-{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decompress(self) -> None:
+        try:
+            with self._opener(self._path) as file:
+                while not self._stopped.is_set():
+                    block = file.read(self._block_size)
+                    if not block:
+                        break
+                    if not self._put(block):
+                        return
+            self._put(None)
+        except BaseException as exc:
+            self._put(exc)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._current:
+            if self._finished:
+                return 0
+            block = self._blocks.get()
+            if block is None:
+                self._finished = True
+                return 0
+            if isinstance(block, BaseException):
+                self._finished = True
+                raise block
+            self._current = memoryview(block)
+        size = min(len(buffer), len(self._current))
+        buffer[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self._stopped.set()
+            self._thread.join()
+        super().close()
+
+
+'''
+Open a CSV input for reading bytes, streaming it through a background
+decompression thread when it is compressed.
+'''
+def _open_csv_binary(path: str):
+    if path.endswith(COMPRESSED_EXTENSIONS):
+        return io.BufferedReader(_ThreadedDecompressor(path), buffer_size=1024 * 1024)
+    return open(path, "rb")
+
+
+'''
+Move a stream opened by _open_csv_binary from byte offset current to offset
+of its (decompressed) content. Plain files seek; compressed streams cannot,
+so the bytes in between are decompressed and discarded without parsing them.
+'''
+def _skip_to(file, path: str, current: int, offset: int) -> None:
+    if not path.endswith(COMPRESSED_EXTENSIONS):
+        file.seek(offset)
+        return
+    remaining = offset - current
+    while remaining > 0:
+        skipped = len(file.read(min(remaining, 1024 * 1024)))
+        if not skipped:
+            break
+        remaining -= skipped
+
+
+'''
+Expand an input path into the list of CSV files to load. A directory loads
+every *.csv file (compressed or not) inside it and a glob pattern loads every
+match, both in sorted order; anything else is treated as a single file.
+'''
+def _resolve_input_files(input_filename: str) -> list:
+    if os.path.isdir(input_filename):
+        input_files = sorted(
+            path for extension in ('',) + COMPRESSED_EXTENSIONS
+            for path in glob.glob(os.path.join(input_filename, f"*.csv{extension}"))
+        )
+    elif glob.has_magic(input_filename):
+        input_files = sorted(glob.glob(input_filename))
+    else:
+        input_files = [input_filename] if os.path.isfile(input_filename) else []
+
+    if not input_files:
+        raise FileNotFoundError(f"No CSV files found for '{input_filename}'")
+    return input_files
+
+
+'''
+Return the lines that have to follow a block of whole lines, taken from
+more_lines, for the block to end on a CSV record boundary. A block only ends
+inside a record when a quoted field spans a newline, so callers only need
+this for blocks with quotes. csv.reader finds the end, since it pulls lines
+only as the record it is reading needs them. lines must start on a record
+boundary.
+'''
+def _finish_record(lines: list, more_lines) -> list:
+    extra = []
+
+    def source():
+        for line in lines:
+            yield line.decode("utf-8")
+        for line in more_lines:
+            extra.append(line)
+            yield line.decode("utf-8")
+
+    reader = csv.reader(source())
+    for _ in reader:
+        if reader.line_num >= len(lines):
+            break
+    return extra
+
+
+'''
+Split a CSV file (after its header line) into byte ranges of roughly
+chunk_bytes that always start and end on a record boundary. A range with
+quotes is read here to find where its last record ends.
+'''
+def _csv_byte_ranges(path: str, chunk_bytes: int = SHARD_CHUNK_BYTES, start: int = 0):
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        file.readline() # skip header
+        start = max(start, file.tell())
+        while start < size:
+            file.seek(min(start + chunk_bytes, size))
+            file.readline() # extend the range to the end of the current line
+            end = file.tell()
+            file.seek(start)
+            block = file.read(end - start)
+            if b'"' in block:
+                end += sum(len(line) for line in _finish_record(list(io.BytesIO(block)), file))
+            yield start, end
+            start = end
+
+
+'''
+Validate a batch of raw CSV rows column-wise with NumPy instead of calling
+int() cell by cell. Every INTEGER field of a returned row is a well-formed
+integer literal, so SQLite's INTEGER affinity converts it in C on insert and
+good rows never go through a Python conversion or exception handler. Returns
+the good rows and a list of (reason, raw_row) rejects, where reason names the
+first check the row failed: field_count, invalid_<column> or missing_sample.
+'''
+def _validate_rows(rows: list) -> tuple:
+    width = len(CSV_COLUMNS)
+    rejects = [("field_count", json.dumps(row)) for row in rows if len(row) != width]
+    if rejects:
+        rows = [row for row in rows if len(row) == width]
+    if not rows:
+        return [], rejects
+
+    checks = []
+    for name in INTEGER_COLUMNS:
+        idx = CSV_COLUMNS.index(name)
+        # only the whitespace SQLite itself skips around a number; str.strip()
+        # would also remove e.g. '\xa0' and let SQLite store the value as TEXT
+        column = np.char.strip(np.array([row[idx] for row in rows], dtype=str), SQL_WHITESPACE)
+        valid = np.char.isdecimal(column)
+        if name == 'time_from_treatment_start':
+            # days before treatment start are recorded as negative offsets
+            valid |= ((np.char.find(column, "-") == 0) & (np.char.count(column, "-") == 1)
+                      & np.char.isdecimal(np.char.lstrip(column, "-")))
+        # isdecimal also accepts non-ASCII digits such as '٥', which SQLite
+        # cannot convert and would store as TEXT; check the code points
+        valid &= (column.view(np.uint32).reshape(len(column), -1) < 128).all(axis=1)
+        # anything longer could overflow a 64-bit INTEGER
+        valid &= np.char.str_len(column) <= 18
+        checks.append((f"invalid_{name}", ~valid))
+    idx = CSV_COLUMNS.index('sample')
+    sample_lengths = np.char.str_len(np.array([row[idx] for row in rows], dtype=str))
+    checks.append(("missing_sample", sample_lengths == 0))
+
+    failed = np.column_stack([mask for _, mask in checks])
+    bad_rows = failed.any(axis=1)
+    if bad_rows.any():
+        reasons = [checks[i][0] for i in failed[bad_rows].argmax(axis=1)]
+        rejects += [(reason, json.dumps(rows[idx])) for reason, idx in zip(reasons, np.flatnonzero(bad_rows))]
+        rows = list(compress(rows, (~bad_rows).tolist()))
+    return rows, rejects
+
+
+'''
+Apply the typed ingest stage to a batch of raw rows when validate is set,
+otherwise pass the strings through to SQLite's type affinity unchanged.
+'''
+def _prepare_rows(rows: list, validate: bool) -> tuple:
+    if validate:
+        return _validate_rows(rows)
+    return rows, []
+
+
+'''
+Parse and validate one byte range of a CSV file. Runs in a worker process so
+that parsing is spread across cores while the parent only writes.
+'''
+def _parse_csv_range(path: str, start: int, end: int, validate: bool) -> tuple:
+    with open(path, "rb") as file:
+        file.seek(start)
+        text = file.read(end - start).decode("utf-8")
+    return _parse_csv_text(text, validate)
+
+
+'''
+Parse and validate a block of whole CSV lines. A block without quotes or
+carriage returns is split on newlines and commas directly, which gives the
+same rows as csv.reader without its per-field state machine.
+'''
+def _parse_csv_text(text: str, validate: bool) -> tuple:
+    if '"' in text or '\r' in text:
+        return _prepare_rows(list(csv.reader(io.StringIO(text, newline=""))), validate)
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return _prepare_rows([line.split(",") for line in lines], validate)
+
+
+'''
+Yield the lines of a memory-mapped file from byte offset start on.
+'''
+def _mmap_lines(buffer: mmap.mmap, start: int):
+    size = len(buffer)
+    while start < size:
+        end = buffer.find(b"\n", start) + 1 or size
+        yield buffer[start:end]
+        start = end
+
+
+'''
+Yield (rows, rejects, position) batches from a plain CSV file through a
+memory map, one chunk of about chunk_bytes ending on a record boundary at a
+time. The map is read sequentially, so the kernel reads ahead and drops pages
+behind it without the data being copied through a Python file buffer first.
+'''
+def _mmap_row_batches(path: str, file_index: int, validate: bool, start: int = 0,
+                      chunk_bytes: int = MMAP_CHUNK_BYTES):
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            buffer.madvise(mmap.MADV_SEQUENTIAL)
+        size = len(buffer)
+        header_end = buffer.find(b"\n") + 1 or size
+        position = max(start, header_end)
+        while position < size:
+            end = buffer.find(b"\n", min(position + chunk_bytes, size) - 1) + 1 or size
+            if buffer.find(b'"', position, end) != -1:
+                lines = list(io.BytesIO(buffer[position:end]))
+                end += sum(len(line) for line in _finish_record(lines, _mmap_lines(buffer, end)))
+            yield (*_parse_csv_text(buffer[position:end].decode("utf-8"), validate), (file_index, end))
+            position = end
+
+
+'''
+Yield (position, task) pairs for the worker pool, where position is the
+(file index, byte offset) just past the chunk and start is the position to
+resume from. Plain files are split into byte ranges that each worker reads
+itself; compressed files are decompressed here in a streaming fashion and
+shipped to the workers as chunks of whole records.
+'''
+def _parse_tasks(input_files: list, validate: bool, start: tuple = (0, 0)):
+    for file_index, path in enumerate(input_files):
+        if file_index < start[0]:
+            continue
+        offset = start[1] if file_index == start[0] else 0
+        if not path.endswith(COMPRESSED_EXTENSIONS):
+            for range_start, range_end in _csv_byte_ranges(path, SHARD_CHUNK_BYTES, offset):
+                yield (file_index, range_end), (_parse_csv_range, path, range_start, range_end, validate)
+            continue
+        with _open_csv_binary(path) as file:
+            position = len(file.readline()) # skip header
+            if offset > position:
+                _skip_to(file, path, position, offset)
+                position = offset
+            while True:
+                lines = file.readlines(SHARD_CHUNK_BYTES)
+                if not lines:
+                    break
+                chunk = b"".join(lines)
+                if b'"' in chunk:
+                    chunk += b"".join(_finish_record(lines, file))
+                position += len(chunk)
+                yield (file_index, position), (_parse_csv_text, chunk.decode("utf-8"), validate)
+
+
+'''
+Yield (rows, rejects, position) batches from every input file, parsing chunks
+in a process pool, in file order. At most two chunks per worker are in flight
+so memory stays bounded when the writer is slower than the parsers.
+'''
+def _parallel_row_batches(input_files: list, workers: int, validate: bool, start: tuple = (0, 0)):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for position, task in _parse_tasks(input_files, validate, start):
+            pending.append((executor.submit(*task), position))
+            if len(pending) >= 2 * workers:
+                future, done = pending.popleft()
+                yield (*future.result(), done)
+        while pending:
+            future, done = pending.popleft()
+            yield (*future.result(), done)
+
+
+'''
+Yield (rows, rejects, position) batches of at most batch_size rows from the
+input files one after another, skipping the header of each file. A batch of
+batch_size lines is extended to the end of a quoted field that spans past it.
+position is the (file index, byte offset) just past the batch; start resumes
+from one.
+With memory_map=True plain files are read through _mmap_row_batches instead.
+'''
+def _serial_row_batches(input_files: list, batch_size: int, validate: bool, start: tuple = (0, 0),
+                        memory_map: bool = False):
+    for file_index, path in enumerate(input_files):
+        if file_index < start[0]:
+            continue
+        if memory_map and not path.endswith(COMPRESSED_EXTENSIONS):
+            offset = start[1] if file_index == start[0] else 0
+            yield from _mmap_row_batches(path, file_index, validate, offset, MMAP_CHUNK_BYTES)
+            continue
+        with _open_csv_binary(path) as file:
+            position = len(file.readline()) # skip header
+            if file_index == start[0] and start[1] > position:
+                _skip_to(file, path, position, start[1])
+                position = start[1]
+            while True:
+                lines = list(islice(file, batch_size))
+                if not lines:
+                    break
+                chunk = b"".join(lines)
+                if b'"' in chunk:
+                    chunk += b"".join(_finish_record(lines, file))
+                position += len(chunk)
+                yield (*_parse_csv_text(chunk.decode("utf-8"), validate), (file_index, position))
+
+'''
+Check whether a table or view exists in the database.
+'''
+def _table_exists(cursor: sqlite3.Cursor, name: str) -> bool:
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
+
+'''
+Cheap fingerprint of the input files: absolute path, size and modification
+time of each one. Matching stats let an unchanged input be skipped without
+reading it.
+'''
+def _file_stats(input_files: list) -> str:
+    stats = []
+    for path in input_files:
+        info = os.stat(path)
+        stats.append([os.path.abspath(path), info.st_size, info.st_mtime_ns])
+    return json.dumps(stats)
+
+
+'''
+Streaming SHA-256 over the contents of the input files, read in 1 MiB blocks
+so memory use does not depend on the file size.
+'''
+def _content_hash(input_files: list) -> str:
+    digest = hashlib.sha256()
+    for path in input_files:
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+        digest.update(b"\0") # keep file boundaries significant
+    return digest.hexdigest()
+
+
+'''
+Read the metadata recorded for a table as a (source, file_stats,
+content_hash, version, incremental) tuple, or None if the table was never
+recorded. incremental is 1 when file_stats and content_hash describe a delta
+applied to the table rather than its whole contents. The metadata table is
+created on first use, and the incremental column added to one created before
+it existed.
+'''
+def _read_metadata(cursor: sqlite3.Cursor, name: str):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {METADATA_TABLE} (
+        table_name TEXT PRIMARY KEY,
+        source TEXT,
+        file_stats TEXT,
+        content_hash TEXT,
+        version TEXT,
+        incremental INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT
+        )"""
+    )
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({METADATA_TABLE})")]
+    if 'incremental' not in columns:
+        cursor.execute(f"ALTER TABLE {METADATA_TABLE} ADD COLUMN incremental INTEGER NOT NULL DEFAULT 0")
+    cursor.execute(f"""
+        SELECT source, file_stats, content_hash, version, incremental
+        FROM {METADATA_TABLE} WHERE table_name = ?
+        """, (name,))
+    return cursor.fetchone()
+
+
+'''
+Record what a table was built from. version identifies the table contents and
+is what downstream tables compare against to decide whether to rebuild.
+'''
+def _record_metadata(cursor: sqlite3.Cursor, name: str, source: str, file_stats: str,
+                     content_hash: str, version: str, incremental: bool = False) -> None:
+    cursor.execute(f"""
+        INSERT OR REPLACE INTO {METADATA_TABLE}
+        (table_name, source, file_stats, content_hash, version, incremental, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
+        """, (name, source, file_stats, content_hash, version, int(incremental)))
+
+
+'''
+Return the checkpoint left by an interrupted load of a table as (file_stats,
+schema, incremental, file_index, byte_offset, rows_loaded), or None.
+'''
+def _read_checkpoint(cursor: sqlite3.Cursor, name: str):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+        table_name TEXT PRIMARY KEY,
+        file_stats TEXT,
+        schema TEXT,
+        incremental INTEGER,
+        file_index INTEGER,
+        byte_offset INTEGER,
+        rows_loaded INTEGER,
+        updated_at TEXT
+        )"""
+    )
+    cursor.execute(f"""
+        SELECT file_stats, schema, incremental, file_index, byte_offset, rows_loaded
+        FROM {CHECKPOINT_TABLE} WHERE table_name = ?
+        """, (name,))
+    return cursor.fetchone()
+
+
+'''
+Record the input position just past the last batch of a load. Written in the
+same transaction as the batch, so it never points past rows that were lost.
+'''
+def _record_checkpoint(cursor: sqlite3.Cursor, name: str, file_stats: str, schema: str,
+                       incremental: bool, position: tuple, rows_loaded: int) -> None:
+    cursor.execute(f"""
+        INSERT OR REPLACE INTO {CHECKPOINT_TABLE}
+        (table_name, file_stats, schema, incremental, file_index, byte_offset, rows_loaded, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))
+        """, (name, file_stats, schema, int(incremental), position[0], position[1], rows_loaded))
+
+
+'''
+Column definition of the stored total_count, appended to every physical table
+holding cell counts. Empty where SQLite has no generated columns, in which
+case readers sum the counts themselves (see _has_total_count).
+'''
+def _total_count_column() -> str:
+    if not GENERATED_COLUMNS:
+        return ""
+    return f",\ntotal_count INTEGER GENERATED ALWAYS AS ({TOTAL_COUNT_EXPRESSION}) STORED"
+
+
+'''
+Whether a table or view has the total_count column. Tables created before it
+was added, or by an SQLite without generated columns, do not.
+'''
+def _has_total_count(cursor: sqlite3.Cursor, name: str) -> bool:
+    cursor.execute(f"PRAGMA table_xinfo({name})")
+    return any(row[1] == 'total_count' for row in cursor.fetchall())
+
+
+'''
+Create a table with the full CSV column set. This is the sample table itself
+in the wide schema and the per-batch incoming table of the other schemas,
+which has no total_count since nothing reads it.
+'''
+def _create_wide_table(cursor: sqlite3.Cursor, name: str, temporary: bool = False) -> None:
     cursor.execute(f"""
-        CREATE TABLE {table_name} (
+        CREATE {"TEMP " if temporary else ""}TABLE IF NOT EXISTS {name} (
         project TEXT,
         subject TEXT,
         condition TEXT,
@@ -34,116 +654,1292 @@ def load_csv_to_sqlite(input_filename: str, db_name: str, table_name: str) -> No
         cd8_t_cell INTEGER,
         cd4_t_cell INTEGER,
         nk_cell INTEGER,
-        monocyte INTEGER
+        monocyte INTEGER{"" if temporary else _total_count_column()}
         )"""
     )
 
-    columns = ['project','subject','condition','age','sex','treatment',
-               'response','sample', 'sample_type','time_from_treatment_start',
-               'b_cell','cd8_t_cell','cd4_t_cell','nk_cell',
-               'monocyte']
-    
-    col_names = ",".join(columns)
-    placeholders = ",".join(["?"] * len(columns))
 
-    reader = csv.reader(file)
-    next(reader) # skip header
+'''
+Report which schema the sample table is stored in, or None if it does not
+exist yet.
+'''
+def _sample_layout(cursor: sqlite3.Cursor, table_name: str):
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (table_name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    if row[0] == 'table':
+        return 'wide'
+    if _table_exists(cursor, f"{table_name}_encoded"):
+        return 'dictionary'
+    if _table_exists(cursor, f"{table_name}_samples"):
+        return 'normalized'
+    return None
+
+
+'''
+Drop the sample table and every table backing it, whichever schema it was
+loaded with.
+'''
+def _drop_sample_tables(cursor: sqlite3.Cursor, table_name: str) -> None:
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (table_name,))
+    row = cursor.fetchone()
+    if row is not None:
+        cursor.execute(f"DROP {row[0].upper()} {table_name}")
+    cursor.execute(f"DROP TABLE IF EXISTS {table_name}_encoded")
+    cursor.execute(f"DROP TABLE IF EXISTS {table_name}_samples")
+    cursor.execute(f"DROP TABLE IF EXISTS {table_name}_subjects")
+    for col in CATEGORICAL_COLUMNS:
+        cursor.execute(f"DROP TABLE IF EXISTS {table_name}_{col}_codes")
+
+
+'''
+Name of the physical table that holds one row per sample in a schema.
+'''
+def _sample_target(table_name: str, schema: str) -> str:
+    if schema == 'dictionary':
+        return f"{table_name}_encoded"
+    if schema == 'normalized':
+        return f"{table_name}_samples"
+    return table_name
+
+
+'''
+Create the tables for the requested schema if they do not exist yet and
+return the name of the physical table that holds one row per sample.
+
+The dictionary schema keeps one <table_name>_<column>_codes lookup table per
+categorical column and stores the small integer codes in
+<table_name>_encoded. A view named table_name decodes them again with the
+same columns as the wide table (see _create_sample_view), so existing queries
+keep working and SQLite compares integer codes once a filter value has been
+looked up.
+
+The normalized schema stores the subject-level attributes once per subject
+in <table_name>_subjects and only subject_id, sample_type, time and counts
+per sample in <table_name>_samples, again behind a view named table_name.
+'''
+def _create_sample_tables(cursor: sqlite3.Cursor, table_name: str, schema: str) -> str:
+    if schema == 'wide':
+        _create_wide_table(cursor, table_name)
+        return _sample_target(table_name, schema)
+
+    if schema == 'normalized':
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table_name}_subjects (
+            subject_id INTEGER PRIMARY KEY,
+            subject TEXT UNIQUE,
+            project TEXT,
+            condition TEXT,
+            age INTEGER,
+            sex TEXT,
+            treatment TEXT,
+            response TEXT
+            )"""
+        )
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table_name}_samples (
+            sample TEXT,
+            subject_id INTEGER REFERENCES {table_name}_subjects (subject_id),
+            sample_type TEXT,
+            time_from_treatment_start INTEGER,
+            b_cell INTEGER,
+            cd8_t_cell INTEGER,
+            cd4_t_cell INTEGER,
+            nk_cell INTEGER,
+            monocyte INTEGER{_total_count_column()}
+            )"""
+        )
+        _create_wide_table(cursor, f"{table_name}_incoming", temporary=True)
+        return _sample_target(table_name, schema)
+
+    for col in CATEGORICAL_COLUMNS:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table_name}_{col}_codes (
+            code INTEGER PRIMARY KEY,
+            value TEXT UNIQUE
+            )"""
+        )
+    encoded_defs = ",\n".join(
+        f"{col}_code INTEGER" if col in CATEGORICAL_COLUMNS
+        else f"{col} {'INTEGER' if col in INTEGER_COLUMNS else 'TEXT'}"
+        for col in CSV_COLUMNS
+    )
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name}_encoded ({encoded_defs}{_total_count_column()})")
+    _create_wide_table(cursor, f"{table_name}_incoming", temporary=True)
+    return _sample_target(table_name, schema)
+
+
+'''
+Create the view named table_name that presents the dictionary or normalized
+tables with the columns of the wide table. The wide schema needs no view.
+'''
+def _create_sample_view(cursor: sqlite3.Cursor, table_name: str, schema: str) -> None:
+    if schema == 'normalized':
+        select_list = ", ".join(
+            f"s.{col}" if col in SUBJECT_COLUMNS or col == 'subject' else f"m.{col}" for col in CSV_COLUMNS
+        )
+        if _has_total_count(cursor, f"{table_name}_samples"):
+            select_list += ", m.total_count"
+        cursor.execute(f"""
+            CREATE VIEW IF NOT EXISTS {table_name} AS
+            SELECT {select_list}
+            FROM {table_name}_samples m
+            JOIN {table_name}_subjects s ON s.subject_id = m.subject_id
+        """)
+    elif schema == 'dictionary':
+        select_list = ", ".join(
+            f"{col}_codes.value AS {col}" if col in CATEGORICAL_COLUMNS else f"e.{col}"
+            for col in CSV_COLUMNS
+        )
+        if _has_total_count(cursor, f"{table_name}_encoded"):
+            select_list += ", e.total_count"
+        joins = " ".join(
+            f"JOIN {table_name}_{col}_codes {col}_codes ON {col}_codes.code = e.{col}_code"
+            for col in CATEGORICAL_COLUMNS
+        )
+        cursor.execute(f"""
+            CREATE VIEW IF NOT EXISTS {table_name} AS
+            SELECT {select_list}
+            FROM {table_name}_encoded e {joins}
+        """)
+
+
+'''
+Replace the sample tables of table_name with those loaded under the staging
+name, renaming them into place. The caller runs this inside one transaction,
+so readers see either the old tables or the new ones and are only blocked
+while the schema is rewritten, never for the length of the load.
+'''
+def _swap_sample_tables(cursor: sqlite3.Cursor, staging: str, table_name: str, schema: str) -> None:
+    _drop_sample_tables(cursor, table_name)
+    if schema == 'wide':
+        suffixes = ['']
+    elif schema == 'dictionary':
+        suffixes = ['_encoded'] + [f"_{col}_codes" for col in CATEGORICAL_COLUMNS]
+    else:
+        suffixes = ['_subjects', '_samples']
+    for suffix in suffixes:
+        cursor.execute(f"ALTER TABLE {staging}{suffix} RENAME TO {table_name}{suffix}")
+    _create_sample_view(cursor, table_name, schema)
+
+    if _table_exists(cursor, f"{staging}_rejects"):
+        cursor.execute(f"DROP TABLE IF EXISTS {table_name}_rejects")
+        cursor.execute(f"ALTER TABLE {staging}_rejects RENAME TO {table_name}_rejects")
+
+
+'''
+Index the sample key and the columns the analysis filters on, on whichever
+physical tables hold them for the given schema, and total_count for quality
+control filters on the sample size. Built after the rows are inserted, since
+one pass over a loaded table is cheaper than maintaining the indexes row by
+row.
+'''
+def _create_query_indexes(cursor: sqlite3.Cursor, table_name: str, schema: str) -> None:
+    if schema == 'wide':
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_sample ON {table_name} (sample)")
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_{table_name}_filters
+            ON {table_name} (condition, treatment, sample_type, time_from_treatment_start)
+        """)
+    elif schema == 'dictionary':
+        encoded = f"{table_name}_encoded"
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{encoded}_sample ON {encoded} (sample)")
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_{encoded}_filters
+            ON {encoded} (condition_code, treatment_code, sample_type_code, time_from_treatment_start)
+        """)
+    else:
+        samples = f"{table_name}_samples"
+        subjects = f"{table_name}_subjects"
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{samples}_sample ON {samples} (sample)")
+        # condition and treatment live on the subject, the rest on the sample
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{subjects}_filters ON {subjects} (condition, treatment)")
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_{samples}_filters
+            ON {samples} (subject_id, sample_type, time_from_treatment_start)
+        """)
+
+    counts_table = _sample_target(table_name, schema)
+    if _has_total_count(cursor, counts_table):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{counts_table}_total_count ON {counts_table} (total_count)")
+
+
+'''
+Build the ON CONFLICT clause that upserts rows keyed on the sample column.
+A row is only rewritten when one of its fields actually changed.
+'''
+def _upsert_clause(columns: list) -> str:
+    value_columns = [col for col in columns if col != 'sample']
+    return f"""
+        ON CONFLICT(sample) DO UPDATE SET
+            {", ".join(f"{col} = excluded.{col}" for col in value_columns)}
+        WHERE {" OR ".join(f"{col} IS NOT excluded.{col}" for col in value_columns)}
+        """
+
+
+'''
+Move a batch from the incoming table into the dictionary or normalized
+schema, then clear the incoming table. Returns the number of sample rows
+written.
+'''
+def _apply_incoming(cursor: sqlite3.Cursor, table_name: str, schema: str, incremental: bool) -> int:
+    if schema == 'normalized':
+        written = _apply_incoming_normalized(cursor, table_name, incremental)
+    else:
+        written = _apply_incoming_dictionary(cursor, table_name, incremental)
+    cursor.execute(f"DELETE FROM temp.{table_name}_incoming")
+    return written
+
+
+'''
+Register new categorical values in the lookup tables and insert (or upsert)
+the encoded rows.
+'''
+def _apply_incoming_dictionary(cursor: sqlite3.Cursor, table_name: str, incremental: bool) -> int:
+    incoming = f"temp.{table_name}_incoming"
+    for col in CATEGORICAL_COLUMNS:
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO {table_name}_{col}_codes (value)
+            SELECT DISTINCT {col} FROM {incoming}
+        """)
+
+    target_columns = [f"{col}_code" if col in CATEGORICAL_COLUMNS else col for col in CSV_COLUMNS]
+    select_list = ", ".join(
+        f"{col}_codes.code" if col in CATEGORICAL_COLUMNS else f"i.{col}" for col in CSV_COLUMNS
+    )
+    joins = " ".join(
+        f"JOIN {table_name}_{col}_codes {col}_codes ON {col}_codes.value = i.{col}"
+        for col in CATEGORICAL_COLUMNS
+    )
+    # "WHERE true" keeps the upsert clause from being parsed as a join constraint
+    cursor.execute(f"""
+        INSERT INTO {table_name}_encoded ({", ".join(target_columns)})
+        SELECT {select_list}
+        FROM {incoming} i {joins}
+        WHERE true
+        {_upsert_clause(target_columns) if incremental else ""}
+    """)
+    return cursor.rowcount
+
+
+'''
+Upsert the subjects of the batch, then insert (or upsert) its samples keyed
+to them. A subject seen again always takes its latest attributes.
+'''
+def _apply_incoming_normalized(cursor: sqlite3.Cursor, table_name: str, incremental: bool) -> int:
+    incoming = f"temp.{table_name}_incoming"
+    cursor.execute(f"""
+        INSERT INTO {table_name}_subjects (subject, {", ".join(SUBJECT_COLUMNS)})
+        SELECT subject, {", ".join(SUBJECT_COLUMNS)} FROM {incoming}
+        WHERE true
+        ON CONFLICT(subject) DO UPDATE SET
+            {", ".join(f"{col} = excluded.{col}" for col in SUBJECT_COLUMNS)}
+        WHERE {" OR ".join(f"{col} IS NOT excluded.{col}" for col in SUBJECT_COLUMNS)}
+    """)
+
+    sample_columns = [col for col in CSV_COLUMNS if col not in SUBJECT_COLUMNS and col != 'subject']
+    target_columns = ['subject_id'] + sample_columns
+    cursor.execute(f"""
+        INSERT INTO {table_name}_samples ({", ".join(target_columns)})
+        SELECT s.subject_id, {", ".join(f"i.{col}" for col in sample_columns)}
+        FROM {incoming} i
+        JOIN {table_name}_subjects s ON s.subject = i.subject
+        WHERE true
+        {_upsert_clause(target_columns) if incremental else ""}
+    """)
+    return cursor.rowcount
+
+
+'''
+Load CSV data from input file into a table in an SQlite database.
+input_filename may also be compressed, or a directory or glob of shards parsed
+by workers processes. bulk commits and checkpoints every batch_size rows, and
+resume continues an interrupted bulk load; incremental upserts keyed on sample;
+validate quarantines bad rows in <table_name>_rejects; skip_unchanged skips an
+input that was already loaded; schema is one of SCHEMAS; memory_map reads plain
+files through a memory map. Returns an IngestStats, which progress also gets
+after every batch.
+'''
+def load_csv_to_sqlite(input_filename: str, db_name: str, table_name: str,
+                       bulk: bool = False, batch_size: int = 50000,
+                       incremental: bool = False, workers: int = None,
+                       validate: bool = True, skip_unchanged: bool = False,
+                       schema: str = 'wide', resume: bool = True,
+                       memory_map: bool = False, progress=None) -> IngestStats:
+    if schema not in SCHEMAS:
+        raise ValueError(f"Unknown schema '{schema}', expected one of {SCHEMAS}")
+    input_files = _resolve_input_files(input_filename)
+    if workers is None:
+        workers = (os.cpu_count() or 1) if len(input_files) > 1 else 1
+
+    stats = IngestStats()
+    start_time = time.perf_counter()
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+
+    file_stats = _file_stats(input_files)
+    previous = _read_metadata(cursor, table_name)
+    content_hash = None
+    layout = _sample_layout(cursor, table_name)
+    if incremental and layout not in (None, schema):
+        conn.close()
+        raise ValueError(f"{table_name} is stored with the '{layout}' schema, cannot load it incrementally as '{schema}'")
+    # after an incremental load the table holds more than the recorded input,
+    # so only a full load that matches a full load can be skipped
+    if skip_unchanged and previous is not None and layout == schema and (incremental or not previous[4]):
+        _, previous_stats, previous_hash, previous_version, previous_incremental = previous
+        unchanged = previous_stats == file_stats
+        if not unchanged and previous_hash is not None:
+            # touched but possibly identical: fall back to comparing content
+            content_hash = _content_hash(input_files)
+            unchanged = content_hash == previous_hash
+        if unchanged:
+            _record_metadata(cursor, table_name, input_filename, file_stats, previous_hash, previous_version,
+                             previous_incremental)
+            conn.commit()
+            conn.close()
+            print(f"{input_filename} is unchanged since the last load of {table_name}, skipping")
+            stats.skipped = True
+            stats.elapsed_seconds = time.perf_counter() - start_time
+            stats.peak_memory_bytes = _peak_memory_bytes()
+            return stats
+    if skip_unchanged and content_hash is None:
+        content_hash = _content_hash(input_files)
+
+    if bulk:
+        # skip fsyncs on this connection only, restored after the load; the
+        # rollback journal stays on disk, so a crash mid-batch rolls back to
+        # the last checkpointed batch instead of corrupting the database
+        previous_synchronous = cursor.execute("PRAGMA synchronous").fetchone()[0]
+        cursor.execute("PRAGMA synchronous = OFF")
+        cursor.execute("PRAGMA cache_size = -262144")  # 256 MiB page cache
+
+    # a full load is built under a staging name and swapped in at the end, so
+    # readers keep seeing the previous tables until then; incremental loads
+    # upsert in place
+    load_name = table_name if incremental else f"{table_name}_staging"
+
+    # pick up after the last committed batch of an interrupted bulk load
+    start = (0, 0)
+    rows_loaded = 0
+    checkpoint = _read_checkpoint(cursor, table_name)
+    if (bulk and resume and checkpoint is not None
+            and checkpoint[:3] == (file_stats, schema, int(incremental))
+            and _table_exists(cursor, _sample_target(load_name, schema))):
+        start = checkpoint[3:5]
+        rows_loaded = checkpoint[5]
+        print(f"Resuming load of {table_name} after {rows_loaded} rows")
+    else:
+        cursor.execute(f"DELETE FROM {CHECKPOINT_TABLE} WHERE table_name = ?", (table_name,))
+        checkpoint = None
+
+    if incremental:
+        # forget the old fingerprint first so an interrupted load is never skipped
+        cursor.execute(f"DELETE FROM {METADATA_TABLE} WHERE table_name = ?", (table_name,))
+    elif checkpoint is None:
+        # leftovers of an interrupted load
+        _drop_sample_tables(cursor, load_name)
+
+    # define database schema
+    target = _create_sample_tables(cursor, load_name, schema)
+    if incremental:
+        _create_sample_view(cursor, table_name, schema)
+
+    columns = CSV_COLUMNS
+    
+    col_names = ",".join(columns)
+    placeholders = ",".join(["?"] * len(columns))
+    # the other schemas stage each batch and reshape it in SQL
+    insert_table = target if schema == 'wide' else f"temp.{load_name}_incoming"
+    insert_sql = f"""
+        INSERT INTO {insert_table} ({col_names})
+        VALUES ({placeholders})
+        """
+
+    if incremental:
+        # upserts need a unique index on the key; replace a plain sample index
+        # left behind by an earlier bulk load
+        for _, index_name, unique, *_ in cursor.execute(f"PRAGMA index_list({target})").fetchall():
+            if index_name == f"idx_{target}_sample" and not unique:
+                cursor.execute(f"DROP INDEX {index_name}")
+        try:
+            cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{target}_sample ON {target} (sample)")
+        except sqlite3.IntegrityError as exc:
+            conn.rollback()
+            conn.close()
+            raise ValueError(f"{table_name} has duplicate sample values, cannot load it incrementally "
+                             f"keyed on sample; reload it in full") from exc
+
+        if schema == 'wide':
+            insert_sql += _upsert_clause(columns)
+        # samples of each batch that are not stored yet, looked up in the index
+        new_samples_sql = f"""
+            SELECT COUNT(DISTINCT j.value) FROM json_each(?) j
+            WHERE NOT EXISTS (SELECT 1 FROM {target} WHERE sample = j.value)
+            """
+        sample_index = columns.index('sample')
+        new_samples = 0
+
+    if validate:
+        # quarantine for rows that fail the typed ingest stage of this load
+        if checkpoint is None:
+            cursor.execute(f"DROP TABLE IF EXISTS {load_name}_rejects")
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {load_name}_rejects (reason TEXT, raw_row TEXT)")
+
+    if workers > 1:
+        batches = _parallel_row_batches(input_files, workers, validate, start)
+    else:
+        batches = _serial_row_batches(input_files, batch_size, validate, start, memory_map)
+
+    # the whole load is one transaction unless bulk mode commits per batch
+    file_index, offset = start
+    batches = iter(batches)
+    while True:
+        mark = time.perf_counter()
+        next_batch = next(batches, None)
+        stats.parse_seconds += time.perf_counter() - mark
+        if next_batch is None:
+            break
+        batch, rejects, position = next_batch
+        if position[0] != file_index:
+            file_index, offset = position[0], 0
+        stats.bytes_read += position[1] - offset
+        offset = position[1]
+
+        mark = time.perf_counter()
+        if incremental:
+            new_samples += cursor.execute(
+                new_samples_sql, (json.dumps([row[sample_index] for row in batch]),)).fetchone()[0]
+        cursor.executemany(insert_sql, batch)
+        if schema == 'wide':
+            stats.rows_inserted += cursor.rowcount
+        else:
+            stats.rows_inserted += _apply_incoming(cursor, load_name, schema, incremental)
+        stats.rows_parsed += len(batch) + len(rejects)
+        if rejects:
+            cursor.executemany(f"INSERT INTO {load_name}_rejects (reason, raw_row) VALUES (?, ?)", rejects)
+            stats.rows_rejected += len(rejects)
+        stats.insert_seconds += time.perf_counter() - mark
+
+        if bulk:
+            mark = time.perf_counter()
+            rows_loaded += len(batch) + len(rejects)
+            _record_checkpoint(cursor, table_name, file_stats, schema, incremental, position, rows_loaded)
+            conn.commit()
+            stats.commit_seconds += time.perf_counter() - mark
+        if progress is not None:
+            stats.elapsed_seconds = time.perf_counter() - start_time
+            stats.peak_memory_bytes = _peak_memory_bytes()
+            progress(stats)
+    mark = time.perf_counter()
+    conn.commit()
+    stats.commit_seconds += time.perf_counter() - mark
+
+    if stats.rows_rejected:
+        print(f"Quarantined {stats.rows_rejected} invalid rows in {table_name}_rejects")
+
+    # an incremental load derives a new version from the one it was applied to
+    version = content_hash or uuid.uuid4().hex
+    if incremental and previous is not None and previous[3] is not None:
+        version = hashlib.sha256(f"{previous[3]}:{version}".encode()).hexdigest()
+    mark = time.perf_counter()
+    if not incremental:
+        # swap the staging tables into place in one short write transaction
+        cursor.execute("BEGIN IMMEDIATE")
+        _swap_sample_tables(cursor, load_name, table_name, schema)
+        target = _sample_target(table_name, schema)
+    _record_metadata(cursor, table_name, input_filename, file_stats, content_hash, version, incremental)
+    cursor.execute(f"DELETE FROM {CHECKPOINT_TABLE} WHERE table_name = ?", (table_name,))
+    conn.commit()
+    stats.commit_seconds += time.perf_counter() - mark
+
+    if incremental:
+        updated = stats.rows_inserted - new_samples
+        print(f"Incremental load into {table_name}: {new_samples} new samples, {updated} updated")
+
+    mark = time.perf_counter()
+    _create_query_indexes(cursor, table_name, schema)
+    if bulk:
+        cursor.execute(f"ANALYZE {target}")
+    conn.commit()
+    stats.index_seconds = time.perf_counter() - mark
+
+    stats.elapsed_seconds = time.perf_counter() - start_time
+    stats.peak_memory_bytes = _peak_memory_bytes()
+    if bulk:
+        print(f"Bulk-loaded {stats.rows_parsed} rows into {table_name} in {stats.elapsed_seconds:.2f}s "
+              f"({stats.rows_per_second:,.0f} rows/sec; parse {stats.parse_seconds:.2f}s, "
+              f"insert {stats.insert_seconds:.2f}s, commit {stats.commit_seconds:.2f}s, "
+              f"index {stats.index_seconds:.2f}s)")
+
+        cursor.execute(f"PRAGMA synchronous = {previous_synchronous}")
+
+    conn.close()
+    return stats
+
+# Part 2 ----------------------------------------------------------------------
+    
+# cell populations unpivoted into the overview table, in output order
+POPULATIONS = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
+
+# ways _build_overview can unpivot the sample table
+OVERVIEW_STRATEGIES = ('single_scan', 'union_all')
+
+# physical layouts overview() can store the overview table in
+OVERVIEW_SCHEMAS = ('long', 'compact')
+
+# sample table columns a CountsMatrix encodes for selecting cohorts
+MATRIX_COLUMNS = ['project', 'subject', 'condition', 'age', 'sex', 'treatment',
+                  'response', 'sample_type', 'time_from_treatment_start']
+
+'''
+Given an SQlite db and table name, produce a new summary table of the samples 
+in that dataset. With skip_unchanged=True the rebuild is skipped when the
+overview was already built from the current version of the source table.
+The rebuild goes into a staging table that replaces the old overview in one
+short transaction, so readers never see it missing or half-built.
+strategy picks the unpivot: 'single_scan' reads the sample table once and
+cross joins it with a constant population table, 'union_all' stacks one
+SELECT per population over a shared CTE. By default 'union_all' is used
+where SQLite materializes that CTE (3.35+), since it then reads the sample
+table once as well and is the faster of the two (see benchmark_overview.py),
+and 'single_scan' on older versions, which would scan it once per population.
+With maintain=True triggers on the sample table keep the overview current
+from then on: an inserted, updated or deleted sample rewrites only its own
+five rows, and while the triggers are in place skip_unchanged treats the
+overview as up to date. A full reload replaces the sample table and its
+triggers, so the next call rebuilds the overview.
+schema='compact' stores the overview without repeated TEXT: see
+_build_compact_overview. A view named overview_table_name presents it with
+the same columns as the long table, so queries on it work unchanged.
+'''
+def overview(db_name: str, table_name: str, overview_table_name: str,
+             skip_unchanged: bool = False, strategy: str = None,
+             maintain: bool = False, schema: str = 'long') -> None:
+    if strategy is None:
+        strategy = 'union_all' if sqlite3.sqlite_version_info >= (3, 35, 0) else 'single_scan'
+    if strategy not in OVERVIEW_STRATEGIES:
+        raise ValueError(f"Unknown strategy '{strategy}', expected one of {OVERVIEW_STRATEGIES}")
+    if schema not in OVERVIEW_SCHEMAS:
+        raise ValueError(f"Unknown schema '{schema}', expected one of {OVERVIEW_SCHEMAS}")
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+
+    source = _read_metadata(cursor, table_name)
+    source_version = source[3] if source is not None else None
+    built = _read_metadata(cursor, overview_table_name)
+    layout = _sample_layout(cursor, table_name)
+    target = _sample_target(table_name, layout) if layout is not None else table_name
+    maintained = _overview_maintained(cursor, overview_table_name, target)
+    if (skip_unchanged and _overview_layout(cursor, overview_table_name) == schema
+            and (maintained or (source_version is not None and built is not None
+                                and built[3] == source_version))):
+        print(f"\n{overview_table_name} is up to date with {table_name}, skipping rebuild")
+        cursor.execute("BEGIN IMMEDIATE")
+        _set_overview_triggers(cursor, overview_table_name, target, maintain, schema)
+        _record_metadata(cursor, overview_table_name, table_name, None, None, source_version)
+        conn.commit()
+    else:
+        staging = f"{overview_table_name}_staging"
+        _drop_overview_tables(cursor, staging)
+        if schema == 'compact':
+            _build_compact_overview(cursor, table_name, staging)
+        else:
+            _build_overview(cursor, table_name, staging, strategy)
+        conn.commit()
+
+        # swap the new overview into place in one short write transaction
+        cursor.execute("BEGIN IMMEDIATE")
+        # triggers that still refer to the old overview would block the rename
+        _set_overview_triggers(cursor, overview_table_name, target, False)
+        _drop_overview_tables(cursor, overview_table_name)
+        if schema == 'compact':
+            for suffix in ('_populations', '_samples', '_counts'):
+                cursor.execute(f"ALTER TABLE {staging}{suffix} RENAME TO {overview_table_name}{suffix}")
+            _create_compact_overview_view(cursor, overview_table_name)
+        else:
+            cursor.execute(f"ALTER TABLE {staging} RENAME TO {overview_table_name}")
+        _set_overview_triggers(cursor, overview_table_name, target, maintain, schema)
+        _record_metadata(cursor, overview_table_name, table_name, None, None, source_version)
+        conn.commit()
+
+        # plot_cell_frequencies joins the overview back to the samples on this key
+        if schema == 'compact':
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{overview_table_name}_samples_sample "
+                           f"ON {overview_table_name}_samples (sample)")
+        else:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{overview_table_name}_sample ON {overview_table_name} (sample)")
+    
+    print(f"\n=== Overview Table: Cell Population Frequency Analysis ===")
+    print(f"Columns: sample | total_count | population | count | percentage")
+    print(f"Sample size: First 10 rows\n")
+    
+    for row in cursor.execute(f"SELECT * FROM {overview_table_name} LIMIT 10"):
+        print(row)
+    
+    conn.commit()
+    conn.close()
+
+
+'''
+Create the long-format overview table from the sample table.
+'''
+def _build_overview(cursor: sqlite3.Cursor, table_name: str, overview_table_name: str,
+                    strategy: str = 'union_all') -> None:
+    cursor.execute(f"DROP TABLE IF EXISTS {overview_table_name}")
+    total_count = "total_count" if _has_total_count(cursor, table_name) else TOTAL_COUNT_EXPRESSION
+    if strategy == 'single_scan':
+        # each sample row is read once and fanned out to one row per
+        # population; the CASE picks that population's count column
+        populations = ", ".join(f"('{name}', {position})" for position, name in enumerate(POPULATIONS))
+        count_case = " ".join(f"WHEN {position} THEN {name}" for position, name in enumerate(POPULATIONS))
+        cursor.execute(f"""
+            CREATE TABLE {overview_table_name} AS
+            WITH populations (population, position) AS (VALUES {populations})
+            SELECT
+                sample,
+                total_count,
+                population,
+                count,
+                ROUND(100.0 * count / total_count, 4) AS percentage
+            FROM (
+                SELECT
+                    s.sample,
+                    {total_count} AS total_count,
+                    p.population,
+                    CASE p.position {count_case} END AS count
+                FROM {table_name} s CROSS JOIN populations p
+            )
+        """)
+        return
+
+    cursor.execute(f"""
+        CREATE TABLE {overview_table_name} AS
+        WITH intermediate AS (
+            SELECT 
+                sample,
+                {total_count} AS total_count,
+                b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte
+            FROM {table_name}
+        )
+        SELECT 
+            sample, 
+            total_count, 
+            'b_cell' AS population, 
+            b_cell AS count,
+            ROUND(100.0 * b_cell / total_count, 4) AS percentage
+        FROM intermediate
+        UNION ALL
+        SELECT sample, total_count, 'cd8_t_cell', cd8_t_cell, ROUND(100.0 * cd8_t_cell / total_count, 4) FROM intermediate
+        UNION ALL
+        SELECT sample, total_count, 'cd4_t_cell', cd4_t_cell, ROUND(100.0 * cd4_t_cell / total_count, 4) FROM intermediate
+        UNION ALL
+        SELECT sample, total_count, 'nk_cell', nk_cell, ROUND(100.0 * nk_cell / total_count, 4) FROM intermediate
+        UNION ALL
+        SELECT sample, total_count, 'monocyte', monocyte, ROUND(100.0 * monocyte / total_count, 4) FROM intermediate
+    """)
+
+'''
+Create the compact overview tables under the given name from the sample
+table: <name>_samples with an integer sample_id, the sample name and its
+total_count once per sample, <name>_populations with a small integer code per
+population, and <name>_counts with one (sample_id, population_id, count,
+percentage) row per population in a WITHOUT ROWID table clustered on its key,
+so the five rows of a sample are stored together and read as one range. The
+percentage is kept unrounded; the view rounds it like the long table does.
+'''
+def _build_compact_overview(cursor: sqlite3.Cursor, table_name: str, name: str) -> None:
+    cursor.execute(f"CREATE TABLE {name}_populations (population_id INTEGER PRIMARY KEY, population TEXT UNIQUE)")
+    cursor.executemany(f"INSERT INTO {name}_populations (population_id, population) VALUES (?, ?)",
+                       list(enumerate(POPULATIONS)))
+    cursor.execute(f"CREATE TABLE {name}_samples (sample_id INTEGER PRIMARY KEY, sample TEXT, total_count INTEGER)")
+    cursor.execute(f"""
+        CREATE TABLE {name}_counts (
+        sample_id INTEGER,
+        population_id INTEGER,
+        count INTEGER,
+        percentage REAL,
+        PRIMARY KEY (sample_id, population_id)
+        ) WITHOUT ROWID"""
+    )
+
+    # read the sample table once; the rowid of the copy becomes the sample_id
+    counts = ", ".join(POPULATIONS)
+    total_count = "total_count" if _has_total_count(cursor, table_name) else TOTAL_COUNT_EXPRESSION
+    cursor.execute(f"DROP TABLE IF EXISTS temp.{name}_source")
+    cursor.execute(f"CREATE TEMP TABLE {name}_source AS SELECT sample, {counts}, {total_count} AS total_count FROM {table_name}")
+    cursor.execute(f"""
+        INSERT INTO {name}_samples (sample_id, sample, total_count)
+        SELECT rowid, sample, total_count FROM temp.{name}_source
+    """)
+    count_case = " ".join(f"WHEN {position} THEN w.{population}" for position, population in enumerate(POPULATIONS))
+    cursor.execute(f"""
+        INSERT INTO {name}_counts (sample_id, population_id, count, percentage)
+        SELECT sample_id, population_id, count, 100.0 * count / total_count
+        FROM (
+            SELECT
+                w.rowid AS sample_id,
+                p.population_id,
+                CASE p.population_id {count_case} END AS count,
+                w.total_count
+            FROM temp.{name}_source w CROSS JOIN {name}_populations p
+        )
+    """)
+    cursor.execute(f"DROP TABLE temp.{name}_source")
+
+
+'''
+Create the view that presents a compact overview with the columns of the
+long overview table.
+'''
+def _create_compact_overview_view(cursor: sqlite3.Cursor, name: str) -> None:
+    cursor.execute(f"""
+        CREATE VIEW {name} AS
+        SELECT s.sample, s.total_count, p.population, c.count, ROUND(c.percentage, 4) AS percentage
+        FROM {name}_counts c
+        JOIN {name}_samples s ON s.sample_id = c.sample_id
+        JOIN {name}_populations p ON p.population_id = c.population_id
+    """)
+
+
+'''
+Report which schema an overview is stored in, or None if it does not exist.
+'''
+def _overview_layout(cursor: sqlite3.Cursor, name: str):
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    if row[0] == 'table':
+        return 'long'
+    return 'compact' if _table_exists(cursor, f"{name}_counts") else None
+
+
+'''
+Drop an overview and every table backing it, whichever schema it has.
+'''
+def _drop_overview_tables(cursor: sqlite3.Cursor, name: str) -> None:
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    if row is not None:
+        cursor.execute(f"DROP {row[0].upper()} {name}")
+    for suffix in ('_counts', '_samples', '_populations'):
+        cursor.execute(f"DROP TABLE IF EXISTS {name}{suffix}")
+
+
+'''
+Names of the triggers that keep an overview table in step with the sample
+table.
+'''
+def _overview_trigger_names(overview_table_name: str) -> list:
+    return [f"{overview_table_name}_maintain_{event}" for event in ('insert', 'update', 'delete')]
+
+
+'''
+Check whether an overview is kept current by triggers on the physical sample
+table target (not ones left on a table that has since been replaced).
+'''
+def _overview_maintained(cursor: sqlite3.Cursor, overview_table_name: str, target: str) -> bool:
+    names = _overview_trigger_names(overview_table_name)
+    cursor.execute(f"""
+        SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'trigger' AND tbl_name = ? AND name IN ({", ".join("?" * len(names))})
+        """, (target, *names))
+    return cursor.fetchone()[0] == len(names)
+
+
+'''
+Drop the maintenance triggers of an overview and, if maintain is set, create
+them on the physical sample table target. Every schema keeps the sample key
+and the counts on that table, so its triggers see every change that matters
+to the overview. Each trigger touches only the rows of the affected sample,
+found through the overview's sample index.
+'''
+def _set_overview_triggers(cursor: sqlite3.Cursor, overview_table_name: str, target: str,
+                           maintain: bool, schema: str = 'long') -> None:
+    insert_trigger, update_trigger, delete_trigger = _overview_trigger_names(overview_table_name)
+    for name in (insert_trigger, update_trigger, delete_trigger):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    if not maintain:
+        return
+
+    # CTEs are not allowed inside triggers, so the unpivot is spelled out
+    if _has_total_count(cursor, target):
+        total_count = "NEW.total_count"
+    else:
+        total_count = " + ".join(f"NEW.{name}" for name in POPULATIONS)
+    if schema == 'compact':
+        populations = " UNION ALL ".join(
+            f"SELECT {position} AS population_id, NEW.{name} AS count" for position, name in enumerate(POPULATIONS)
+        )
+        # last_insert_rowid() is the new sample_id while the trigger runs
+        insert_rows = f"""
+            INSERT INTO {overview_table_name}_samples (sample, total_count) VALUES (NEW.sample, {total_count});
+            INSERT INTO {overview_table_name}_counts (sample_id, population_id, count, percentage)
+            SELECT last_insert_rowid(), population_id, count, 100.0 * count / ({total_count})
+            FROM ({populations});
+        """
+        delete_rows = f"""
+            DELETE FROM {overview_table_name}_counts WHERE sample_id IN
+                (SELECT sample_id FROM {overview_table_name}_samples WHERE sample = OLD.sample);
+            DELETE FROM {overview_table_name}_samples WHERE sample = OLD.sample;
+        """
+    else:
+        populations = " UNION ALL ".join(f"SELECT '{name}' AS population, NEW.{name} AS count" for name in POPULATIONS)
+        insert_rows = f"""
+            INSERT INTO {overview_table_name} (sample, total_count, population, count, percentage)
+            SELECT NEW.sample, total_count, population, count, ROUND(100.0 * count / total_count, 4)
+            FROM (SELECT {total_count} AS total_count), ({populations});
+        """
+        delete_rows = f"DELETE FROM {overview_table_name} WHERE sample = OLD.sample;"
+
+    cursor.execute(f"CREATE TRIGGER {insert_trigger} AFTER INSERT ON {target} BEGIN {insert_rows} END")
+    cursor.execute(f"""
+        CREATE TRIGGER {update_trigger} AFTER UPDATE OF sample, {", ".join(POPULATIONS)} ON {target}
+        BEGIN {delete_rows} {insert_rows} END
+    """)
+    cursor.execute(f"CREATE TRIGGER {delete_trigger} AFTER DELETE ON {target} BEGIN {delete_rows} END")
+
+'''
+The population counts of a sample table held in memory as an
+(n_samples x n_populations) integer matrix, in POPULATIONS order, with every
+column in MATRIX_COLUMNS stored as integer codes into its list of distinct
+values. totals and percentages (rounded like the overview table) are computed
+once for the whole matrix, and mask() selects cohorts by comparing codes, so
+the overview, plot and statistics paths never walk Python rows. Build one with
+load_counts_matrix().
+'''
+@dataclass
+class CountsMatrix:
+    samples: np.ndarray
+    counts: np.ndarray
+    codes: dict
+    categories: dict
+
+    def __post_init__(self):
+        self.totals = self.counts.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.percentages = np.round(100.0 * self.counts / self.totals[:, np.newaxis], 4)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    '''
+    Boolean mask of the samples whose columns equal the given values. A list
+    or tuple of values matches any of them; a value that never occurs matches
+    no sample.
+    '''
+    def mask(self, **filters) -> np.ndarray:
+        selected = np.ones(len(self), dtype=bool)
+        for column, value in filters.items():
+            if column not in self.codes:
+                raise ValueError(f"Unknown column '{column}', expected one of {MATRIX_COLUMNS}")
+            values = value if isinstance(value, (list, tuple)) else [value]
+            lookup = {category: code for code, category in enumerate(self.categories[column])}
+            selected &= np.isin(self.codes[column], [lookup[v] for v in values if v in lookup])
+        return selected
+
+    '''
+    Relative frequencies of one population for the samples in the mask.
+    '''
+    def population_percentages(self, population: str, selected: np.ndarray) -> np.ndarray:
+        return self.percentages[selected, POPULATIONS.index(population)]
+
+
+'''
+Read a sample table (in any schema) into a CountsMatrix with one query. This is
+the only step that touches individual rows; build the matrix once and pass it to
+plot_cell_frequencies() for every cohort. Missing counts are read as 0.
+'''
+def load_counts_matrix(db_name: str, table_name: str) -> CountsMatrix:
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    counts = ", ".join(f"COALESCE({population}, 0)" for population in POPULATIONS)
+    cursor.execute(f"SELECT sample, {counts}, {', '.join(MATRIX_COLUMNS)} FROM {table_name}")
+    rows = cursor.fetchall()
+    conn.close()
+
+    # transpose into one tuple per column
+    columns = list(zip(*rows)) or [()] * (1 + len(POPULATIONS) + len(MATRIX_COLUMNS))
+    del rows
+    n = len(columns[0])
+    codes = {}
+    categories = {}
+    for column, values in zip(MATRIX_COLUMNS, columns[1 + len(POPULATIONS):]):
+        lookup = dict.fromkeys(values)
+        for code, category in enumerate(lookup):
+            lookup[category] = code
+        codes[column] = np.fromiter(map(lookup.__getitem__, values), dtype=np.int32, count=n)
+        categories[column] = list(lookup)
+
+    return CountsMatrix(
+        samples=np.array(columns[0], dtype=object),
+        counts=np.array(columns[1:1 + len(POPULATIONS)], dtype=np.int64).reshape(len(POPULATIONS), n).T,
+        codes=codes,
+        categories=categories,
+    )
+
+
+# Part 3 ----------------------------------------------------------------------
+# file the boxplot figures are saved to unless an output_path is given
+BOXPLOT_FILENAME = 'cell_response_boxplots.png'
+
+# where cached_boxplot() keeps rendered figures, and how many bytes of them
+PLOT_CACHE_DIR = 'plot_cache'
+PLOT_CACHE_BYTES = 64 * 1024 * 1024
+
+# directory render_gallery() writes its figures and index.html to
+GALLERY_DIR = 'gallery'
+
+# background renders of headless plots, collected by wait_for_plots(), and
+# the process the render thread belongs to (a forked child does not inherit it)
+_plot_executor = None
+_plot_executor_pid = None
+_pending_plots = []
+
+
+'''
+Lay out the five population panels of the boxplot figure. draw_panel(axes,
+cell_type) draws the responder and non-responder boxes of one population.
+'''
+def _draw_boxplot_figure(fig, cell_types: list, draw_panel) -> None:
+    axes = fig.subplots(2, 3).flatten()
+    
+    for idx, cell_type in enumerate(cell_types):
+        draw_panel(axes[idx], cell_type)
+        axes[idx].set_title(f'{cell_type.replace("_", " ").title()}')
+        axes[idx].set_xlabel('Treatment Response')
+        axes[idx].set_ylabel('Relative Frequency (%)')
+        axes[idx].grid(axis='y', alpha=0.3)
+    
+    # Remove extra subplot
+    fig.delaxes(axes[5])
+    
+    fig.tight_layout()
+
+
+'''
+Draw the boxplot figure and save it to output_path. By default this goes
+through pyplot and shows the figure, which blocks until its window is closed,
+then closes it. With headless=True the figure is drawn on a plain Agg Figure,
+which involves no GUI and no pyplot state, and the drawing and saving run on
+a background thread while the caller carries on; wait_for_plots() waits for
+them. Either way the figure is released once saved.
+'''
+def _render_boxplots(cell_types: list, draw_panel, headless: bool, output_path: str) -> None:
+    if headless:
+        _submit_plot(_save_headless_boxplots, cell_types, draw_panel, output_path)
+        return
+
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(15, 8))
+    _draw_boxplot_figure(fig, cell_types, draw_panel)
+    plt.savefig(output_path, dpi=300, bbox_inches='tight')
+    plt.show()
+    plt.close(fig)
+
+
+'''
+Queue render(*args) on the background plot thread, for wait_for_plots().
+'''
+def _submit_plot(render, *args) -> None:
+    global _plot_executor, _plot_executor_pid
+    if _plot_executor is None or _plot_executor_pid != os.getpid():
+        # one thread: renders are CPU bound and may write the same file
+        _plot_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plot")
+        _plot_executor_pid = os.getpid()
+        _pending_plots.clear()
+    _pending_plots.append(_plot_executor.submit(render, *args))
+
+
+'''
+Background half of a headless _render_boxplots(). Returns the saved path.
+'''
+def _save_headless_boxplots(cell_types: list, draw_panel, output_path: str) -> str:
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(15, 8))
+    FigureCanvasAgg(fig)
+    try:
+        _draw_boxplot_figure(fig, cell_types, draw_panel)
+        fig.savefig(output_path, dpi=300, bbox_inches='tight')
+    finally:
+        fig.clear()
+    return output_path
+
+
+'''
+Wait for every headless plot still rendering and return the paths they were
+saved to, in the order they were requested. An error raised while rendering
+is raised here.
+'''
+def wait_for_plots() -> list:
+    paths = []
+    while _pending_plots:
+        paths.append(_pending_plots.pop(0).result())
+    return paths
+
+
+'''
+Return the path of the boxplot figure of plot_cell_frequencies() for a cohort,
+rendering it only when it is not cached yet. Figures are cached in cache_dir
+under a hash of the recorded versions of the sample and overview tables and
+of (condition, treatment, sample_type), so a repeat request for unchanged data
+returns at once without querying it, and a reload or overview rebuild makes a
+new entry. When the cache grows past max_bytes the least recently used
+figures are deleted. With output_path the figure is also copied there and that
+path is returned. Tables that were not loaded by load_csv_to_sqlite(), or
+whose overview is maintained by triggers, can change without a new version,
+so their figures are rendered every time and not cached.
+A render draws data, the cell_frequencies() result for the cohort, when it is
+given instead of querying the cohort again. With background=True it runs on
+the thread of headless plots and the path is returned at once, before the
+figure is written; wait_for_plots() waits for it.
+'''
+def cached_boxplot(db_name: str, sample_table_name: str, overview_table_name: str, treatment: str, condition: str,
+                   sample_type: str = 'PBMC', output_path: str = None, cache_dir: str = PLOT_CACHE_DIR,
+                   max_bytes: int = PLOT_CACHE_BYTES, data: tuple = None, background: bool = False) -> str:
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    source = _read_metadata(cursor, sample_table_name)
+    built = _read_metadata(cursor, overview_table_name)
+    layout = _sample_layout(cursor, sample_table_name)
+    target = _sample_target(sample_table_name, layout) if layout is not None else sample_table_name
+    maintained = _overview_maintained(cursor, overview_table_name, target)
+    conn.close()
+
+    def render(draw, *args):
+        if background:
+            _submit_plot(draw, *args)
+        else:
+            draw(*args)
+
+    if source is None or source[3] is None or built is None or maintained:
+        print(f"\n{sample_table_name} can change without a new version, rendering boxplots without the cache")
+        output_path = output_path or BOXPLOT_FILENAME
+        if data is None:
+            data = _cohort_frequencies(db_name, sample_table_name, overview_table_name, treatment, condition,
+                                       None, sample_type)[:2]
+        render(_save_headless_boxplots, data[1], _response_panel(data[0]), output_path)
+        return output_path
+
+    key = json.dumps([sample_table_name, source[3], overview_table_name, built[3], condition, treatment, sample_type])
+    cache_path = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".png")
+    if os.path.exists(cache_path):
+        print(f"\nUsing cached boxplots {cache_path}")
+        # the modification time is the recency the eviction goes by
+        os.utime(cache_path)
+        if output_path is None:
+            return cache_path
+        shutil.copyfile(cache_path, output_path)
+        return output_path
+
+    print(f"\nRendering boxplots into the cache as {cache_path}")
+    if data is None:
+        data = _cohort_frequencies(db_name, sample_table_name, overview_table_name, treatment, condition,
+                                   None, sample_type)[:2]
+    render(_store_cached_boxplot, data[1], _response_panel(data[0]), cache_path, max_bytes, output_path)
+    return output_path or cache_path
+
+
+'''
+Render half of cached_boxplot(): save the figure to cache_path, evict past
+max_bytes, and copy it to output_path if given. Returns the path of the copy.
+'''
+def _store_cached_boxplot(cell_types: list, draw_panel, cache_path: str, max_bytes: int, output_path: str) -> str:
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # render under a temporary name so readers never see a partial file
+    partial = os.path.join(cache_dir, f".{uuid.uuid4().hex}.png")
+    try:
+        _save_headless_boxplots(cell_types, draw_panel, partial)
+        os.replace(partial, cache_path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    _evict_plot_cache(cache_dir, max_bytes, keep=cache_path)
+
+    if output_path is None:
+        return cache_path
+    shutil.copyfile(cache_path, output_path)
+    return output_path
+
+
+'''
+Render one cohort's boxplots headless to output_path on the calling thread,
+without printing the cohort report, and return the data by population and
+response and the cell types. Unlike plot_cell_frequencies(headless=True) this
+shares no queue or stdout with other callers, so concurrent sessions and
+gallery workers each get their own figure.
+'''
+def _render_boxplots_now(db_name: str, sample_table_name: str, overview_table_name: str, treatment: str,
+                         condition: str, sample_type: str, output_path: str) -> tuple:
+    data_by_population, cell_types, _ = _cohort_frequencies(db_name, sample_table_name, overview_table_name,
+                                                            treatment, condition, None, sample_type)
+    _save_headless_boxplots(cell_types, _response_panel(data_by_population), output_path)
+    return data_by_population, cell_types
+
+
+'''
+Delete the least recently used cached figures until the cache holds at most
+max_bytes, never deleting keep.
+'''
+def _evict_plot_cache(cache_dir: str, max_bytes: int, keep: str) -> None:
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".png") and not entry.name.startswith("."):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+'''
+Render the responder/non-responder boxplots of every condition and treatment
+pair that has samples of sample_type, one PNG per pair in output_dir, and
+write output_dir/index.html linking them with their sample counts. Returns
+the path of the index. The figures are rendered in a pool of worker processes,
+each drawing headless through _render_boxplots_now(); workers=None uses every
+core and workers=1 renders in this process.
+'''
+def render_gallery(db_name: str, sample_table_name: str, overview_table_name: str,
+                   output_dir: str = GALLERY_DIR, sample_type: str = 'PBMC', workers: int = None) -> str:
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT DISTINCT condition, treatment FROM {sample_table_name}
+        WHERE sample_type = ? AND condition IS NOT NULL AND treatment IS NOT NULL
+        ORDER BY condition, treatment
+    """, (sample_type,))
+    pairs = cursor.fetchall()
+    conn.close()
+
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [
+        (db_name, sample_table_name, overview_table_name, treatment, condition, sample_type,
+         # the index keeps names unique once unsafe characters are replaced
+         os.path.join(output_dir, f"{index:03d}_{re.sub(r'[^A-Za-z0-9.-]+', '_', f'{condition}_{treatment}')}.png"))
+        for index, (condition, treatment) in enumerate(pairs)
+    ]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks)))
+
+    print(f"\nRendering {len(tasks)} condition/treatment boxplots with {workers} worker(s)")
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            figures = list(executor.map(_render_gallery_figure, tasks))
+    else:
+        figures = [_render_gallery_figure(task) for task in tasks]
 
-    cursor.executemany(
-        f"""
-        INSERT INTO {table_name} ({col_names})
-        VALUES ({placeholders})
-        """
-        , reader
+    rows = "\n".join(
+        f"<tr><td>{html.escape(condition)}</td><td>{html.escape(treatment)}</td><td>{responders}</td>"
+        f"<td>{non_responders}</td><td><a href=\"{html.escape(name)}\"><img src=\"{html.escape(name)}\" width=\"480\"></a></td></tr>"
+        for condition, treatment, name, responders, non_responders in figures
     )
+    index_path = os.path.join(output_dir, "index.html")
+    with open(index_path, 'w', encoding='utf-8') as f:
+        f.write(f"""<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>Cell relative frequencies by response ({html.escape(sample_type)})</title></head>
+<body>
+<h1>Cell relative frequencies by response ({html.escape(sample_type)})</h1>
+<table>
+<tr><th>Condition</th><th>Treatment</th><th>Responders</th><th>Non-responders</th><th>Boxplots</th></tr>
+{rows}
+</table>
+</body>
+</html>
+""")
+    print(f"Wrote {index_path}")
+    return index_path
 
-    conn.commit()
-    conn.close()
 
-    file.close()
+'''
+Worker half of render_gallery(): render one pair's figure and return
+(condition, treatment, file name, responders, non-responders).
+'''
+def _render_gallery_figure(task: tuple) -> tuple:
+    db_name, sample_table_name, overview_table_name, treatment, condition, sample_type, output_path = task
+    data_by_population, cell_types = _render_boxplots_now(db_name, sample_table_name, overview_table_name,
+                                                          treatment, condition, sample_type, output_path)
+    return (condition, treatment, os.path.basename(output_path),
+            len(data_by_population[cell_types[0]]['yes']), len(data_by_population[cell_types[0]]['no']))
+
 
-# Part 2 ----------------------------------------------------------------------
-    
 '''
-Given an SQlite db and table name, produce a new summary table of the samples 
-in that dataset
+Query half of cell_frequencies(), which prints nothing: returns the data by
+population and response, the cell types and the number of observations.
 '''
-def overview(db_name: str, table_name: str, overview_table_name: str) -> None:
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
+def _cohort_frequencies(db_name: str, sample_table_name: str, overview_table_name: str, treatment: str,
+                        condition: str, matrix: CountsMatrix, sample_type: str) -> tuple:
+    cell_types = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
+
+    if matrix is None:
+        conn = sqlite3.connect(db_name)
+        cursor = conn.cursor()
+        
+        # Query relative frequencies (percentages) with response status
+        query = f"""
+        SELECT ov.population, ov.percentage, sd.response
+        FROM {overview_table_name} ov
+        JOIN {sample_table_name} sd ON ov.sample = sd.sample
+        WHERE sd.sample_type = ?
+          AND sd.condition = ?
+          AND sd.treatment = ?
+        """
+        
+        cursor.execute(query, (sample_type, condition, treatment))
+        results = cursor.fetchall()
+        conn.close()
+        observations = len(results)
+        
+        # Organize data by population and response
+        data_by_population = {ct: {'yes': [], 'no': []} for ct in cell_types}
+        
+        for population, percentage, response in results:
+            # samples without a yes/no response (e.g. untreated) are left out
+            if population in data_by_population and response in data_by_population[population]:
+                data_by_population[population][response].append(percentage)
+    else:
+        cohort = matrix.mask(sample_type=sample_type, condition=condition, treatment=treatment)
+        observations = int(cohort.sum()) * len(cell_types)
+        by_response = {response: cohort & matrix.mask(response=response) for response in ('yes', 'no')}
+        data_by_population = {
+            ct: {response: matrix.population_percentages(ct, selected) for response, selected in by_response.items()}
+            for ct in cell_types
+        }
+
+    return data_by_population, cell_types, observations
 
-    cursor.execute(f"DROP TABLE IF EXISTS {overview_table_name}")
-    cursor.execute(f"""
-        CREATE TABLE {overview_table_name} AS
-        WITH intermediate AS (
-            SELECT 
-                sample,
-                b_cell + cd8_t_cell + cd4_t_cell + nk_cell + monocyte AS total_count,
-                b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte
-            FROM {table_name}
-        )
-        SELECT 
-            sample, 
-            total_count, 
-            'b_cell' AS population, 
-            b_cell AS count,
-            ROUND(100.0 * b_cell / total_count, 4) AS percentage
-        FROM intermediate
-        UNION ALL
-        SELECT sample, total_count, 'cd8_t_cell', cd8_t_cell, ROUND(100.0 * cd8_t_cell / total_count, 4) FROM intermediate
-        UNION ALL
-        SELECT sample, total_count, 'cd4_t_cell', cd4_t_cell, ROUND(100.0 * cd4_t_cell / total_count, 4) FROM intermediate
-        UNION ALL
-        SELECT sample, total_count, 'nk_cell', nk_cell, ROUND(100.0 * nk_cell / total_count, 4) FROM intermediate
-        UNION ALL
-        SELECT sample, total_count, 'monocyte', monocyte, ROUND(100.0 * monocyte / total_count, 4) FROM intermediate
-    """)
-    
-    print(f"\n=== Overview Table: Cell Population Frequency Analysis ===")
-    print(f"Columns: sample | total_count | population | count | percentage")
-    print(f"Sample size: First 10 rows\n")
-    
-    for row in cursor.execute(f"SELECT * FROM {overview_table_name} LIMIT 10"):
-        print(row)
-    
-    conn.commit()
-    conn.close()
 
-# Part 3 ----------------------------------------------------------------------
 '''
-Plot boxplots comparing cell relative frequencies between treatment responders
-and non-responders. Can be used with any statistical test.
-Returns the organized data by population and response for further analysis.
+Collect the cell relative frequencies of treatment responders and
+non-responders in a cohort and print its size, without plotting.
+Returns the organized data by population and response for the statistical
+tests. Given a CountsMatrix from load_counts_matrix(), the cohort is selected
+from it with masks instead of being queried, and the percentages are NumPy
+arrays.
 '''
-def plot_cell_frequencies(db_name: str, sample_table_name: str, overview_table_name: str, treatment: str, condition: str) -> tuple:
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-    
-    # Query relative frequencies (percentages) with response status
-    query = f"""
-    SELECT ov.population, ov.percentage, sd.response
-    FROM {overview_table_name} ov
-    JOIN {sample_table_name} sd ON ov.sample = sd.sample
-    WHERE sd.sample_type = 'PBMC' 
-      AND sd.condition = '{condition}' 
-      AND sd.treatment = '{treatment}'
-    """
-    
-    cursor.execute(query)
-    results = cursor.fetchall()
+def cell_frequencies(db_name: str, sample_table_name: str, overview_table_name: str, treatment: str, condition: str,
+                     matrix: CountsMatrix = None, sample_type: str = 'PBMC') -> tuple:
+    data_by_population, cell_types, observations = _cohort_frequencies(
+        db_name, sample_table_name, overview_table_name, treatment, condition, matrix, sample_type)
     
     print(f"\n=== Cell Relative Frequency Analysis ===")
     print(f"Condition: {condition}, Treatment: {treatment}")
-    print(f"Sample Type: PBMC")
-    print(f"Total observations in analysis: {len(results)}")
-    
-    # Organize data by population and response
-    cell_types = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
-    data_by_population = {ct: {'yes': [], 'no': []} for ct in cell_types}
-    
-    for population, percentage, response in results:
-        if population in data_by_population:
-            data_by_population[population][response].append(percentage)
+    print(f"Sample Type: {sample_type}")
+    print(f"Total observations in analysis: {observations}")
     
     # Count samples
     yes_count = sum(len(data_by_population[ct]['yes']) for ct in cell_types) // len(cell_types)
@@ -151,32 +1947,41 @@ def plot_cell_frequencies(db_name: str, sample_table_name: str, overview_table_n
     
     print(f"Responders (Response=Yes): {yes_count}")
     print(f"Non-responders (Response=No): {no_count}\n")
-    
+
+    return data_by_population, cell_types
+
+
+'''
+Plot boxplots comparing cell relative frequencies between treatment responders
+and non-responders. Can be used with any statistical test.
+Returns the organized data by population and response from cell_frequencies()
+for further analysis; matrix is passed on to it.
+With headless=True the figure is rendered in the background without a GUI
+(see _render_boxplots), so this returns as soon as the data is organized.
+The figure is saved to output_path, BOXPLOT_FILENAME by default.
+'''
+def plot_cell_frequencies(db_name: str, sample_table_name: str, overview_table_name: str, treatment: str, condition: str,
+                          matrix: CountsMatrix = None, headless: bool = False, sample_type: str = 'PBMC',
+                          output_path: str = None) -> tuple:
+    data_by_population, cell_types = cell_frequencies(db_name, sample_table_name, overview_table_name,
+                                                      treatment, condition, matrix, sample_type)
+
     # Create 5 subplots
-    fig, axes = plt.subplots(2, 3, figsize=(15, 8))
-    axes = axes.flatten()
+    _render_boxplots(cell_types, _response_panel(data_by_population), headless, output_path or BOXPLOT_FILENAME)
     
-    for idx, cell_type in enumerate(cell_types):
+    return data_by_population, cell_types
+
+
+'''
+Return the draw_panel of _draw_boxplot_figure() that draws the responder and
+non-responder boxes of a population from cell_frequencies() data.
+'''
+def _response_panel(data_by_population: dict):
+    def draw_panel(ax, cell_type):
         yes_data = data_by_population[cell_type]['yes']
         no_data = data_by_population[cell_type]['no']
-        
-        # Create boxplot
-        axes[idx].boxplot([yes_data, no_data], labels=['Yes', 'No'])
-        axes[idx].set_title(f'{cell_type.replace("_", " ").title()}')
-        axes[idx].set_xlabel('Treatment Response')
-        axes[idx].set_ylabel('Relative Frequency (%)')
-        axes[idx].grid(axis='y', alpha=0.3)
-    
-    # Remove extra subplot
-    fig.delaxes(axes[5])
-    
-    plt.tight_layout()
-    plt.savefig('cell_response_boxplots.png', dpi=300, bbox_inches='tight')
-    plt.show()
-    
-    conn.close()
-    
-    return data_by_population, cell_types
+        ax.boxplot([yes_data, no_data], labels=['Yes', 'No'])
+    return draw_panel
 
 
 '''
@@ -185,6 +1990,7 @@ Compares cell relative frequencies between responders and non-responders.
 Works with data returned from plot_cell_frequencies().
 '''
 def analyze_frequencies_mw(data_by_population: dict, cell_types: list) -> None:
+    from scipy import stats
     print("Cell Type Relative Frequency Statistics (Mann-Whitney U):")
     p_values = []
     
@@ -192,8 +1998,8 @@ def analyze_frequencies_mw(data_by_population: dict, cell_types: list) -> None:
         yes_data = data_by_population[cell_type]['yes']
         no_data = data_by_population[cell_type]['no']
         
-        yes_mean = sum(yes_data) / len(yes_data) if yes_data else 0
-        no_mean = sum(no_data) / len(no_data) if no_data else 0
+        yes_mean = np.mean(yes_data) if len(yes_data) else 0
+        no_mean = np.mean(no_data) if len(no_data) else 0
         
         print(f"\n{cell_type}:")
         print(f"  Responders (Yes)     - Mean: {yes_mean:.2f}%")
@@ -203,23 +2009,7 @@ def analyze_frequencies_mw(data_by_population: dict, cell_types: list) -> None:
         statistic, p_value = stats.mannwhitneyu(yes_data, no_data, alternative='two-sided')
         p_values.append((cell_type, p_value))
     
-    # Benjamini-Hochberg FDR correction
-    print("\n" + "="*70)
-    print("Statistical Significance Testing (Mann-Whitney U with BH FDR)")
-    print("="*70)
-    
-    sorted_indices = sorted(range(len(p_values)), key=lambda i: p_values[i][1])
-    
-    print(f"{'Cell Type':<18} {'p-value':<12} {'BH Threshold':<15} {'Significant':<12}")
-    print("-"*70)
-    
-    for rank, idx in enumerate(sorted_indices):
-        cell_type, p_value = p_values[idx]
-        threshold = (rank + 1) / len(cell_types) * 0.05
-        is_significant = p_value < threshold
-        marker = "Yes ***" if is_significant else "No"
-        
-        print(f"{cell_type:<18} {p_value:<12.4f} {threshold:<15.4f} {marker:<12}")
+    _print_significance(p_values, cell_types, "Mann-Whitney U")
 
 
 '''
@@ -229,6 +2019,7 @@ Works with data returned from plot_cell_frequencies().
 Use to compare parametric vs non-parametric approaches.
 '''
 def analyze_frequencies_ttest(data_by_population: dict, cell_types: list) -> None:
+    from scipy import stats
     print("\nCell Type Relative Frequency Statistics (Welch's t-test):")
     p_values = []
     
@@ -236,8 +2027,8 @@ def analyze_frequencies_ttest(data_by_population: dict, cell_types: list) -> Non
         yes_data = data_by_population[cell_type]['yes']
         no_data = data_by_population[cell_type]['no']
         
-        yes_mean = sum(yes_data) / len(yes_data) if yes_data else 0
-        no_mean = sum(no_data) / len(no_data) if no_data else 0
+        yes_mean = np.mean(yes_data) if len(yes_data) else 0
+        no_mean = np.mean(no_data) if len(no_data) else 0
         
         print(f"\n{cell_type}:")
         print(f"  Responders (Yes)     - Mean: {yes_mean:.2f}%")
@@ -248,9 +2039,16 @@ def analyze_frequencies_ttest(data_by_population: dict, cell_types: list) -> Non
         statistic, p_value = stats.ttest_ind(yes_data, no_data, equal_var=False)
         p_values.append((cell_type, p_value))
     
-    # Benjamini-Hochberg FDR correction (same as Mann-Whitney analysis)
+    _print_significance(p_values, cell_types, "Welch's t-test")
+
+
+'''
+Print the Benjamini-Hochberg FDR table for (cell_type, p_value) pairs, shared
+by the Mann-Whitney U and Welch's t-test analyses.
+'''
+def _print_significance(p_values: list, cell_types: list, test_name: str) -> None:
     print("\n" + "="*70)
-    print("Statistical Significance Testing (Welch's t-test with BH FDR)")
+    print(f"Statistical Significance Testing ({test_name} with BH FDR)")
     print("="*70)
     
     sorted_indices = sorted(range(len(p_values)), key=lambda i: p_values[i][1])
@@ -266,6 +2064,281 @@ def analyze_frequencies_ttest(data_by_population: dict, cell_types: list) -> Non
         
         print(f"{cell_type:<18} {p_value:<12.4f} {threshold:<15.4f} {marker:<12}")
 
+
+# cohort columns the statistics cube is grouped by, besides the population
+CUBE_COLUMNS = ['condition', 'treatment', 'sample_type', 'time_from_treatment_start', 'response']
+
+# width in percentage points of the histogram bins the cube keeps per group;
+# quartiles drawn from them are within half a bin of the exact ones
+SKETCH_BIN_WIDTH = 0.01
+
+# the 1.5 IQR fences move with the quartiles, so percentages this close to a
+# fence can land on the other side of it (see cohort_boxplot_stats)
+SKETCH_FENCE_MARGIN = 2.5 * SKETCH_BIN_WIDTH
+
+
+'''
+Build a summary table of the overview's relative frequencies with one row per
+(condition, treatment, sample_type, time_from_treatment_start, response,
+population), holding the number of samples and the sum, sum of squares,
+minimum and maximum of their percentages. Means, variances and Welch's t-test
+for a cohort then come from these sufficient statistics in time proportional
+to the number of groups instead of the number of samples. Alongside it,
+<cube>_bins holds a histogram of each group's percentages in SKETCH_BIN_WIDTH
+bins, from which cohort_boxplot_stats() draws boxplots. Like overview(),
+the cube is rebuilt in a staging table and swapped in, and skip_unchanged
+skips the rebuild when it was built from the current version of the sample
+table and its overview. An overview built from an older version of the sample
+table raises ValueError, since the cube would summarize stale percentages.
+While triggers maintain the overview it is always rebuilt, since those
+changes do not bump the recorded version.
+'''
+def build_stats_cube(db_name: str, sample_table_name: str, overview_table_name: str, cube_table_name: str,
+                     skip_unchanged: bool = False) -> None:
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+
+    source = _read_metadata(cursor, sample_table_name)
+    source_version = source[3] if source is not None else None
+    built = _read_metadata(cursor, cube_table_name)
+    summarized = _read_metadata(cursor, overview_table_name)
+    overview_version = summarized[3] if summarized is not None else None
+    layout = _sample_layout(cursor, sample_table_name)
+    target = _sample_target(sample_table_name, layout) if layout is not None else sample_table_name
+    maintained = _overview_maintained(cursor, overview_table_name, target)
+    if not maintained and overview_version != source_version:
+        conn.close()
+        raise ValueError(f"{overview_table_name} was not built from the current {sample_table_name}, "
+                         f"rebuild it with overview() before the statistics cube")
+    if (skip_unchanged and _table_exists(cursor, f"{cube_table_name}_bins") and not maintained
+            and source_version is not None and built is not None
+            and built[3] == overview_version == source_version):
+        print(f"\n{cube_table_name} is up to date with {sample_table_name}, skipping rebuild")
+        conn.close()
+        return
+
+    staging = f"{cube_table_name}_staging"
+    groups = ", ".join(f"sd.{column}" for column in CUBE_COLUMNS)
+    cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+    cursor.execute(f"""
+        CREATE TABLE {staging} AS
+        SELECT
+            {groups},
+            ov.population,
+            COUNT(ov.percentage) AS samples,
+            SUM(ov.percentage) AS total,
+            SUM(ov.percentage * ov.percentage) AS total_squares,
+            MIN(ov.percentage) AS minimum,
+            MAX(ov.percentage) AS maximum
+        FROM {overview_table_name} ov
+        JOIN {sample_table_name} sd ON ov.sample = sd.sample
+        GROUP BY {groups}, ov.population
+    """)
+    cursor.execute(f"DROP TABLE IF EXISTS {staging}_bins")
+    cursor.execute(f"""
+        CREATE TABLE {staging}_bins AS
+        SELECT
+            {groups},
+            ov.population,
+            CAST(ROUND(ov.percentage / {SKETCH_BIN_WIDTH}) AS INTEGER) AS bin,
+            COUNT(*) AS samples
+        FROM {overview_table_name} ov
+        JOIN {sample_table_name} sd ON ov.sample = sd.sample
+        WHERE ov.percentage IS NOT NULL
+        GROUP BY {groups}, ov.population, bin
+    """)
+    conn.commit()
+
+    cursor.execute("BEGIN IMMEDIATE")
+    for suffix in ('', '_bins'):
+        cursor.execute(f"DROP TABLE IF EXISTS {cube_table_name}{suffix}")
+        cursor.execute(f"ALTER TABLE {staging}{suffix} RENAME TO {cube_table_name}{suffix}")
+    _record_metadata(cursor, cube_table_name, sample_table_name, None, None, source_version)
+    conn.commit()
+    for suffix in ('', '_bins'):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{cube_table_name}{suffix}_cohort "
+                       f"ON {cube_table_name}{suffix} (condition, treatment, sample_type)")
+    conn.commit()
+
+    cursor.execute(f"SELECT COUNT(*) FROM {cube_table_name}")
+    print(f"\nBuilt {cube_table_name} with {cursor.fetchone()[0]} groups")
+    conn.close()
+
+
+'''
+Read the sufficient statistics of a responder/non-responder comparison from
+the statistics cube as {population: {response: (n, mean, variance, minimum,
+maximum)}} for responses 'yes' and 'no', combining every time point unless
+time_from_treatment_start is given. variance is the sample variance (ddof=1),
+NaN for fewer than two samples, as are mean, minimum and maximum for none.
+'''
+def cohort_statistics(db_name: str, cube_table_name: str, treatment: str, condition: str,
+                      sample_type: str = 'PBMC', time_from_treatment_start: int = None) -> dict:
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+
+    query = f"""
+        SELECT population, response, SUM(samples), SUM(total), SUM(total_squares), MIN(minimum), MAX(maximum)
+        FROM {cube_table_name}
+        WHERE condition = ? AND treatment = ? AND sample_type = ? AND response IN ('yes', 'no')
+    """
+    params = [condition, treatment, sample_type]
+    if time_from_treatment_start is not None:
+        query += " AND time_from_treatment_start = ?"
+        params.append(time_from_treatment_start)
+    cursor.execute(query + " GROUP BY population, response", params)
+    rows = cursor.fetchall()
+    conn.close()
+
+    empty = (0, np.nan, np.nan, np.nan, np.nan)
+    summary = {population: {'yes': empty, 'no': empty} for population in POPULATIONS}
+    for population, response, n, total, total_squares, minimum, maximum in rows:
+        if n == 0:
+            continue
+        mean = total / n
+        # sums of squares can cancel to just below zero
+        variance = max(total_squares - total * mean, 0.0) / (n - 1) if n > 1 else np.nan
+        summary[population][response] = (n, mean, variance, minimum, maximum)
+    return summary
+
+
+'''
+Boxplot statistics of a responder/non-responder comparison drawn from the
+cube's histograms, as {population: {response: stats}} where stats is the
+dictionary matplotlib's Axes.bxp() takes. The bins of every matching time
+point are merged, quartiles interpolate between order statistics like
+np.percentile does, and whiskers reach the furthest bin within 1.5 IQR of the
+box. The median and quartiles are within SKETCH_BIN_WIDTH / 2 of the ones
+boxplot() would compute from the raw percentages, which moves the fences 1.5
+IQR from the box by up to 2 * SKETCH_BIN_WIDTH. A whisker end is within
+SKETCH_BIN_WIDTH / 2 of boxplot()'s as long as no raw percentage lies within
+SKETCH_FENCE_MARGIN of its fence. Otherwise that percentage can be drawn as a
+flier instead of ending the whisker, or the other way round, and the whisker
+then ends at the next bin inward or outward, however far away. Each outlying
+bin gives one flier.
+'''
+def cohort_boxplot_stats(db_name: str, cube_table_name: str, treatment: str, condition: str,
+                         sample_type: str = 'PBMC', time_from_treatment_start: int = None) -> dict:
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+
+    query = f"""
+        SELECT population, response, bin, SUM(samples)
+        FROM {cube_table_name}_bins
+        WHERE condition = ? AND treatment = ? AND sample_type = ? AND response IN ('yes', 'no')
+    """
+    params = [condition, treatment, sample_type]
+    if time_from_treatment_start is not None:
+        query += " AND time_from_treatment_start = ?"
+        params.append(time_from_treatment_start)
+    cursor.execute(query + " GROUP BY population, response, bin ORDER BY population, response, bin", params)
+    histograms = {}
+    for population, response, bin, samples in cursor.fetchall():
+        histograms.setdefault((population, response), []).append((bin, samples))
+    conn.close()
+
+    labels = {'yes': 'Yes', 'no': 'No'}
+    return {
+        population: {
+            response: _sketch_boxplot_stats(histograms.get((population, response), []), labels[response])
+            for response in ('yes', 'no')
+        }
+        for population in POPULATIONS
+    }
+
+
+'''
+Turn a sorted [(bin, samples), ...] histogram into Axes.bxp() statistics.
+'''
+def _sketch_boxplot_stats(histogram: list, label: str) -> dict:
+    if not histogram:
+        return {'label': label, 'med': np.nan, 'q1': np.nan, 'q3': np.nan,
+                'whislo': np.nan, 'whishi': np.nan, 'fliers': []}
+    bins, samples = np.array(histogram, dtype=np.int64).T
+    values = bins * SKETCH_BIN_WIDTH
+    cumulative = np.cumsum(samples)
+    n = cumulative[-1]
+
+    def order_statistic(k):
+        return values[np.searchsorted(cumulative, k, side='right')]
+
+    def quantile(q):
+        position = (n - 1) * q
+        lower = int(position)
+        return order_statistic(lower) + (position - lower) * (order_statistic(min(lower + 1, n - 1)) - order_statistic(lower))
+
+    q1, med, q3 = quantile(0.25), quantile(0.5), quantile(0.75)
+    low, high = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+    inside = values[(values >= low) & (values <= high)]
+    return {
+        'label': label,
+        'med': med,
+        'q1': q1,
+        'q3': q3,
+        'whislo': min(inside.min(), q1) if len(inside) else q1,
+        'whishi': max(inside.max(), q3) if len(inside) else q3,
+        'fliers': values[(values < low) | (values > high)],
+    }
+
+
+'''
+Welch's t-test on the summary from cohort_statistics(), computed from the
+group sizes, means and variances alone. Prints the same report as
+analyze_frequencies_ttest() does for the raw data.
+'''
+def analyze_cube_ttest(summary: dict, cell_types: list) -> None:
+    from scipy import stats
+    print("\nCell Type Relative Frequency Statistics (Welch's t-test):")
+    p_values = []
+    
+    for cell_type in cell_types:
+        yes_n, yes_mean, yes_variance, _, _ = summary[cell_type]['yes']
+        no_n, no_mean, no_variance, _, _ = summary[cell_type]['no']
+        
+        print(f"\n{cell_type}:")
+        print(f"  Responders (Yes)     - Mean: {yes_mean if yes_n else 0:.2f}%")
+        print(f"  Non-responders (No)  - Mean: {no_mean if no_n else 0:.2f}%")
+        
+        statistic, p_value = stats.ttest_ind_from_stats(
+            yes_mean, np.sqrt(yes_variance), yes_n,
+            no_mean, np.sqrt(no_variance), no_n,
+            equal_var=False,
+        )
+        p_values.append((cell_type, p_value))
+    
+    _print_significance(p_values, cell_types, "Welch's t-test")
+
+
+'''
+plot_cell_frequencies() drawn from the statistics cube: the boxplots come from
+cohort_boxplot_stats() through Axes.bxp(), so no individual percentage is read.
+Returns the cohort_statistics() summary, for analyze_cube_ttest(). headless,
+sample_type and output_path work as in plot_cell_frequencies().
+'''
+def plot_cell_frequencies_from_cube(db_name: str, cube_table_name: str, treatment: str, condition: str,
+                                    headless: bool = False, sample_type: str = 'PBMC',
+                                    output_path: str = None) -> tuple:
+    cell_types = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
+    summary = cohort_statistics(db_name, cube_table_name, treatment, condition, sample_type)
+    boxes = cohort_boxplot_stats(db_name, cube_table_name, treatment, condition, sample_type)
+
+    yes_count = summary[cell_types[0]]['yes'][0]
+    no_count = summary[cell_types[0]]['no'][0]
+    
+    print(f"\n=== Cell Relative Frequency Analysis ===")
+    print(f"Condition: {condition}, Treatment: {treatment}")
+    print(f"Sample Type: {sample_type}")
+    print(f"Total observations in analysis: {(yes_count + no_count) * len(cell_types)}")
+    print(f"Responders (Response=Yes): {yes_count}")
+    print(f"Non-responders (Response=No): {no_count}\n")
+    
+    def draw_panel(ax, cell_type):
+        ax.bxp([boxes[cell_type]['yes'], boxes[cell_type]['no']])
+    
+    _render_boxplots(cell_types, draw_panel, headless, output_path or BOXPLOT_FILENAME)
+    
+    return summary, cell_types
+
 # Part 4 ----------------------------------------------------------------------
 '''
 Given a table of sample data, filter the data and report statistics Bob is 
@@ -384,52 +2457,268 @@ def filter(db_name: str, table_name: str, **filters) -> None:
     
     conn.close()
 
+
+def distinct_values(db_name: str, table_name: str, column: str) -> list:
+    '''
+    Return the sorted distinct values of a column of the sample table.
+    
+    With the dictionary schema the values of a categorical column are read
+    from its small lookup table instead of scanning every sample; codes no
+    longer used by any sample are left out. With the normalized schema the
+    subject-level columns are read from the subjects table.
+    
+    Example: distinct_values(db_name, table_name, 'condition')
+    '''
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    
+    layout = _sample_layout(cursor, table_name)
+    if column in CATEGORICAL_COLUMNS and layout == 'dictionary':
+        cursor.execute(f"""
+            SELECT value FROM {table_name}_{column}_codes c
+            WHERE EXISTS (SELECT 1 FROM {table_name}_encoded e WHERE e.{column}_code = c.code)
+        """)
+    elif column in SUBJECT_COLUMNS and layout == 'normalized':
+        cursor.execute(f"SELECT DISTINCT {column} FROM {table_name}_subjects")
+    else:
+        cursor.execute(f"SELECT DISTINCT {column} FROM {table_name}")
+    values = sorted(row[0] for row in cursor.fetchall())
+    
+    conn.close()
+    return values
+
 # Full Pipeline Execution -----------------------------------------------------
 
-input_filename = "cell-count.csv"
-db_name = "teiko_technical.db"
-table_name = "sample_data"
-overview_table_name = "overview"
+# defaults of the command line; every function above takes these as arguments
+INPUT_FILENAME = "cell-count.csv"
+DB_NAME = "teiko_technical.db"
+TABLE_NAME = "sample_data"
+OVERVIEW_TABLE_NAME = "overview"
 
-print("PART 1: Data Management")
-print("Loading CSV data into SQLite database...")
-load_csv_to_sqlite(input_filename, db_name, table_name)
+# the cohort analyzed in Part 3, and the conclusion Welch's t-test supports for it
+DEFAULT_COHORT = {'condition': 'melanoma', 'treatment': 'miraclib', 'sample_type': 'PBMC'}
+DEFAULT_RESULT = "According to Welch's t-test, melanoma patients who responded to miraclib have a significantly higher proportion of cd4_t_cells compared to non-responders. Other cell types show slight variations, but they are not statistically significant."
 
-print("------------------------------------------------------------------------")
+# the additional query: melanoma males at baseline, averaging their b_cells
+DEFAULT_QUERY = [('condition', 'melanoma'), ('sex', 'M'), ('time_from_treatment_start', 0)]
+DEFAULT_AVERAGE = 'b_cell'
 
-print("PART 2: Initial Analysis - Data Overview")
-overview(db_name, table_name, overview_table_name)
+# columns filter() accepts, the first 10 of the CSV
+FILTER_COLUMNS = CSV_COLUMNS[:10]
 
-print("------------------------------------------------------------------------")
+SEPARATOR = "------------------------------------------------------------------------"
 
-print("PART 3: Statistical Analysis")
-# Plot the data and get organized data for statistical analysis
-data_by_population, cell_types = plot_cell_frequencies(db_name, table_name, overview_table_name, "miraclib", "melanoma")
 
-# Run alternative statistical analysis with Welch's t-test
-analyze_frequencies_ttest(data_by_population, cell_types)
-result = "According to Welch's t-test, melanoma patients who responded to miraclib have a significantly higher proportion of cd4_t_cells compared to non-responders. Other cell types show slight variations, but they are not statistically significant."
-print(result)
+def run_load(args) -> None:
+    print("PART 1: Data Management")
+    print("Loading CSV data into SQLite database...")
+    load_csv_to_sqlite(args.input, args.db, args.table, bulk=True, skip_unchanged=not args.force,
+                       schema=args.schema, workers=args.workers)
 
-# Uncomment to run statistical analysis with Mann-Whitney U test
-#analyze_frequencies_mw(data_by_population, cell_types)
 
-print("------------------------------------------------------------------------")
+def run_overview(args) -> None:
+    print("PART 2: Initial Analysis - Data Overview")
+    overview(args.db, args.table, args.overview_table, skip_unchanged=not args.force,
+             maintain=args.maintain, schema=args.overview_schema)
 
-print("PART 4: Data Subset Analysis")
-further_analysis(db_name, table_name)
 
-print("------------------------------------------------------------------------")
+def run_plot(args) -> tuple:
+    print("PART 3: Statistical Analysis")
+    if args.gallery:
+        index_path = render_gallery(args.db, args.table, args.overview_table, output_dir=args.gallery,
+                                    sample_type=args.sample_type, workers=args.workers)
+        print(f"Gallery written to {index_path}")
+        return None
+    if args.headless and not args.force:
+        # the image of a cohort whose data did not change comes from the cache,
+        # otherwise it is rendered in the background while the stats run
+        data = cell_frequencies(args.db, args.table, args.overview_table, args.treatment, args.condition,
+                                sample_type=args.sample_type)
+        cached_boxplot(args.db, args.table, args.overview_table, args.treatment, args.condition,
+                       sample_type=args.sample_type, output_path=args.output, cache_dir=args.cache_dir,
+                       data=data, background=True)
+        return data
+    # Plot the data and get organized data for statistical analysis
+    return plot_cell_frequencies(args.db, args.table, args.overview_table, args.treatment, args.condition,
+                                 headless=args.headless, sample_type=args.sample_type, output_path=args.output)
 
-print("Additional Query")
-filter(db_name, table_name, condition='melanoma', sex='M', time_from_treatment_start=0)
-# Calculate average b_cells for melanoma males at baseline
-conn = sqlite3.connect(db_name)
-cursor = conn.cursor()
-cursor.execute(f"""
-    SELECT AVG(b_cell) FROM {table_name}
-    WHERE condition='melanoma' AND sex='M' AND time_from_treatment_start=0
-""")
-avg_b_cells = cursor.fetchone()[0]
-print(f"Average b_cells for melanoma males at baseline: {avg_b_cells:.2f}")
-conn.close()
\ No newline at end of file
+
+'''
+Test the responder differences of the cohort with Welch's t-test or, with
+--test mw, the Mann-Whitney U test. data is what run_plot() returned for the
+same cohort; without it the frequencies are queried without plotting.
+'''
+def run_stats(args, data: tuple = None) -> None:
+    if data is None:
+        print("PART 3: Statistical Analysis")
+        data = cell_frequencies(args.db, args.table, args.overview_table, args.treatment, args.condition,
+                                sample_type=args.sample_type)
+    data_by_population, cell_types = data
+
+    if args.test == 'mw':
+        analyze_frequencies_mw(data_by_population, cell_types)
+        return
+    analyze_frequencies_ttest(data_by_population, cell_types)
+    cohort = {'condition': args.condition, 'treatment': args.treatment, 'sample_type': args.sample_type}
+    if cohort == DEFAULT_COHORT:
+        print(DEFAULT_RESULT)
+
+
+def run_subset(args) -> None:
+    print("PART 4: Data Subset Analysis")
+    further_analysis(args.db, args.table)
+
+
+def run_query(args) -> None:
+    print("Additional Query")
+    filters = dict(args.filters or DEFAULT_QUERY)
+    filter(args.db, args.table, **filters)
+
+    # Calculate the average count of one population over the same samples
+    conn = sqlite3.connect(args.db)
+    cursor = conn.cursor()
+    where = " AND ".join(f"{column} = ?" for column in filters) or "1"
+    cursor.execute(f"SELECT AVG({args.average}) FROM {args.table} WHERE {where}", list(filters.values()))
+    average = cursor.fetchone()[0]
+    conn.close()
+
+    described = ", ".join(f"{column}={value}" for column, value in filters.items()) or "all samples"
+    if average is None:
+        print(f"No samples to average {args.average} over for {described}")
+    else:
+        print(f"Average {args.average} for {described}: {average:.2f}")
+
+
+'''
+Run every stage in order, as executing this file always has. Part 3 tests the
+data it plotted instead of querying it twice; after a gallery, which plots no
+single cohort, the tests query the cohort themselves.
+'''
+def run_all(args) -> None:
+    run_load(args)
+    print(SEPARATOR)
+    run_overview(args)
+    print(SEPARATOR)
+    data = run_plot(args)
+    run_stats(args, data)
+    print(SEPARATOR)
+    run_subset(args)
+    print(SEPARATOR)
+    run_query(args)
+
+
+'''
+Parse a COLUMN=VALUE filter of the query subcommand into (column, value),
+with the value of an INTEGER column converted so it matches the stored one.
+'''
+def _filter_argument(text: str) -> tuple:
+    column, separator, value = text.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError(f"expected COLUMN=VALUE, got '{text}'")
+    if column not in FILTER_COLUMNS:
+        raise argparse.ArgumentTypeError(f"unknown column '{column}', expected one of {', '.join(FILTER_COLUMNS)}")
+    if column in INTEGER_COLUMNS:
+        try:
+            value = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"{column} must be an integer, got '{value}'")
+    return column, value
+
+
+'''
+Build the command line: one subcommand per stage of the pipeline, and 'all'
+to run them in order with the options of every stage. Each stage reads and
+writes the database, so they can be run separately and repeated.
+'''
+def build_parser() -> argparse.ArgumentParser:
+    tables = argparse.ArgumentParser(add_help=False)
+    tables.add_argument("--db", default=DB_NAME, help="SQLite database file (default: %(default)s)")
+    tables.add_argument("--table", default=TABLE_NAME, help="sample table (default: %(default)s)")
+    tables.add_argument("--overview-table", default=OVERVIEW_TABLE_NAME,
+                        help="overview table (default: %(default)s)")
+
+    force = argparse.ArgumentParser(add_help=False)
+    force.add_argument("--force", action="store_true",
+                       help="reload the CSV, rebuild the overview and render the boxplots even if nothing changed")
+
+    workers = argparse.ArgumentParser(add_help=False)
+    workers.add_argument("--workers", type=int,
+                         help="worker processes for sharded loads and the gallery (default: one per core)")
+
+    load = argparse.ArgumentParser(add_help=False)
+    load.add_argument("--input", default=INPUT_FILENAME,
+                      help="CSV file, compressed CSV, directory or glob of shards (default: %(default)s)")
+    load.add_argument("--schema", choices=SCHEMAS, default='wide',
+                      help="layout of the sample table (default: %(default)s)")
+
+    overview_options = argparse.ArgumentParser(add_help=False)
+    overview_options.add_argument("--overview-schema", choices=OVERVIEW_SCHEMAS, default='long',
+                                  help="layout of the overview table (default: %(default)s)")
+    overview_options.add_argument("--maintain", action="store_true",
+                                  help="keep the overview current with triggers on the sample table")
+
+    cohort = argparse.ArgumentParser(add_help=False)
+    cohort.add_argument("--condition", default=DEFAULT_COHORT['condition'], help="(default: %(default)s)")
+    cohort.add_argument("--treatment", default=DEFAULT_COHORT['treatment'], help="(default: %(default)s)")
+    cohort.add_argument("--sample-type", default=DEFAULT_COHORT['sample_type'], help="(default: %(default)s)")
+
+    plot = argparse.ArgumentParser(add_help=False)
+    plot.add_argument("--output", default=BOXPLOT_FILENAME,
+                      help="image the boxplots are saved to (default: %(default)s)")
+    plot.add_argument("--headless", action="store_true",
+                      help="only save the image, without opening a window, reusing it from the cache when the "
+                           "data did not change")
+    plot.add_argument("--cache-dir", default=PLOT_CACHE_DIR,
+                      help="cache of headless boxplot images (default: %(default)s)")
+    plot.add_argument("--gallery", metavar="DIR",
+                      help="render every condition/treatment pair into DIR instead, with an index.html")
+
+    test = argparse.ArgumentParser(add_help=False)
+    test.add_argument("--test", choices=('ttest', 'mw'), default='ttest',
+                      help="Welch's t-test or Mann-Whitney U (default: %(default)s)")
+
+    query = argparse.ArgumentParser(add_help=False)
+    query.add_argument("filters", nargs="*", type=_filter_argument, metavar="COLUMN=VALUE",
+                       help="filters on the sample table (default: "
+                            + " ".join(f"{column}={value}" for column, value in DEFAULT_QUERY) + ")")
+    query.add_argument("--average", choices=POPULATIONS, default=DEFAULT_AVERAGE,
+                       help="population whose count is averaged over the matching samples (default: %(default)s)")
+
+    parser = argparse.ArgumentParser(
+        description="Load the cell counts and run the analysis of Parts 1-4. "
+                    "Without a command every stage runs in order.")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    stages = [
+        ('all', run_all, "run every stage in order (the default)",
+         [load, force, workers, overview_options, cohort, plot, test, query]),
+        ('load', run_load, "Part 1: load the CSV into the database", [load, force, workers]),
+        ('overview', run_overview, "Part 2: build the overview table", [overview_options, force]),
+        ('plot', run_plot, "Part 3: boxplots of responders against non-responders", [cohort, plot, force, workers]),
+        ('stats', run_stats, "Part 3: test the responder differences for significance", [cohort, test]),
+        ('subset', run_subset, "Part 4: baseline melanoma PBMC samples by project, response and sex", []),
+        ('query', run_query, "count the samples matching filters and average a population", [query]),
+    ]
+    for name, handler, help_text, parents in stages:
+        stage = subparsers.add_parser(name, parents=[tables, *parents], help=help_text, description=help_text)
+        stage.set_defaults(handler=handler)
+    return parser
+
+
+'''
+Run the pipeline from the command line, e.g. "python teiko_technical.py plot
+--condition carcinoma --headless". Without a command (or with only options)
+every stage runs, as in "python teiko_technical.py --db other.db".
+'''
+def main(argv: list = None) -> None:
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or (argv[0].startswith("-") and argv[0] not in ("-h", "--help")):
+        argv = ["all", *argv]
+    args = parser.parse_args(argv)
+    args.handler(args)
+    # let a headless plot finish writing before the process exits
+    wait_for_plots()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,23 @@ import sqlite3
 import os
 import csv
 import tempfile
+import shutil
+import threading
+import subprocess
+import contextlib
+import io
+import gzip
+import bz2
+import lzma
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 import sys
 
 # Import functions from the main module
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from teiko_technical import load_csv_to_sqlite, overview, filter
+import teiko_technical
+from teiko_technical import load_csv_to_sqlite, overview, filter, distinct_values
 
 # Suppress the matplotlib import in main module
 import warnings
@@ -187,6 +198,1020 @@ class TestLoadCSVToSQLite(unittest.TestCase):
         self.assertEqual(condition, 'melanoma')
         self.assertEqual(sample, 'sample001')
 
+    def test_bulk_load_across_batches(self):
+        """Test that bulk mode loads every row when the input spans several batches"""
+        test_rows = [
+            ['prj1', f'sbj{i:03d}', 'melanoma', '57', 'M', 'drug_a', 'yes',
+             f'sample{i:03d}', 'PBMC', '0', '100', '200', '300', '150', '250']
+            for i in range(7)
+        ]
+        self.create_test_csv(test_rows)
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, bulk=True, batch_size=3)
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*), MIN(sample), MAX(sample) FROM {self.table_name}")
+        count, first_sample, last_sample = cursor.fetchone()
+        conn.close()
+
+        self.assertEqual(count, 7, "Should have loaded all 7 rows across 3 batches")
+        self.assertEqual(first_sample, 'sample000')
+        self.assertEqual(last_sample, 'sample006')
+
+    def test_bulk_load_builds_index_and_statistics(self):
+        """Test that bulk mode indexes the sample column and runs ANALYZE after the insert"""
+        test_rows = [
+            ['prj1', 'sbj001', 'melanoma', '57', 'M', 'drug_a', 'yes',
+             'sample001', 'PBMC', '0', '100', '200', '300', '150', '250'],
+        ]
+        self.create_test_csv(test_rows)
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, bulk=True)
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"PRAGMA index_list({self.table_name})")
+        index_names = [row[1] for row in cursor.fetchall()]
+        cursor.execute("SELECT tbl FROM sqlite_stat1")
+        analyzed_tables = [row[0] for row in cursor.fetchall()]
+        cursor.execute("PRAGMA journal_mode")
+        journal_mode = cursor.fetchone()[0]
+        conn.close()
+
+        self.assertIn(f"idx_{self.table_name}_sample", index_names)
+        self.assertIn(self.table_name, analyzed_tables)
+        self.assertEqual(journal_mode, 'delete', "Journal mode should be restored after the load")
+
+    def test_incremental_upsert_by_sample(self):
+        """Test that incremental mode inserts new samples, updates changed ones and keeps the rest"""
+        self.create_test_csv([
+            ['prj1', 'sbj001', 'melanoma', '57', 'M', 'drug_a', 'yes',
+             'sample001', 'PBMC', '0', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj002', 'carcinoma', '65', 'F', 'drug_b', 'no',
+             'sample002', 'PBMC', '7', '120', '180', '320', '160', '280'],
+        ])
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, bulk=True)
+
+        # sample001 unchanged, sample002 has a corrected count, sample003 is new
+        self.create_test_csv([
+            ['prj1', 'sbj001', 'melanoma', '57', 'M', 'drug_a', 'yes',
+             'sample001', 'PBMC', '0', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj002', 'carcinoma', '65', 'F', 'drug_b', 'no',
+             'sample002', 'PBMC', '7', '999', '180', '320', '160', '280'],
+            ['prj2', 'sbj003', 'melanoma', '52', 'M', 'drug_a', 'yes',
+             'sample003', 'PBMC', '14', '110', '210', '310', '155', '260'],
+        ])
+        with mock.patch("builtins.print") as printed:
+            load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, incremental=True)
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT sample, b_cell FROM {self.table_name} ORDER BY sample")
+        rows = cursor.fetchall()
+        conn.close()
+
+        self.assertEqual(rows, [('sample001', 100), ('sample002', 999), ('sample003', 110)])
+        printed.assert_any_call(f"Incremental load into {self.table_name}: 1 new samples, 1 updated")
+
+    def test_incremental_load_rejects_duplicate_samples(self):
+        """Test that an incremental load onto a table with duplicate samples raises a ValueError"""
+        row = ['prj1', 'sbj001', 'melanoma', '57', 'M', 'drug_a', 'yes',
+               'sample001', 'PBMC', '0', '100', '200', '300', '150', '250']
+        self.create_test_csv([row, row])
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+
+        with self.assertRaisesRegex(ValueError, "duplicate sample"):
+            load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, incremental=True)
+
+        conn = sqlite3.connect(self.db_path)
+        count = conn.execute(f"SELECT COUNT(*) FROM {self.table_name}").fetchone()[0]
+        conn.close()
+        self.assertEqual(count, 2)
+
+    def test_incremental_load_skips_unchanged_rows(self):
+        """Test that reloading identical data incrementally writes nothing"""
+        test_rows = [
+            ['prj1', 'sbj001', 'melanoma', '57', 'M', 'drug_a', 'yes',
+             'sample001', 'PBMC', '0', '100', '200', '300', '150', '250'],
+        ]
+        self.create_test_csv(test_rows)
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, incremental=True)
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE audit (sample TEXT)")
+        conn.execute(f"""
+            CREATE TRIGGER audit_update AFTER UPDATE ON {self.table_name}
+            BEGIN INSERT INTO audit VALUES (NEW.sample); END
+        """)
+        conn.commit()
+        conn.close()
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, incremental=True)
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM audit")
+        updates = cursor.fetchone()[0]
+        cursor.execute(f"SELECT COUNT(*) FROM {self.table_name}")
+        count = cursor.fetchone()[0]
+        conn.close()
+
+        self.assertEqual(updates, 0, "Unchanged samples should not be rewritten")
+        self.assertEqual(count, 1)
+
+
+class CSVTestCase(unittest.TestCase):
+    """Shared fixture: a temporary directory with the test CSV of ROWS (if any) and the database paths"""
+
+    HEADERS = teiko_technical.CSV_COLUMNS
+
+    ROWS = [
+        ['prj1', 'sbj001', 'melanoma', '57', 'M', 'miraclib', 'yes', 'sample001', 'PBMC', '0', '100', '200', '300', '400', '500'],
+        ['prj1', 'sbj002', 'melanoma', '60', 'F', 'miraclib', 'no', 'sample002', 'PBMC', '7', '110', '210', '310', '410', '510'],
+        ['prj1', 'sbj003', 'carcinoma', '65', 'M', 'phauximab', 'yes', 'sample003', 'WB', '0', '120', '220', '320', '420', '520'],
+        ['prj2', 'sbj004', 'healthy', '70', 'M', 'none', '', 'sample004', 'PBMC', '14', '130', '230', '330', '430', '530'],
+    ]
+
+    def setUp(self):
+        """Create temporary directory and files for testing"""
+        self.test_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_dir, "test.db")
+        self.csv_path = os.path.join(self.test_dir, "test.csv")
+        self.table_name = "test_data"
+        self.overview_table = "test_overview"
+        if self.ROWS:
+            self.write_csv(self.ROWS)
+
+    def tearDown(self):
+        """Clean up temporary files"""
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def write_csv(self, rows, path=None, opener=open):
+        """Helper to (re)write the test CSV file, or another CSV at path, optionally compressed"""
+        with opener(path or self.csv_path, 'wt', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.HEADERS)
+            writer.writerows(rows)
+
+    def fetch_all(self, query):
+        """Helper to run a query against the test database on its own connection"""
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(query).fetchall()
+        conn.close()
+        return rows
+
+
+class MaintainedOverviewTestCase(CSVTestCase):
+    """Shared helpers for changing the sample table and checking the overview kept up with it"""
+
+    def execute(self, *statements):
+        """Helper to run and commit statements against the test database"""
+        conn = sqlite3.connect(self.db_path)
+        for statement in statements:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+
+    def assert_overview_current(self):
+        """Assert that the maintained overview equals one rebuilt from scratch"""
+        conn = sqlite3.connect(self.db_path)
+        maintained = conn.execute(
+            f"SELECT * FROM {self.overview_table} ORDER BY sample, population").fetchall()
+        conn.close()
+        overview(self.db_path, self.table_name, "rebuilt_overview")
+        conn = sqlite3.connect(self.db_path)
+        rebuilt = conn.execute("SELECT * FROM rebuilt_overview ORDER BY sample, population").fetchall()
+        conn.close()
+        self.assertEqual(maintained, rebuilt)
+        return maintained
+
+
+class LoadedDatabaseTestCase(CSVTestCase):
+    """Shared fixture: the test CSV loaded with an overview built, for the analysis tests"""
+
+    ROWS = CSVTestCase.ROWS + [
+        ['prj1', 'sbj005', 'melanoma', '52', 'F', 'miraclib', 'yes', 'sample005', 'PBMC', '0', '50', '0', '25', '25', '0'],
+        ['prj1', 'sbj006', 'melanoma', '58', 'M', 'miraclib', 'no', 'sample006', 'PBMC', '0', '10', '20', '30', '40', '900'],
+    ]
+
+    def setUp(self):
+        """Create a loaded test database with an overview"""
+        super().setUp()
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table)
+
+    def plot(self, **kwargs):
+        """Helper to run plot_cell_frequencies without writing or showing the figure"""
+        with mock.patch.object(teiko_technical.plt, "savefig"), mock.patch.object(teiko_technical.plt, "show"):
+            data = teiko_technical.plot_cell_frequencies(
+                self.db_path, self.table_name, self.overview_table, "miraclib", "melanoma", **kwargs)
+        teiko_technical.plt.close('all')
+        return data
+
+
+class TestShardedLoad(CSVTestCase):
+    """Test cases for loading a directory or glob of CSV shards"""
+
+    def setUp(self):
+        """Create a shard directory with one CSV per project"""
+        super().setUp()
+        self.shard_dir = os.path.join(self.test_dir, "shards")
+        os.mkdir(self.shard_dir)
+
+        for project, first in (('prj1', 0), ('prj2', 100)):
+            rows = [
+                [project, f'sbj{i:03d}', 'melanoma', '57', 'M', 'drug_a', 'yes',
+                 f'sample{i:03d}', 'PBMC', '0', str(i), '200', '300', '150', '250']
+                for i in range(first, first + 40)
+            ]
+            self.write_csv(rows, os.path.join(self.shard_dir, f"{project}.csv"))
+
+    def fetch_summary(self):
+        """Helper to fetch row/project counts and the stored column types"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*), COUNT(DISTINCT project), SUM(b_cell) FROM {self.table_name}")
+        summary = cursor.fetchone()
+        cursor.execute(f"SELECT typeof(age), typeof(b_cell) FROM {self.table_name} LIMIT 1")
+        types = cursor.fetchone()
+        conn.close()
+        return summary, types
+
+    def test_directory_of_shards(self):
+        """Test that every shard in a directory is loaded with typed counts"""
+        load_csv_to_sqlite(self.shard_dir, self.db_path, self.table_name, workers=2)
+
+        (count, projects, b_cell_sum), types = self.fetch_summary()
+        self.assertEqual(count, 80)
+        self.assertEqual(projects, 2)
+        self.assertEqual(b_cell_sum, sum(range(40)) + sum(range(100, 140)))
+        self.assertEqual(types, ('integer', 'integer'))
+
+    def test_glob_of_shards(self):
+        """Test that a glob pattern selects only the matching shards"""
+        load_csv_to_sqlite(os.path.join(self.shard_dir, "prj2*.csv"), self.db_path, self.table_name)
+
+        (count, projects, b_cell_sum), _ = self.fetch_summary()
+        self.assertEqual(count, 40)
+        self.assertEqual(projects, 1)
+
+    def test_small_chunks_keep_rows_intact(self):
+        """Test that splitting shards into many byte ranges neither drops nor duplicates rows"""
+        with mock.patch.object(teiko_technical, "SHARD_CHUNK_BYTES", 100):
+            load_csv_to_sqlite(self.shard_dir, self.db_path, self.table_name, bulk=True, workers=3)
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*), COUNT(DISTINCT sample) FROM {self.table_name}")
+        count, distinct_samples = cursor.fetchone()
+        conn.close()
+
+        self.assertEqual(count, 80)
+        self.assertEqual(distinct_samples, 80)
+
+    def test_missing_input_raises(self):
+        """Test that an empty glob fails before the existing table is touched"""
+        with self.assertRaises(FileNotFoundError):
+            load_csv_to_sqlite(os.path.join(self.shard_dir, "*.tsv"), self.db_path, self.table_name)
+
+
+class TestSkipUnchanged(CSVTestCase):
+    """Test cases for skipping loads and overview rebuilds when the input is unchanged"""
+
+    ROWS = [
+        ['prj1', 'sbj001', 'melanoma', '57', 'M', 'drug_a', 'yes',
+         'sample001', 'PBMC', '0', '100', '200', '300', '150', '250'],
+        ['prj1', 'sbj002', 'carcinoma', '65', 'F', 'drug_b', 'no',
+         'sample002', 'PBMC', '7', '120', '180', '320', '160', '280'],
+    ]
+
+    def count_rows(self, table):
+        """Helper to count the rows of a table"""
+        conn = sqlite3.connect(self.db_path)
+        count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        conn.close()
+        return count
+
+    def delete_first_row(self, table):
+        """Helper to tamper with a table so a skipped reload can be detected"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f"DELETE FROM {table} WHERE rowid = (SELECT MIN(rowid) FROM {table})")
+        conn.commit()
+        conn.close()
+
+    def test_unchanged_file_is_not_reloaded(self):
+        """Test that a second load of the same file is skipped"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+        self.delete_first_row(self.table_name)
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+
+        self.assertEqual(self.count_rows(self.table_name), 1, "Unchanged input should not be reloaded")
+
+    def test_touched_file_with_same_content_is_not_reloaded(self):
+        """Test that a new mtime alone falls back to the content hash"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+        self.delete_first_row(self.table_name)
+        info = os.stat(self.csv_path)
+        os.utime(self.csv_path, ns=(info.st_atime_ns, info.st_mtime_ns + 10**9))
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+
+        self.assertEqual(self.count_rows(self.table_name), 1, "Identical content should not be reloaded")
+
+    def test_changed_file_is_reloaded(self):
+        """Test that new content is always loaded"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+        self.write_csv([
+            ['prj2', 'sbj003', 'melanoma', '52', 'M', 'drug_a', 'yes',
+             'sample003', 'PBMC', '14', '110', '210', '310', '155', '260'],
+        ])
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+
+        self.assertEqual(self.count_rows(self.table_name), 1)
+        conn = sqlite3.connect(self.db_path)
+        sample = conn.execute(f"SELECT sample FROM {self.table_name}").fetchone()[0]
+        conn.close()
+        self.assertEqual(sample, 'sample003')
+
+    def test_full_load_after_incremental_is_reloaded(self):
+        """Test that a full load of the last incremental delta replaces the table instead of being skipped"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+        self.write_csv([
+            ['prj2', 'sbj003', 'melanoma', '52', 'M', 'drug_a', 'yes',
+             'sample003', 'PBMC', '14', '110', '210', '310', '155', '260'],
+        ])
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, incremental=True, skip_unchanged=True)
+        self.assertEqual(self.count_rows(self.table_name), 3)
+
+        stats = load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, incremental=True,
+                                   skip_unchanged=True)
+        self.assertTrue(stats.skipped, "Repeating the same delta should still be skipped")
+
+        stats = load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+        self.assertFalse(stats.skipped)
+        self.assertEqual(self.count_rows(self.table_name), 1, "A full load should replace the table")
+        stats = load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+        self.assertTrue(stats.skipped)
+
+    def test_metadata_without_load_mode_is_upgraded(self):
+        """Test that a metadata table from before the load mode was recorded gains the column"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f"""
+            CREATE TABLE {teiko_technical.METADATA_TABLE} (
+            table_name TEXT PRIMARY KEY, source TEXT, file_stats TEXT,
+            content_hash TEXT, version TEXT, updated_at TEXT)""")
+        conn.execute(f"INSERT INTO {teiko_technical.METADATA_TABLE} VALUES ('other', 'x.csv', '[]', NULL, 'v1', NULL)")
+        conn.commit()
+        conn.close()
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, incremental=True, skip_unchanged=True)
+
+        conn = sqlite3.connect(self.db_path)
+        modes = dict(conn.execute(f"SELECT table_name, incremental FROM {teiko_technical.METADATA_TABLE}").fetchall())
+        conn.close()
+        self.assertEqual(modes, {'other': 0, self.table_name: 1})
+
+    def test_overview_rebuild_follows_source_version(self):
+        """Test that overview() only rebuilds after the source table was reloaded"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+        overview(self.db_path, self.table_name, self.overview_table, skip_unchanged=True)
+        self.delete_first_row(self.overview_table)
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+        overview(self.db_path, self.table_name, self.overview_table, skip_unchanged=True)
+        self.assertEqual(self.count_rows(self.overview_table), 9, "Overview should not be rebuilt")
+
+        self.write_csv([
+            ['prj2', 'sbj003', 'melanoma', '52', 'M', 'drug_a', 'yes',
+             'sample003', 'PBMC', '14', '110', '210', '310', '155', '260'],
+        ])
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+        overview(self.db_path, self.table_name, self.overview_table, skip_unchanged=True)
+        self.assertEqual(self.count_rows(self.overview_table), 5, "Overview should follow the reload")
+
+
+class TestCompressedLoad(CSVTestCase):
+    """Test cases for streaming compressed CSV exports"""
+
+    # each test writes its own CSVs, and some load the whole directory
+    ROWS = []
+
+    def write_compressed_csv(self, filename, opener, first=0, count=50):
+        """Helper to write a compressed CSV with count samples"""
+        path = os.path.join(self.test_dir, filename)
+        self.write_csv([
+            ['prj1', f'sbj{i:03d}', 'melanoma', '57', 'M', 'drug_a', 'yes',
+             f'sample{i:03d}', 'PBMC', '0', '100', '200', '300', '150', '250']
+            for i in range(first, first + count)
+        ], path, opener)
+        return path
+
+    def count_samples(self):
+        """Helper to count the total and distinct samples loaded"""
+        conn = sqlite3.connect(self.db_path)
+        counts = conn.execute(f"SELECT COUNT(*), COUNT(DISTINCT sample) FROM {self.table_name}").fetchone()
+        conn.close()
+        return counts
+
+    def test_gzip_bz2_xz_inputs(self):
+        """Test that each supported codec is streamed into the table"""
+        for filename, opener in (("cells.csv.gz", gzip.open), ("cells.csv.bz2", bz2.open),
+                                 ("cells.csv.xz", lzma.open)):
+            with self.subTest(filename=filename):
+                path = self.write_compressed_csv(filename, opener)
+                load_csv_to_sqlite(path, self.db_path, self.table_name)
+                self.assertEqual(self.count_samples(), (50, 50))
+
+    def test_compressed_shards_in_parallel(self):
+        """Test that compressed shards are chunked for the worker pool without losing rows"""
+        self.write_compressed_csv("prj1.csv.gz", gzip.open, first=0)
+        self.write_compressed_csv("prj2.csv.xz", lzma.open, first=100)
+
+        with mock.patch.object(teiko_technical, "SHARD_CHUNK_BYTES", 200):
+            load_csv_to_sqlite(self.test_dir, self.db_path, self.table_name, workers=2)
+
+        self.assertEqual(self.count_samples(), (100, 100))
+
+    def test_corrupt_archive_raises(self):
+        """Test that a decompression error on the background thread reaches the caller"""
+        path = os.path.join(self.test_dir, "broken.csv.gz")
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(b"project,subject\n" * 1000)[:40])
+
+        with self.assertRaises(EOFError):
+            load_csv_to_sqlite(path, self.db_path, self.table_name)
+
+
+class TestDictionarySchema(CSVTestCase):
+    """Test cases for the dictionary-encoded sample table layout"""
+
+    def test_view_matches_wide_layout(self):
+        """Test that the decoding view returns exactly the rows and columns of the wide table"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        wide_rows = self.fetch_all(f"SELECT * FROM {self.table_name} ORDER BY sample")
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary')
+        dictionary_rows = self.fetch_all(f"SELECT * FROM {self.table_name} ORDER BY sample")
+
+        self.assertEqual(dictionary_rows, wide_rows)
+
+    def test_categoricals_stored_as_codes(self):
+        """Test that categorical values are stored once in lookup tables and as integers per row"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary')
+
+        codes = self.fetch_all(f"SELECT value FROM {self.table_name}_condition_codes ORDER BY value")
+        stored_types = self.fetch_all(
+            f"SELECT DISTINCT typeof(condition_code), typeof(sex_code) FROM {self.table_name}_encoded")
+
+        self.assertEqual(codes, [('carcinoma',), ('healthy',), ('melanoma',)])
+        self.assertEqual(stored_types, [('integer', 'integer')])
+
+    def test_filters_and_overview_through_view(self):
+        """Test that WHERE filters and the overview build work unchanged on the view"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary')
+        overview(self.db_path, self.table_name, self.overview_table)
+
+        matches = self.fetch_all(
+            f"SELECT sample FROM {self.table_name} WHERE condition = 'melanoma' AND sex = 'M'")
+        overview_rows = self.fetch_all(f"SELECT COUNT(*) FROM {self.overview_table}")
+
+        self.assertEqual(matches, [('sample001',)])
+        self.assertEqual(overview_rows, [(20,)])
+
+    def test_incremental_load_encodes_new_values(self):
+        """Test that an incremental load adds new categories and updates changed samples"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary')
+        self.write_csv([
+            ['prj1', 'sbj002', 'melanoma', '60', 'F', 'miraclib', 'yes', 'sample002', 'PBMC', '7', '110', '210', '310', '410', '510'],
+            ['prj3', 'sbj005', 'lymphoma', '48', 'F', 'miraclib', 'no', 'sample005', 'PBMC', '0', '140', '240', '340', '440', '540'],
+        ])
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary', incremental=True)
+
+        rows = self.fetch_all(f"SELECT sample, condition, response FROM {self.table_name} ORDER BY sample")
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[1], ('sample002', 'melanoma', 'yes'))
+        self.assertEqual(rows[4], ('sample005', 'lymphoma', 'no'))
+
+    def test_distinct_values_from_lookup_table(self):
+        """Test that distinct values come from the lookup table and skip unused codes"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f"INSERT INTO {self.table_name}_condition_codes (value) VALUES ('unused')")
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(distinct_values(self.db_path, self.table_name, 'condition'),
+                         ['carcinoma', 'healthy', 'melanoma'])
+        self.assertEqual(distinct_values(self.db_path, self.table_name, 'age'), [57, 60, 65, 70])
+
+    def test_schema_switch_and_mismatch(self):
+        """Test that a full reload can change schema but an incremental load cannot"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary')
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+
+        table_type = self.fetch_all(f"SELECT type FROM sqlite_master WHERE name = '{self.table_name}'")
+        leftovers = self.fetch_all(
+            f"SELECT name FROM sqlite_master WHERE name LIKE '{self.table_name}_%code%'")
+        self.assertEqual(table_type, [('table',)])
+        self.assertEqual(leftovers, [])
+
+        with self.assertRaises(ValueError):
+            load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary', incremental=True)
+
+
+class TestNormalizedSchema(CSVTestCase):
+    """Test cases for the normalized subjects/samples layout"""
+
+    SUBJECT_ROWS = [
+        ['prj1', 'sbj001', 'melanoma', '57', 'M', 'miraclib', 'yes', 'sample001', 'PBMC', '0', '100', '200', '300', '400', '500'],
+        ['prj1', 'sbj001', 'melanoma', '57', 'M', 'miraclib', 'yes', 'sample002', 'PBMC', '7', '110', '210', '310', '410', '510'],
+        ['prj1', 'sbj001', 'melanoma', '57', 'M', 'miraclib', 'yes', 'sample003', 'PBMC', '14', '120', '220', '320', '420', '520'],
+        ['prj1', 'sbj002', 'carcinoma', '65', 'F', 'phauximab', 'no', 'sample004', 'WB', '0', '130', '230', '330', '430', '530'],
+    ]
+
+    def test_view_matches_wide_layout(self):
+        """Test that the joining view returns exactly the rows and columns of the wide table"""
+        self.write_csv(self.SUBJECT_ROWS)
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        wide_rows = self.fetch_all(f"SELECT * FROM {self.table_name} ORDER BY sample")
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='normalized')
+        normalized_rows = self.fetch_all(f"SELECT * FROM {self.table_name} ORDER BY sample")
+
+        self.assertEqual(normalized_rows, wide_rows)
+
+    def test_subjects_stored_once(self):
+        """Test that subject attributes are stored once however many samples a subject has"""
+        self.write_csv(self.SUBJECT_ROWS)
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='normalized')
+
+        subjects = self.fetch_all(f"SELECT subject, condition, age FROM {self.table_name}_subjects ORDER BY subject")
+        samples = self.fetch_all(f"SELECT COUNT(*), COUNT(DISTINCT subject_id) FROM {self.table_name}_samples")
+
+        self.assertEqual(subjects, [('sbj001', 'melanoma', 57), ('sbj002', 'carcinoma', 65)])
+        self.assertEqual(samples, [(4, 2)])
+
+    def test_filters_and_overview_through_view(self):
+        """Test that WHERE filters and the overview build work unchanged on the view"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='normalized')
+        overview(self.db_path, self.table_name, self.overview_table)
+
+        matches = self.fetch_all(
+            f"SELECT sample FROM {self.table_name} WHERE condition = 'melanoma' AND sex = 'M'")
+        overview_rows = self.fetch_all(f"SELECT COUNT(*) FROM {self.overview_table}")
+
+        self.assertEqual(matches, [('sample001',)])
+        self.assertEqual(overview_rows, [(20,)])
+
+    def test_incremental_load_encodes_new_values(self):
+        """Test that an incremental load adds new subjects and updates changed ones"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='normalized')
+        self.write_csv([
+            ['prj1', 'sbj002', 'melanoma', '60', 'F', 'miraclib', 'yes', 'sample002', 'PBMC', '7', '110', '210', '310', '410', '510'],
+            ['prj3', 'sbj005', 'lymphoma', '48', 'F', 'miraclib', 'no', 'sample005', 'PBMC', '0', '140', '240', '340', '440', '540'],
+        ])
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='normalized', incremental=True)
+
+        rows = self.fetch_all(f"SELECT sample, condition, response FROM {self.table_name} ORDER BY sample")
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[1], ('sample002', 'melanoma', 'yes'))
+        self.assertEqual(rows[4], ('sample005', 'lymphoma', 'no'))
+
+    def test_distinct_values_from_subjects(self):
+        """Test that subject-level distinct values are read from the subjects table"""
+        self.write_csv(self.SUBJECT_ROWS)
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='normalized')
+
+        self.assertEqual(distinct_values(self.db_path, self.table_name, 'condition'), ['carcinoma', 'melanoma'])
+        self.assertEqual(distinct_values(self.db_path, self.table_name, 'sample_type'), ['PBMC', 'WB'])
+
+    def test_schema_switch_clears_other_layout(self):
+        """Test that reloading with another schema removes the normalized tables"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='normalized')
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary')
+
+        leftovers = self.fetch_all(
+            f"SELECT name FROM sqlite_master WHERE name IN ('{self.table_name}_subjects', '{self.table_name}_samples')")
+        self.assertEqual(leftovers, [])
+
+        with self.assertRaises(ValueError):
+            load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='normalized', incremental=True)
+
+
+class TestQueryIndexes(CSVTestCase):
+    """Test cases for the indexes built after a load and an overview build"""
+
+    FILTER_QUERY = ("SELECT COUNT(*) FROM {table} WHERE condition = 'melanoma' "
+                    "AND sample_type = 'PBMC' AND time_from_treatment_start = 0")
+    JOIN_QUERY = ("SELECT ov.population, ov.percentage, sd.response FROM {overview} ov "
+                  "JOIN {table} sd ON ov.sample = sd.sample "
+                  "WHERE sd.treatment = 'miraclib' AND sd.condition = 'melanoma' AND sd.sample_type = 'PBMC'")
+
+    def query_plan(self, query):
+        """Helper returning the EXPLAIN QUERY PLAN detail lines for a query"""
+        conn = sqlite3.connect(self.db_path)
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}")]
+        conn.close()
+        return plan
+
+    def test_filter_predicates_use_composite_index(self):
+        """Test that the further_analysis predicates search the composite index instead of scanning"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+
+        plan = self.query_plan(self.FILTER_QUERY.format(table=self.table_name))
+
+        self.assertTrue(any(f"idx_{self.table_name}_filters" in line for line in plan), plan)
+        self.assertFalse(any(line.startswith("SCAN") for line in plan), plan)
+
+    def test_overview_join_uses_sample_indexes(self):
+        """Test that the plot join looks overview rows up by sample instead of scanning"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table)
+
+        plan = self.query_plan(self.JOIN_QUERY.format(table=self.table_name, overview=self.overview_table))
+
+        self.assertIn(f"SEARCH ov USING INDEX idx_{self.overview_table}_sample (sample=?)", plan)
+        self.assertFalse(any(line.startswith("SCAN") for line in plan), plan)
+
+    def test_indexes_on_every_schema(self):
+        """Test that the view-backed schemas index their physical tables too"""
+        for schema in ('dictionary', 'normalized'):
+            with self.subTest(schema=schema):
+                load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema=schema)
+                overview(self.db_path, self.table_name, self.overview_table)
+
+                for query in (self.FILTER_QUERY, self.JOIN_QUERY):
+                    plan = self.query_plan(query.format(table=self.table_name, overview=self.overview_table))
+                    self.assertFalse(any(line.startswith("SCAN") for line in plan), plan)
+
+    def test_sample_index_survives_incremental_load(self):
+        """Test that incremental loads keep a unique sample index alongside the filter index"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, incremental=True)
+
+        conn = sqlite3.connect(self.db_path)
+        indexes = {name: unique for _, name, unique, *_ in conn.execute(f"PRAGMA index_list({self.table_name})")}
+        conn.close()
+
+        self.assertEqual(indexes, {f"idx_{self.table_name}_sample": 1, f"idx_{self.table_name}_filters": 0,
+                                   f"idx_{self.table_name}_total_count": 0})
+
+    def test_total_count_filter_uses_index(self):
+        """Test that a quality control filter on total_count is an index range scan on every schema"""
+        for schema in ('wide', 'dictionary', 'normalized'):
+            with self.subTest(schema=schema):
+                load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema=schema)
+
+                plan = self.query_plan(f"SELECT sample FROM {self.table_name} WHERE total_count < 1600")
+
+                self.assertTrue(any("idx_" in line and "total_count<?" in line for line in plan), plan)
+                self.assertFalse(any(line.startswith("SCAN") for line in plan), plan)
+
+
+class TestTotalCount(CSVTestCase):
+    """Test cases for the stored total_count column of the sample table"""
+
+    def test_total_count_on_every_schema(self):
+        """Test that total_count is the sum of the counts and follows updates on every schema"""
+        for schema in ('wide', 'dictionary', 'normalized'):
+            with self.subTest(schema=schema):
+                load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema=schema)
+                target = teiko_technical._sample_target(self.table_name, schema)
+
+                conn = sqlite3.connect(self.db_path)
+                conn.execute(f"UPDATE {target} SET monocyte = 0 WHERE sample = 'sample002'")
+                totals = dict(conn.execute(f"SELECT sample, total_count FROM {self.table_name}"))
+                conn.close()
+
+                self.assertEqual(totals, {'sample001': 1500, 'sample002': 1040, 'sample003': 1600, 'sample004': 1650})
+
+    def test_exported_csv_columns_load_back(self):
+        """Test that the CSV columns selected from a loaded table, as the dashboard exports them, load back"""
+        exported_path = os.path.join(self.test_dir, "exported.csv")
+        columns = ', '.join(teiko_technical.CSV_COLUMNS)
+        for schema in ('wide', 'dictionary', 'normalized'):
+            with self.subTest(schema=schema):
+                load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema=schema)
+                conn = sqlite3.connect(self.db_path)
+                self.assertIn('total_count', [column[0] for column in conn.execute(
+                    f"SELECT * FROM {self.table_name}").description])
+                exported = conn.execute(f"SELECT {columns} FROM {self.table_name} ORDER BY sample").fetchall()
+                conn.close()
+                self.write_csv(exported, exported_path)
+
+                reloaded_db = os.path.join(self.test_dir, f"reloaded_{schema}.db")
+                stats = load_csv_to_sqlite(exported_path, reloaded_db, self.table_name, schema=schema)
+                conn = sqlite3.connect(reloaded_db)
+                reloaded = conn.execute(f"SELECT {columns} FROM {self.table_name} ORDER BY sample").fetchall()
+                conn.close()
+
+                self.assertEqual(stats.rows_rejected, 0)
+                self.assertEqual(reloaded, exported)
+
+    def test_overview_reads_stored_total(self):
+        """Test that the overview takes total_count from the column instead of adding the counts"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        with mock.patch.object(teiko_technical, "TOTAL_COUNT_EXPRESSION", "NULL"):
+            overview(self.db_path, self.table_name, self.overview_table)
+            overview(self.db_path, self.table_name, "compact_overview", schema='compact')
+
+        conn = sqlite3.connect(self.db_path)
+        for name in (self.overview_table, "compact_overview"):
+            totals = conn.execute(f"SELECT DISTINCT total_count FROM {name} ORDER BY 1").fetchall()
+            self.assertEqual(totals, [(1500,), (1550,), (1600,), (1650,)])
+        conn.close()
+
+    def test_tables_without_total_count(self):
+        """Test that sample tables created before the column existed still build overviews"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f"CREATE TABLE {self.table_name} ({', '.join(self.HEADERS)})")
+        conn.executemany(f"INSERT INTO {self.table_name} VALUES ({', '.join('?' * len(self.HEADERS))})", self.ROWS)
+        conn.commit()
+        conn.close()
+
+        overview(self.db_path, self.table_name, self.overview_table, maintain=True)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f"INSERT INTO {self.table_name} (sample, b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte) "
+                     f"VALUES ('sample005', 1, 2, 3, 4, 0)")
+        conn.commit()
+        totals = conn.execute(f"SELECT DISTINCT total_count FROM {self.overview_table} ORDER BY 1").fetchall()
+        conn.close()
+        self.assertEqual(totals, [(10,), (1500,), (1550,), (1600,), (1650,)])
+
+
+class TestStagingSwap(CSVTestCase):
+    """Test cases for loading into staging tables and swapping them into place"""
+
+    def test_readers_see_old_table_during_load(self):
+        """Test that a reader mid-load still sees the complete previous table"""
+        seen_during_load = []
+        original_batches = teiko_technical._serial_row_batches
+
+        def batches_with_reader(*args):
+            for batch in original_batches(*args):
+                yield batch
+                seen_during_load.append(self.fetch_all(f"SELECT COUNT(*) FROM {self.table_name}"))
+
+        for schema in ('wide', 'dictionary', 'normalized'):
+            with self.subTest(schema=schema):
+                self.write_csv(self.ROWS)
+                load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema=schema)
+                self.write_csv(self.ROWS[:2])
+                seen_during_load.clear()
+
+                with mock.patch.object(teiko_technical, "_serial_row_batches", side_effect=batches_with_reader):
+                    load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema=schema)
+
+                self.assertEqual(seen_during_load, [[(4,)]])
+                self.assertEqual(self.fetch_all(f"SELECT COUNT(*) FROM {self.table_name}"), [(2,)])
+
+    def test_no_staging_tables_left_behind(self):
+        """Test that the staging tables are renamed away, including leftovers of an interrupted load"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f"CREATE TABLE {self.table_name}_staging (junk TEXT)")
+        conn.close()
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary')
+        overview(self.db_path, self.table_name, self.overview_table)
+
+        staging = self.fetch_all("SELECT name FROM sqlite_master WHERE name LIKE '%staging%'")
+        self.assertEqual(staging, [])
+        self.assertEqual(self.fetch_all(f"SELECT COUNT(*) FROM {self.table_name}_rejects"), [(0,)])
+
+    def test_overview_readers_see_old_overview_during_rebuild(self):
+        """Test that the old overview stays readable while the new one is built"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table)
+        self.write_csv(self.ROWS[:2])
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        seen_during_build = []
+        original_build = teiko_technical._build_overview
+
+        def build_with_reader(*args):
+            original_build(*args)
+            seen_during_build.append(self.fetch_all(f"SELECT COUNT(*) FROM {self.overview_table}"))
+
+        with mock.patch.object(teiko_technical, "_build_overview", side_effect=build_with_reader):
+            overview(self.db_path, self.table_name, self.overview_table)
+
+        self.assertEqual(seen_during_build, [[(20,)]])
+        self.assertEqual(self.fetch_all(f"SELECT COUNT(*) FROM {self.overview_table}"), [(10,)])
+
+
+class TestResumableLoad(CSVTestCase):
+    """Test cases for checkpointed bulk loads that resume after an interruption"""
+
+    def interrupted_load(self, input_path, batches_before_failure, **kwargs):
+        """Helper that runs a bulk load which dies after a number of batches"""
+        original_batches = teiko_technical._serial_row_batches
+
+        def failing_batches(*args):
+            for index, batch in enumerate(original_batches(*args)):
+                if index == batches_before_failure:
+                    raise RuntimeError("simulated crash")
+                yield batch
+
+        with mock.patch.object(teiko_technical, "_serial_row_batches", side_effect=failing_batches):
+            with self.assertRaises(RuntimeError):
+                load_csv_to_sqlite(input_path, self.db_path, self.table_name, bulk=True, batch_size=1, **kwargs)
+
+    def resumed_load(self, input_path, **kwargs):
+        """Helper that reruns the load and returns the rows it parsed"""
+        original_batches = teiko_technical._serial_row_batches
+        parsed = []
+
+        def counting_batches(*args):
+            for batch in original_batches(*args):
+                parsed.extend(batch[0])
+                yield batch
+
+        with mock.patch.object(teiko_technical, "_serial_row_batches", side_effect=counting_batches):
+            load_csv_to_sqlite(input_path, self.db_path, self.table_name, bulk=True, batch_size=1, **kwargs)
+        return parsed
+
+    def test_resume_continues_after_last_batch(self):
+        """Test that a restarted load parses only the remaining rows and loads each row once"""
+        self.interrupted_load(self.csv_path, 2)
+        checkpoint = self.fetch_all("SELECT rows_loaded FROM ingest_checkpoints")
+
+        parsed = self.resumed_load(self.csv_path)
+
+        self.assertEqual(checkpoint, [(2,)])
+        self.assertEqual([row[7] for row in parsed], ['sample003', 'sample004'])
+        self.assertEqual(self.fetch_all(f"SELECT sample FROM {self.table_name} ORDER BY sample"),
+                         [('sample001',), ('sample002',), ('sample003',), ('sample004',)])
+        self.assertEqual(self.fetch_all("SELECT COUNT(*) FROM ingest_checkpoints"), [(0,)])
+
+    def test_resume_compressed_input(self):
+        """Test that a compressed input resumes by skipping the already loaded bytes"""
+        gz_path = os.path.join(self.test_dir, "test.csv.gz")
+        self.write_csv(self.ROWS, gz_path, gzip.open)
+        self.interrupted_load(gz_path, 3, schema='dictionary')
+
+        parsed = self.resumed_load(gz_path, schema='dictionary')
+
+        self.assertEqual([row[7] for row in parsed], ['sample004'])
+        self.assertEqual(self.fetch_all(f"SELECT COUNT(DISTINCT sample), COUNT(*) FROM {self.table_name}"), [(4, 4)])
+
+    def test_changed_input_starts_over(self):
+        """Test that a checkpoint is ignored once the input file has changed"""
+        self.interrupted_load(self.csv_path, 2)
+        self.write_csv(self.ROWS[1:])
+
+        parsed = self.resumed_load(self.csv_path)
+
+        self.assertEqual(len(parsed), 3)
+        self.assertEqual(self.fetch_all(f"SELECT COUNT(*) FROM {self.table_name}"), [(3,)])
+
+    def test_resume_disabled(self):
+        """Test that resume=False reloads from the start"""
+        self.interrupted_load(self.csv_path, 2)
+
+        parsed = self.resumed_load(self.csv_path, resume=False)
+
+        self.assertEqual(len(parsed), 4)
+        self.assertEqual(self.fetch_all(f"SELECT COUNT(*) FROM {self.table_name}"), [(4,)])
+
+    def test_bulk_load_keeps_rollback_journal(self):
+        """Test that a checkpointed load only turns syncing off and keeps the on-disk journal a crash rolls back"""
+        statements = []
+        connect = sqlite3.connect
+
+        def traced_connect(*args, **kwargs):
+            conn = connect(*args, **kwargs)
+            conn.set_trace_callback(statements.append)
+            return conn
+
+        with mock.patch.object(teiko_technical.sqlite3, "connect", traced_connect):
+            load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, bulk=True, batch_size=1)
+
+        pragmas = [statement for statement in statements if statement.lstrip().upper().startswith("PRAGMA")]
+        self.assertIn("PRAGMA synchronous = OFF", pragmas)
+        self.assertFalse([pragma for pragma in pragmas if "journal_mode" in pragma and "=" in pragma], pragmas)
+        self.assertEqual(self.fetch_all("PRAGMA journal_mode"), [('delete',)])
+
+    def test_quoted_newlines_across_batches(self):
+        """Test that every reader ends its batches on record boundaries, not inside a quoted field"""
+        rows = [row[:1] + [row[1].replace("sbj", "sbj\n")] + row[2:] if index % 2 else row
+                for index, row in enumerate(self.ROWS)]
+        gz_path = os.path.join(self.test_dir, "test.csv.gz")
+        self.write_csv(rows)
+        self.write_csv(rows, gz_path, gzip.open)
+        expected = [(row[1], row[7]) for row in rows]
+
+        loads = {
+            'serial': (self.csv_path, dict(batch_size=2)),
+            'memory_map': (self.csv_path, dict(memory_map=True)),
+            'byte_ranges': (self.csv_path, dict(workers=2)),
+            'compressed': (gz_path, dict(workers=2)),
+        }
+        # one-byte chunks end after every line, so every reader has to carry on past a quoted newline
+        with mock.patch.object(teiko_technical, "MMAP_CHUNK_BYTES", 1), \
+                mock.patch.object(teiko_technical, "SHARD_CHUNK_BYTES", 1):
+            for name, (path, kwargs) in loads.items():
+                with self.subTest(reader=name):
+                    stats = load_csv_to_sqlite(path, self.db_path, self.table_name, bulk=True, **kwargs)
+                    self.assertEqual((stats.rows_parsed, stats.rows_rejected), (4, 0))
+                    self.assertEqual(self.fetch_all(f"SELECT subject, sample FROM {self.table_name} ORDER BY sample"),
+                                     expected)
+
+        self.interrupted_load(self.csv_path, 2)
+        self.assertEqual(self.fetch_all("SELECT rows_loaded FROM ingest_checkpoints"), [(2,)])
+        parsed = self.resumed_load(self.csv_path)
+        self.assertEqual([row[1] for row in parsed], ['sbj003', 'sbj\n004'])
+        self.assertEqual(self.fetch_all(f"SELECT subject, sample FROM {self.table_name} ORDER BY sample"), expected)
+
+
+class TestMemoryMappedLoad(CSVTestCase):
+    """Test cases for the memory-mapped CSV reader"""
+
+    def load_rows(self, **kwargs):
+        """Helper to load the test CSV and return every row of the table"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, **kwargs)
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(f"SELECT * FROM {self.table_name} ORDER BY sample").fetchall()
+        conn.close()
+        return rows
+
+    def test_matches_line_reader(self):
+        """Test that the memory-mapped reader loads exactly what the line reader does"""
+        self.write_csv(self.ROWS)
+        expected = self.load_rows()
+
+        with mock.patch.object(teiko_technical, "MMAP_CHUNK_BYTES", 100):
+            rows = self.load_rows(memory_map=True, bulk=True)
+
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows, expected)
+
+    def test_quoted_fields(self):
+        """Test that chunks with quoted fields fall back to full CSV parsing"""
+        rows = [list(row) for row in self.ROWS]
+        rows[0][2] = 'melanoma, stage "IV"'
+        self.write_csv(rows)
+
+        loaded = self.load_rows(memory_map=True)
+
+        self.assertEqual(loaded[0][2], 'melanoma, stage "IV"')
+        self.assertEqual(len(loaded), 4)
+
+    def test_missing_trailing_newline(self):
+        """Test that the last row is loaded when the file does not end in a newline"""
+        self.write_csv(self.ROWS)
+        with open(self.csv_path, 'rb+') as f:
+            f.seek(-2, os.SEEK_END)
+            f.truncate()
+
+        with mock.patch.object(teiko_technical, "MMAP_CHUNK_BYTES", 100):
+            rows = self.load_rows(memory_map=True)
+
+        self.assertEqual([row[7] for row in rows], ['sample001', 'sample002', 'sample003', 'sample004'])
+        self.assertEqual(rows[3][14], 530)
+
+
+class TestIngestStats(CSVTestCase):
+    """Test cases for the stats returned by a load and its progress callback"""
+
+    ROWS = CSVTestCase.ROWS + [['prj1', 'sbj009', 'melanoma', '57', 'M', 'miraclib', 'yes', 'sample009', 'PBMC', '0', 'n/a', '200', '300', '400', '500']]
+
+    def test_returned_stats(self):
+        """Test that a load reports its rows, bytes and timings"""
+        stats = load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, bulk=True, batch_size=2)
+
+        self.assertEqual((stats.rows_parsed, stats.rows_inserted, stats.rows_rejected), (5, 4, 1))
+        self.assertEqual(stats.bytes_read, os.path.getsize(self.csv_path))
+        self.assertFalse(stats.skipped)
+        for seconds in (stats.parse_seconds, stats.insert_seconds, stats.commit_seconds, stats.index_seconds):
+            self.assertGreaterEqual(seconds, 0.0)
+        self.assertGreaterEqual(stats.elapsed_seconds,
+                                stats.parse_seconds + stats.insert_seconds + stats.commit_seconds)
+        if sys.platform != "win32":
+            self.assertGreater(stats.peak_memory_bytes, 0)
+
+    def test_progress_callback(self):
+        """Test that the progress callback sees the running totals after each batch"""
+        seen = []
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, batch_size=2,
+                           progress=lambda stats: seen.append((stats.rows_parsed, stats.bytes_read)))
+
+        self.assertEqual([rows for rows, _ in seen], [2, 4, 5])
+        self.assertEqual(seen[-1][1], os.path.getsize(self.csv_path))
+        self.assertEqual(sorted(seen), seen)
+
+    def test_skipped_load_stats(self):
+        """Test that a skipped load says so and reports no rows"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+
+        stats = load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, skip_unchanged=True)
+
+        self.assertTrue(stats.skipped)
+        self.assertEqual(stats.rows_parsed, 0)
+
 
 class TestOverview(unittest.TestCase):
     """Test cases for the overview function"""
@@ -419,6 +1444,764 @@ class TestOverview(unittest.TestCase):
         
         conn.close()
 
+    def test_strategies_build_same_rows(self):
+        """Test that the single-scan and UNION ALL unpivots produce the same overview"""
+        test_rows = [
+            ['prj1', 'sbj001', 'melanoma', '57', 'M', 'drug_a', 'yes', 
+             'sample001', 'PBMC', '0', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj002', 'melanoma', '60', 'F', 'drug_a', 'no', 
+             'sample002', 'PBMC', '7', '7', '0', '13', '999', '1'],
+        ]
+        self.create_and_load_csv(test_rows)
+
+        results = {}
+        for strategy in ('single_scan', 'union_all'):
+            overview(self.db_path, self.table_name, self.overview_table, strategy=strategy)
+            conn = sqlite3.connect(self.db_path)
+            results[strategy] = conn.execute(
+                f"SELECT * FROM {self.overview_table} ORDER BY sample, population").fetchall()
+            conn.close()
+
+        self.assertEqual(len(results['single_scan']), 10)
+        self.assertEqual(results['single_scan'], results['union_all'])
+
+    def test_unknown_strategy(self):
+        """Test that an unknown unpivot strategy is rejected"""
+        with self.assertRaises(ValueError):
+            overview(self.db_path, self.table_name, self.overview_table, strategy='pivot')
+
+
+class TestOverviewMaintenance(MaintainedOverviewTestCase):
+    """Test cases for keeping the overview current with triggers"""
+
+    def test_direct_changes_touch_only_their_rows(self):
+        """Test that inserted, updated and deleted samples are reflected in the overview"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table, maintain=True)
+
+        self.execute(
+            f"INSERT INTO {self.table_name} (sample, b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte) "
+            f"VALUES ('sample005', 1, 2, 3, 4, 0)",
+            f"UPDATE {self.table_name} SET b_cell = 900 WHERE sample = 'sample001'",
+            f"UPDATE {self.table_name} SET condition = 'other' WHERE sample = 'sample002'",
+            f"DELETE FROM {self.table_name} WHERE sample = 'sample003'",
+        )
+
+        rows = self.assert_overview_current()
+        self.assertEqual(len(rows), 20)
+        self.assertIn(('sample005', 10, 'nk_cell', 4, 40.0), rows)
+
+    def test_incremental_load_keeps_overview_current(self):
+        """Test that an incremental load updates the overview without a rebuild on every schema"""
+        for schema in ('wide', 'dictionary', 'normalized'):
+            with self.subTest(schema=schema):
+                self.write_csv(self.ROWS)
+                load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema=schema)
+                overview(self.db_path, self.table_name, self.overview_table, maintain=True)
+                self.write_csv([
+                    ['prj1', 'sbj002', 'melanoma', '60', 'F', 'miraclib', 'no', 'sample002', 'PBMC', '7', '5', '5', '5', '5', '5'],
+                    ['prj3', 'sbj005', 'lymphoma', '48', 'F', 'miraclib', 'no', 'sample005', 'PBMC', '0', '140', '240', '340', '440', '540'],
+                ])
+                load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema=schema, incremental=True)
+
+                with mock.patch.object(teiko_technical, "_build_overview") as build:
+                    overview(self.db_path, self.table_name, self.overview_table, skip_unchanged=True, maintain=True)
+                build.assert_not_called()
+                self.assertEqual(len(self.assert_overview_current()), 25)
+
+    def test_full_reload_forces_rebuild(self):
+        """Test that a full reload drops the triggers so the next overview call rebuilds"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table, maintain=True)
+        self.write_csv(self.ROWS[:2])
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+
+        overview(self.db_path, self.table_name, self.overview_table, skip_unchanged=True, maintain=True)
+
+        self.assertEqual(len(self.assert_overview_current()), 10)
+
+    def test_rebuild_without_maintain_drops_triggers(self):
+        """Test that rebuilding with maintain=False stops the trigger maintenance"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table, maintain=True)
+        overview(self.db_path, self.table_name, self.overview_table)
+
+        conn = sqlite3.connect(self.db_path)
+        triggers = conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall()
+        conn.close()
+        self.assertEqual(triggers, [])
+
+
+class TestCompactOverview(MaintainedOverviewTestCase):
+    """Test cases for the compact WITHOUT ROWID overview layout"""
+
+    def long_and_compact(self):
+        """Helper to build both overview layouts and return their rows"""
+        overview(self.db_path, self.table_name, "long_overview")
+        overview(self.db_path, self.table_name, self.overview_table, schema='compact')
+        conn = sqlite3.connect(self.db_path)
+        long_rows = conn.execute("SELECT * FROM long_overview ORDER BY sample, population").fetchall()
+        compact_rows = conn.execute(
+            f"SELECT * FROM {self.overview_table} ORDER BY sample, population").fetchall()
+        conn.close()
+        return long_rows, compact_rows
+
+    def test_view_matches_long_overview(self):
+        """Test that the compact overview reads back exactly like the long table on every schema"""
+        for schema in ('wide', 'dictionary', 'normalized'):
+            with self.subTest(schema=schema):
+                load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema=schema)
+                long_rows, compact_rows = self.long_and_compact()
+                self.assertEqual(len(compact_rows), 20)
+                self.assertEqual(compact_rows, long_rows)
+
+    def test_counts_are_clustered_without_rowid(self):
+        """Test that the counts are stored WITHOUT ROWID on (sample_id, population_id)"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table, schema='compact')
+
+        conn = sqlite3.connect(self.db_path)
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = ?",
+                           (f"{self.overview_table}_counts",)).fetchone()[0]
+        kinds = dict(conn.execute("SELECT name, type FROM sqlite_master").fetchall())
+        conn.close()
+        self.assertIn("WITHOUT ROWID", sql)
+        self.assertIn("PRIMARY KEY (sample_id, population_id)", sql)
+        self.assertEqual(kinds[self.overview_table], 'view')
+
+    def test_plot_join_reads_counts_by_key(self):
+        """Test that joining samples to the compact overview seeks the clustered key"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table, schema='compact')
+
+        conn = sqlite3.connect(self.db_path)
+        plan = " ".join(row[3] for row in conn.execute(
+            f"EXPLAIN QUERY PLAN SELECT ov.population, ov.percentage FROM {self.table_name} sd "
+            f"JOIN {self.overview_table} ov ON ov.sample = sd.sample WHERE sd.condition = 'melanoma'"))
+        conn.close()
+        self.assertIn(f"idx_{self.overview_table}_samples_sample", plan)
+        self.assertIn(f"SEARCH c USING PRIMARY KEY (sample_id=?)", plan)
+
+    def test_switching_schema_rebuilds(self):
+        """Test that skip_unchanged still rebuilds when the requested layout differs"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table)
+        overview(self.db_path, self.table_name, self.overview_table, skip_unchanged=True, schema='compact')
+        long_rows, compact_rows = self.long_and_compact()
+        self.assertEqual(compact_rows, long_rows)
+
+        overview(self.db_path, self.table_name, self.overview_table, skip_unchanged=True)
+        conn = sqlite3.connect(self.db_path)
+        kinds = dict(conn.execute("SELECT name, type FROM sqlite_master").fetchall())
+        conn.close()
+        self.assertEqual(kinds[self.overview_table], 'table')
+        self.assertNotIn(f"{self.overview_table}_counts", kinds)
+
+    def test_maintained_compact_overview(self):
+        """Test that triggers keep the compact overview current"""
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table, maintain=True, schema='compact')
+
+        self.execute(
+            f"INSERT INTO {self.table_name} (sample, b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte) "
+            f"VALUES ('sample005', 1, 2, 3, 4, 0)",
+            f"UPDATE {self.table_name} SET b_cell = 900 WHERE sample = 'sample001'",
+            f"DELETE FROM {self.table_name} WHERE sample = 'sample003'",
+        )
+
+        rows = self.assert_overview_current()
+        self.assertEqual(len(rows), 20)
+        self.assertIn(('sample005', 10, 'nk_cell', 4, 40.0), rows)
+
+    def test_unknown_schema(self):
+        """Test that an unknown overview layout is rejected"""
+        with self.assertRaises(ValueError):
+            overview(self.db_path, self.table_name, self.overview_table, schema='columnar')
+
+
+class TestCountsMatrix(LoadedDatabaseTestCase):
+    """Test cases for the in-memory NumPy counts matrix"""
+
+    def test_matrix_matches_overview_table(self):
+        """Test that totals and percentages equal the SQL overview on every schema"""
+        for schema in ('wide', 'dictionary', 'normalized'):
+            with self.subTest(schema=schema):
+                load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema=schema)
+                matrix = teiko_technical.load_counts_matrix(self.db_path, self.table_name)
+                conn = sqlite3.connect(self.db_path)
+                expected = conn.execute(
+                    f"SELECT sample, total_count, population, count, percentage FROM {self.overview_table}").fetchall()
+                conn.close()
+
+                self.assertEqual(matrix.counts.shape, (6, 5))
+                self.assertEqual(matrix.counts.dtype.kind, 'i')
+                actual = [
+                    (sample, int(matrix.totals[i]), population, int(matrix.counts[i, j]), float(matrix.percentages[i, j]))
+                    for i, sample in enumerate(matrix.samples)
+                    for j, population in enumerate(teiko_technical.POPULATIONS)
+                ]
+                self.assertCountEqual(actual, expected)
+
+    def test_mask_selects_cohorts(self):
+        """Test that masks combine filters, accept several values and ignore unknown ones"""
+        matrix = teiko_technical.load_counts_matrix(self.db_path, self.table_name)
+
+        def selected(**filters):
+            return sorted(matrix.samples[matrix.mask(**filters)])
+
+        self.assertEqual(selected(condition='melanoma', response='yes'), ['sample001', 'sample005'])
+        self.assertEqual(selected(treatment=['phauximab', 'none']), ['sample003', 'sample004'])
+        self.assertEqual(selected(time_from_treatment_start=14), ['sample004'])
+        self.assertEqual(selected(condition='lymphoma'), [])
+        with self.assertRaises(ValueError):
+            matrix.mask(b_cell=100)
+
+    def test_plot_from_matrix_matches_sql(self):
+        """Test that plot_cell_frequencies returns the same cohort from the matrix as from SQL"""
+        matrix = teiko_technical.load_counts_matrix(self.db_path, self.table_name)
+        from_sql, cell_types = self.plot()
+        from_matrix, _ = self.plot(matrix=matrix)
+
+        for cell_type in cell_types:
+            for response in ('yes', 'no'):
+                self.assertIsInstance(from_matrix[cell_type][response], teiko_technical.np.ndarray)
+                self.assertEqual(sorted(from_matrix[cell_type][response].tolist()),
+                                 sorted(from_sql[cell_type][response]))
+
+    def test_statistics_accept_arrays(self):
+        """Test that both statistics functions take the matrix output, including empty groups"""
+        data, cell_types = self.plot(matrix=teiko_technical.load_counts_matrix(self.db_path, self.table_name))
+        data['b_cell']['yes'] = data['b_cell']['yes'][:0]
+        with mock.patch("builtins.print"):
+            teiko_technical.analyze_frequencies_ttest(data, cell_types)
+            teiko_technical.analyze_frequencies_mw(data, cell_types)
+
+
+class TestHeadlessPlots(LoadedDatabaseTestCase):
+    """Test cases for rendering the boxplots in the background without a GUI"""
+
+    def setUp(self):
+        """Render into the temporary directory"""
+        super().setUp()
+        self.output_path = os.path.join(self.test_dir, "boxplots.png")
+        patcher = mock.patch.object(teiko_technical, "BOXPLOT_FILENAME", self.output_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_headless_render_saves_in_background(self):
+        """Test that a headless plot returns before rendering, never shows, and saves the PNG"""
+        release = threading.Event()
+        original = teiko_technical._save_headless_boxplots
+
+        def delayed(*args):
+            release.wait(5)
+            return original(*args)
+
+        with mock.patch.object(teiko_technical, "_save_headless_boxplots", delayed), \
+                mock.patch.object(teiko_technical.plt, "show") as show, mock.patch("builtins.print"):
+            data, cell_types = teiko_technical.plot_cell_frequencies(
+                self.db_path, self.table_name, self.overview_table, "miraclib", "melanoma", headless=True)
+            self.assertFalse(os.path.exists(self.output_path))
+            self.assertEqual(len(data['b_cell']['yes']), 2)
+            release.set()
+            self.assertEqual(teiko_technical.wait_for_plots(), [self.output_path])
+
+        show.assert_not_called()
+        with open(self.output_path, 'rb') as f:
+            self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+        self.assertEqual(teiko_technical.plt.get_fignums(), [])
+        self.assertEqual(teiko_technical.wait_for_plots(), [])
+
+    def test_render_errors_surface_in_wait(self):
+        """Test that an error while rendering in the background is raised by wait_for_plots"""
+        with mock.patch.object(teiko_technical, "BOXPLOT_FILENAME", os.path.join(self.test_dir, "missing", "x.png")), \
+                mock.patch("builtins.print"):
+            teiko_technical.plot_cell_frequencies(
+                self.db_path, self.table_name, self.overview_table, "miraclib", "melanoma", headless=True)
+            with self.assertRaises(FileNotFoundError):
+                teiko_technical.wait_for_plots()
+
+    def test_interactive_figure_is_closed(self):
+        """Test that the pyplot figure is released after it was shown"""
+        with mock.patch.object(teiko_technical.plt, "show"), mock.patch("builtins.print"):
+            teiko_technical.plot_cell_frequencies(
+                self.db_path, self.table_name, self.overview_table, "miraclib", "melanoma")
+        self.assertEqual(teiko_technical.plt.get_fignums(), [])
+        self.assertTrue(os.path.exists(self.output_path))
+
+
+class TestPlotCache(LoadedDatabaseTestCase):
+    """Test cases for the on-disk cache of rendered boxplots"""
+
+    def setUp(self):
+        """Cache into the temporary directory and count the renders"""
+        super().setUp()
+        self.cache_dir = os.path.join(self.test_dir, "cache")
+        printer = mock.patch("builtins.print")
+        printer.start()
+        self.addCleanup(printer.stop)
+        renders = mock.patch.object(teiko_technical, "_save_headless_boxplots",
+                                    wraps=teiko_technical._save_headless_boxplots)
+        self.renders = renders.start()
+        self.addCleanup(renders.stop)
+
+    def cached(self, condition="melanoma", **kwargs):
+        """Helper to request a cohort's boxplots through the cache"""
+        return teiko_technical.cached_boxplot(self.db_path, self.table_name, self.overview_table, "miraclib",
+                                              condition, cache_dir=self.cache_dir, **kwargs)
+
+    def cache_entries(self):
+        """Helper listing the cached figures"""
+        return sorted(name for name in os.listdir(self.cache_dir) if not name.startswith("."))
+
+    def test_repeat_request_is_served_from_cache(self):
+        """Test that the second request for a cohort renders nothing and returns the same image"""
+        first = self.cached()
+        second = self.cached()
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.renders.call_count, 1)
+        with open(first, 'rb') as f:
+            self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+
+        output_path = os.path.join(self.test_dir, "out.png")
+        self.assertEqual(self.cached(output_path=output_path), output_path)
+        self.assertEqual(self.renders.call_count, 1)
+        with open(first, 'rb') as cached, open(output_path, 'rb') as copied:
+            self.assertEqual(cached.read(), copied.read())
+
+    def test_key_follows_cohort_and_data_version(self):
+        """Test that another cohort, sample type or data version gets its own entry"""
+        self.cached()
+        self.cached(condition="carcinoma")
+        self.cached(sample_type="WB")
+        self.assertEqual(len(self.cache_entries()), 3)
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, schema='dictionary')
+        overview(self.db_path, self.table_name, self.overview_table)
+        self.cached()
+        self.assertEqual(self.renders.call_count, 4)
+        self.assertEqual(len(self.cache_entries()), 4)
+
+    def test_least_recently_used_are_evicted(self):
+        """Test that the cache stays within max_bytes by deleting the least recently used figures"""
+        melanoma = self.cached()
+        size = os.path.getsize(melanoma)
+        os.utime(melanoma, (1, 1))
+        carcinoma = self.cached(condition="carcinoma")
+        os.utime(carcinoma, (2, 2))
+        self.cached()  # touching melanoma makes carcinoma the oldest
+        healthy = self.cached(condition="healthy", max_bytes=2 * size + 1)
+
+        self.assertEqual(self.cache_entries(), sorted(os.path.basename(path) for path in (melanoma, healthy)))
+
+    def test_incremental_load_gets_new_entry(self):
+        """Test that an incremental load versions the data anew, so the cohort is rendered again"""
+        first = self.cached()
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, incremental=True)
+        self.assertNotEqual(self.cached(), first)
+        self.assertEqual(self.renders.call_count, 2)
+
+    def test_maintained_overview_is_not_cached(self):
+        """Test that with a trigger-maintained overview every request renders and nothing is cached"""
+        overview(self.db_path, self.table_name, self.overview_table, maintain=True)
+        output_path = os.path.join(self.test_dir, "out.png")
+        self.assertEqual(self.cached(output_path=output_path), output_path)
+        self.cached(output_path=output_path)
+
+        self.assertEqual(self.renders.call_count, 2)
+        self.assertFalse(os.path.exists(self.cache_dir))
+        self.assertTrue(os.path.exists(output_path))
+
+    def test_background_render_of_given_data(self):
+        """Test that a miss renders the given data without querying it, on the plot thread when asked to"""
+        data = teiko_technical.cell_frequencies(self.db_path, self.table_name, self.overview_table,
+                                                "miraclib", "melanoma")
+        with mock.patch.object(teiko_technical, "_cohort_frequencies") as query:
+            cache_path = self.cached(data=data, background=True)
+            self.assertEqual(teiko_technical.wait_for_plots(), [cache_path])
+        query.assert_not_called()
+        self.assertEqual(self.cache_entries(), [os.path.basename(cache_path)])
+        self.assertEqual(self.cached(), cache_path)
+        self.assertEqual(self.renders.call_count, 1)
+
+    def test_concurrent_requests_get_their_own_figures(self):
+        """Test that requests from several threads at once each cache the figure of their own cohort"""
+        conditions = ["melanoma", "carcinoma", "healthy"] * 2
+        with ThreadPoolExecutor(max_workers=len(conditions)) as executor:
+            paths = list(executor.map(self.cached, conditions))
+
+        self.assertEqual(len(set(paths)), 3)
+        self.assertEqual(paths[:3], paths[3:])
+        self.assertEqual(self.cache_entries(), sorted(os.path.basename(path) for path in set(paths)))
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+
+
+class TestGallery(LoadedDatabaseTestCase):
+    """Test cases for rendering every condition/treatment pair into a gallery"""
+
+    def render(self, **kwargs):
+        """Helper to render the gallery quietly into the temporary directory"""
+        self.gallery_dir = os.path.join(self.test_dir, "gallery")
+        with mock.patch("builtins.print"):
+            return teiko_technical.render_gallery(self.db_path, self.table_name, self.overview_table,
+                                                  output_dir=self.gallery_dir, **kwargs)
+
+    def test_gallery_in_worker_processes(self):
+        """Test that every pair with samples of the type gets a figure and an index entry"""
+        index_path = self.render(workers=2)
+
+        figures = sorted(name for name in os.listdir(self.gallery_dir) if name.endswith(".png"))
+        self.assertEqual(figures, ["000_healthy_none.png", "001_melanoma_miraclib.png"])
+        with open(index_path, encoding='utf-8') as f:
+            index = f.read()
+        for name in figures:
+            self.assertIn(f'src="{name}"', index)
+        self.assertIn("<td>melanoma</td><td>miraclib</td><td>2</td><td>2</td>", index)
+        self.assertIn("<td>healthy</td><td>none</td><td>0</td><td>0</td>", index)
+
+    def test_gallery_in_process_escapes_names(self):
+        """Test that a single worker renders in process and unsafe names are made safe"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f"UPDATE {self.table_name} SET condition = 'a/b <c>' WHERE condition = 'healthy'")
+        conn.commit()
+        conn.close()
+
+        with mock.patch.object(teiko_technical, "ProcessPoolExecutor") as pool:
+            index_path = self.render(workers=1, sample_type='WB')
+        pool.assert_not_called()
+
+        self.assertEqual(sorted(os.listdir(self.gallery_dir)), ["000_carcinoma_phauximab.png", "index.html"])
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f"UPDATE {self.table_name} SET sample_type = 'WB' WHERE condition = 'a/b <c>'")
+        conn.commit()
+        conn.close()
+        self.render(workers=1, sample_type='WB')
+        self.assertIn("000_a_b_c_none.png", os.listdir(self.gallery_dir))
+        with open(index_path, encoding='utf-8') as f:
+            index = f.read()
+        self.assertIn("<td>a/b &lt;c&gt;</td>", index)
+        self.assertIn('src="001_carcinoma_phauximab.png"', index)
+
+    def test_values_with_quotes(self):
+        """Test that cohort values containing an apostrophe are bound, not pasted into the SQL"""
+        self.write_csv([row[:2] + ["crohn's"] + row[3:] if row[2] == 'melanoma' else row for row in self.ROWS])
+        with mock.patch("builtins.print"):
+            load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+            overview(self.db_path, self.table_name, self.overview_table)
+            cache_path = teiko_technical.cached_boxplot(
+                self.db_path, self.table_name, self.overview_table, "miraclib", "crohn's",
+                cache_dir=os.path.join(self.test_dir, "cache"))
+        self.assertTrue(os.path.exists(cache_path))
+
+        index_path = self.render(workers=1)
+        with open(index_path, encoding='utf-8') as f:
+            self.assertIn("<td>crohn&#x27;s</td><td>miraclib</td><td>2</td><td>2</td>", f.read())
+
+
+class TestLazyImports(unittest.TestCase):
+    """Test cases for importing matplotlib and scipy only when needed"""
+
+    def test_module_attributes_import_on_access(self):
+        """Test that teiko_technical.plt and .stats still resolve to the libraries"""
+        import matplotlib.pyplot
+        from scipy import stats
+        self.assertIs(teiko_technical.plt, matplotlib.pyplot)
+        self.assertIs(teiko_technical.stats, stats)
+        with self.assertRaises(AttributeError):
+            teiko_technical.seaborn
+
+    def test_no_top_level_imports(self):
+        """Test that the module source only imports matplotlib and scipy inside functions"""
+        with open(teiko_technical.__file__, encoding='utf-8') as f:
+            top_level = [line for line in f if line.startswith(("import ", "from "))]
+        self.assertFalse([line for line in top_level if "matplotlib" in line or "scipy" in line], top_level)
+
+
+class TestCommandLine(LoadedDatabaseTestCase):
+    """Test cases for the per-stage subcommands of main()"""
+
+    def run_main(self, *argv):
+        """Helper to run main() on the test tables and return what it printed"""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            teiko_technical.main([*argv, "--db", self.db_path, "--table", self.table_name,
+                                  "--overview-table", self.overview_table])
+        return output.getvalue()
+
+    def test_import_has_no_side_effects(self):
+        """Test that importing the module prints nothing, writes nothing and loads no plotting or stats library"""
+        probe = ("import sys, teiko_technical; "
+                 "print(sorted(name for name in ('matplotlib', 'scipy') if name in sys.modules))")
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(teiko_technical.__file__)))
+        empty_dir = tempfile.mkdtemp(dir=self.test_dir)
+        result = subprocess.run([sys.executable, "-c", probe], cwd=empty_dir, env=env,
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout, "[]\n")
+        self.assertEqual(os.listdir(empty_dir), [])
+
+    def test_load_and_overview_subcommands(self):
+        """Test that load and overview build the tables in the requested layouts"""
+        self.db_path = os.path.join(self.test_dir, "cli.db")
+        self.run_main("load", "--input", self.csv_path, "--schema", "dictionary")
+        self.run_main("overview", "--overview-schema", "compact")
+        conn = sqlite3.connect(self.db_path)
+        types = dict(conn.execute("SELECT name, type FROM sqlite_master WHERE name IN (?, ?)",
+                                  (self.table_name, self.overview_table)).fetchall())
+        rows = conn.execute(f"SELECT COUNT(*) FROM {self.overview_table}").fetchone()[0]
+        conn.close()
+        self.assertEqual(types, {self.table_name: 'view', self.overview_table: 'view'})
+        self.assertEqual(rows, 6 * 5)
+
+    def test_stats_subcommand_does_not_plot(self):
+        """Test that stats runs the chosen test on the cohort without drawing anything"""
+        with mock.patch.object(teiko_technical, "_render_boxplots") as render:
+            welch = self.run_main("stats")
+            mann_whitney = self.run_main("stats", "--test", "mw", "--condition", "carcinoma",
+                                         "--treatment", "phauximab", "--sample-type", "WB")
+        render.assert_not_called()
+        self.assertIn("Welch's t-test", welch)
+        self.assertIn("Responders (Response=Yes): 2", welch)
+        self.assertIn(teiko_technical.DEFAULT_RESULT, welch)
+        self.assertIn("Mann-Whitney U", mann_whitney)
+        self.assertIn("Condition: carcinoma, Treatment: phauximab", mann_whitney)
+        self.assertNotIn(teiko_technical.DEFAULT_RESULT, mann_whitney)
+
+    def test_plot_subcommand_saves_headless(self):
+        """Test that plot --headless has written the image when main returns"""
+        output_path = os.path.join(self.test_dir, "cli.png")
+        cache_dir = os.path.join(self.test_dir, "cache")
+        with mock.patch.object(teiko_technical.plt, "show") as show:
+            self.run_main("plot", "--headless", "--output", output_path, "--cache-dir", cache_dir)
+        show.assert_not_called()
+        with open(output_path, 'rb') as f:
+            self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+
+    def test_plot_subcommand_uses_cache(self):
+        """Test that a repeat plot --headless comes from the cache and --force renders again"""
+        output_path = os.path.join(self.test_dir, "cli.png")
+        cache_dir = os.path.join(self.test_dir, "cache")
+        plot = ("plot", "--headless", "--output", output_path, "--cache-dir", cache_dir)
+        render_threads = []
+
+        def render(*args):
+            render_threads.append(threading.current_thread())
+            return original_render(*args)
+
+        original_render = teiko_technical._save_headless_boxplots
+        queries = mock.patch.object(teiko_technical, "_cohort_frequencies", wraps=teiko_technical._cohort_frequencies)
+        with mock.patch.object(teiko_technical, "_save_headless_boxplots", side_effect=render), queries as query:
+            first = self.run_main(*plot)
+            self.assertEqual(query.call_count, 1)
+            second = self.run_main(*plot)
+            self.assertEqual(len(render_threads), 1)
+            forced = self.run_main(*plot, "--force")
+            self.assertEqual(len(render_threads), 2)
+
+        # a miss renders the data already queried, in the background like --force
+        self.assertNotIn(threading.main_thread(), render_threads)
+        self.assertIn("Rendering boxplots into the cache", first)
+        self.assertIn("Using cached boxplots", second)
+        self.assertNotIn("cached", forced)
+        self.assertIn("Responders (Response=Yes): 2", second)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_query_subcommand(self):
+        """Test the default query, explicit filters with integer values, and the averaged population"""
+        default = self.run_main("query")
+        self.assertIn("Found 2 matching rows", default)
+        self.assertIn("Average b_cell for condition=melanoma, sex=M, time_from_treatment_start=0: 55.00", default)
+
+        filtered = self.run_main("query", "age=60", "--average", "monocyte")
+        self.assertIn("Found 1 matching rows", filtered)
+        self.assertIn("Average monocyte for age=60: 510.00", filtered)
+
+        nothing = self.run_main("query", "condition=lymphoma")
+        self.assertIn("No samples to average b_cell over for condition=lymphoma", nothing)
+
+    def test_query_rejects_bad_filters(self):
+        """Test that unknown columns, non-integer values and malformed filters are usage errors"""
+        for bad in ("b_cell=100", "age=old", "condition"):
+            with self.subTest(bad=bad), mock.patch("sys.stderr", io.StringIO()):
+                with self.assertRaises(SystemExit):
+                    self.run_main("query", bad)
+
+    def test_all_with_gallery_still_tests_cohort(self):
+        """Test that all --gallery runs the Part 3 tests on the cohort after rendering the gallery"""
+        gallery_dir = os.path.join(self.test_dir, "gallery")
+        output = self.run_main("all", "--input", self.csv_path, "--gallery", gallery_dir, "--workers", "1")
+        self.assertTrue(os.path.exists(os.path.join(gallery_dir, "index.html")))
+        self.assertIn("Gallery written to", output)
+        self.assertIn("Welch's t-test", output)
+        self.assertIn("Responders (Response=Yes): 2", output)
+        self.assertIn("Additional Query", output)
+
+    def test_no_command_runs_every_stage(self):
+        """Test that options without a command run the whole pipeline"""
+        with mock.patch.object(teiko_technical, "run_all") as run_all:
+            teiko_technical.main(["--db", self.db_path, "--headless"])
+        args = run_all.call_args.args[0]
+        self.assertEqual(args.db, self.db_path)
+        self.assertTrue(args.headless)
+        self.assertEqual((args.condition, args.treatment), ("melanoma", "miraclib"))
+
+
+class TestStatsCube(LoadedDatabaseTestCase):
+    """Test cases for the pre-aggregated statistics cube"""
+
+    def p_values(self, analyze, *args):
+        """Helper to run an analysis quietly and return the p-values it reports"""
+        with mock.patch("builtins.print"), mock.patch.object(teiko_technical, "_print_significance") as report:
+            analyze(*args)
+        return dict(report.call_args.args[0])
+
+    def test_cube_matches_raw_statistics(self):
+        """Test that means, variances and Welch's t-test from the cube equal those of the raw data"""
+        teiko_technical.build_stats_cube(self.db_path, self.table_name, self.overview_table, "test_cube")
+        summary = teiko_technical.cohort_statistics(self.db_path, "test_cube", "miraclib", "melanoma")
+        data, cell_types = self.plot()
+
+        for cell_type in cell_types:
+            for response in ('yes', 'no'):
+                raw = data[cell_type][response]
+                n, mean, variance, minimum, maximum = summary[cell_type][response]
+                self.assertEqual(n, 2)
+                self.assertAlmostEqual(mean, teiko_technical.np.mean(raw))
+                self.assertAlmostEqual(variance, teiko_technical.np.var(raw, ddof=1), places=6)
+                self.assertEqual((minimum, maximum), (min(raw), max(raw)))
+
+        from_cube = self.p_values(teiko_technical.analyze_cube_ttest, summary, cell_types)
+        from_raw = self.p_values(teiko_technical.analyze_frequencies_ttest, data, cell_types)
+        for cell_type in cell_types:
+            self.assertAlmostEqual(from_cube[cell_type], from_raw[cell_type], places=6)
+
+    def test_cube_groups_and_time_filter(self):
+        """Test that the cube holds one row per cohort and population, and time points can be selected"""
+        teiko_technical.build_stats_cube(self.db_path, self.table_name, self.overview_table, "test_cube")
+        conn = sqlite3.connect(self.db_path)
+        groups = conn.execute("SELECT COUNT(*) FROM test_cube").fetchone()[0]
+        conn.close()
+        # sample001 and sample005 share a cohort
+        self.assertEqual(groups, 5 * 5)
+
+        summary = teiko_technical.cohort_statistics(
+            self.db_path, "test_cube", "miraclib", "melanoma", time_from_treatment_start=7)
+        self.assertEqual(summary['b_cell']['no'][0], 1)
+        self.assertTrue(teiko_technical.np.isnan(summary['b_cell']['no'][2]))
+        self.assertEqual(summary['b_cell']['yes'][0], 0)
+
+    def test_skip_unchanged(self):
+        """Test that the cube is only rebuilt when the sample table changed"""
+        teiko_technical.build_stats_cube(self.db_path, self.table_name, self.overview_table, "test_cube")
+        with mock.patch("builtins.print") as printed:
+            teiko_technical.build_stats_cube(self.db_path, self.table_name, self.overview_table, "test_cube",
+                                             skip_unchanged=True)
+        self.assertIn("skipping rebuild", printed.call_args.args[0])
+
+        self.write_csv(self.ROWS[:2])
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table)
+        teiko_technical.build_stats_cube(self.db_path, self.table_name, self.overview_table, "test_cube",
+                                         skip_unchanged=True)
+        summary = teiko_technical.cohort_statistics(self.db_path, "test_cube", "miraclib", "melanoma")
+        self.assertEqual(summary['monocyte']['yes'][0], 1)
+
+    def test_stale_overview_is_refused(self):
+        """Test that a cube is not built from an overview of an older load, and is rebuilt after the overview"""
+        teiko_technical.build_stats_cube(self.db_path, self.table_name, self.overview_table, "test_cube")
+        rows = [row[:10] + [str(int(count) * 10 + 500) for count in row[10:]] if row[2] == 'melanoma' else row
+                for row in self.ROWS]
+        self.write_csv(rows)
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+
+        for skip_unchanged in (True, False):
+            with self.subTest(skip_unchanged=skip_unchanged), self.assertRaises(ValueError):
+                teiko_technical.build_stats_cube(self.db_path, self.table_name, self.overview_table, "test_cube",
+                                                 skip_unchanged=skip_unchanged)
+
+        overview(self.db_path, self.table_name, self.overview_table)
+        with mock.patch("builtins.print") as printed:
+            teiko_technical.build_stats_cube(self.db_path, self.table_name, self.overview_table, "test_cube",
+                                             skip_unchanged=True)
+        self.assertIn("Built test_cube", printed.call_args.args[0])
+        summary = teiko_technical.cohort_statistics(self.db_path, "test_cube", "miraclib", "melanoma")
+        data, _ = self.plot()
+        self.assertAlmostEqual(summary['b_cell']['yes'][1], teiko_technical.np.mean(data['b_cell']['yes']))
+
+
+    def test_boxplot_stats_within_bin_bound(self):
+        """Test that quartiles, and whiskers away from the fences, are within half a bin of matplotlib's"""
+        import random
+        from matplotlib import cbook
+        rng = random.Random(19)
+        rows = [
+            ['prj1', f'sbj{i}', 'melanoma', '50', 'F', 'miraclib', rng.choice(['yes', 'no']), f's{i}', 'PBMC',
+             str(rng.choice([0, 7, 14])), *(str(rng.randint(1, 5000)) for _ in range(5))]
+            for i in range(300)
+        ]
+        rows.append(['prj1', 'sbjx', 'melanoma', '50', 'F', 'miraclib', 'yes', 'sx', 'PBMC', '0', '90000', '1', '1', '1', '1'])
+        self.write_csv(rows)
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+        overview(self.db_path, self.table_name, self.overview_table)
+        teiko_technical.build_stats_cube(self.db_path, self.table_name, self.overview_table, "test_cube")
+
+        boxes = teiko_technical.cohort_boxplot_stats(self.db_path, "test_cube", "miraclib", "melanoma")
+        data, cell_types = self.plot()
+        bound = teiko_technical.SKETCH_BIN_WIDTH / 2 + 1e-9
+        for cell_type in cell_types:
+            for response in ('yes', 'no'):
+                raw = teiko_technical.np.array(data[cell_type][response])
+                exact = cbook.boxplot_stats(raw)[0]
+                sketch = boxes[cell_type][response]
+                for key in ('med', 'q1', 'q3'):
+                    self.assertLessEqual(abs(sketch[key] - exact[key]), bound, (cell_type, response, key))
+                iqr = exact['q3'] - exact['q1']
+                near_fence = False
+                for key, fence in (('whislo', exact['q1'] - 1.5 * iqr), ('whishi', exact['q3'] + 1.5 * iqr)):
+                    if (abs(raw - fence) <= teiko_technical.SKETCH_FENCE_MARGIN).any():
+                        near_fence = True
+                        continue
+                    self.assertLessEqual(abs(sketch[key] - exact[key]), bound, (cell_type, response, key))
+                if not near_fence:
+                    self.assertLessEqual(len(sketch['fliers']), len(exact['fliers']))
+        self.assertGreater(len(boxes['b_cell']['yes']['fliers']), 0)
+
+    def test_boxplot_whisker_near_fence(self):
+        """Test that a percentage just inside the 1.5 IQR fence can become a flier, as documented"""
+        from matplotlib import cbook
+        raw = [0.186, 0.164, 0.239, 0.407, 0.959, 0.297, 0.953, 2.047]
+        bins = [round(value / teiko_technical.SKETCH_BIN_WIDTH) for value in raw]
+        histogram = sorted((bin, bins.count(bin)) for bin in set(bins))
+        exact = cbook.boxplot_stats(raw)[0]
+        sketch = teiko_technical._sketch_boxplot_stats(histogram, 'Yes')
+
+        fence = exact['q3'] + 1.5 * (exact['q3'] - exact['q1'])
+        self.assertLess(fence - 2.047, teiko_technical.SKETCH_FENCE_MARGIN)
+        self.assertEqual(exact['whishi'], 2.047)
+        bound = teiko_technical.SKETCH_BIN_WIDTH / 2 + 1e-9
+        for key in ('med', 'q1', 'q3', 'whislo'):
+            self.assertLessEqual(abs(sketch[key] - exact[key]), bound, key)
+        # the point crossed the fence: the whisker ends at the next bin inward
+        self.assertAlmostEqual(sketch['whishi'], 0.96)
+        self.assertEqual(len(sketch['fliers']), 1)
+        self.assertAlmostEqual(sketch['fliers'][0], 2.05)
+
+    def test_plot_from_cube(self):
+        """Test that the cube plot draws without raw data and returns the cohort summary"""
+        teiko_technical.build_stats_cube(self.db_path, self.table_name, self.overview_table, "test_cube")
+        shown = []
+        with mock.patch.object(teiko_technical.plt, "savefig"), \
+                mock.patch.object(teiko_technical.plt, "show", lambda: shown.append(teiko_technical.plt.gcf())), \
+                mock.patch("builtins.print"):
+            summary, cell_types = teiko_technical.plot_cell_frequencies_from_cube(
+                self.db_path, "test_cube", "miraclib", "melanoma")
+        figure, = shown
+        self.assertEqual(len(figure.axes), 5)
+        self.assertEqual([label.get_text() for label in figure.axes[0].get_xticklabels()], ['Yes', 'No'])
+        self.assertEqual(summary['cd4_t_cell']['yes'][0], 2)
+
 
 class TestDataValidation(unittest.TestCase):
     """Test cases for data validation and edge cases"""
@@ -530,6 +2313,112 @@ class TestDataValidation(unittest.TestCase):
         # Each population should be 1/5 = 20%
         self.assertAlmostEqual(percentage, 20.0, places=2, msg="Percentage should be ~20%")
 
+    def test_malformed_rows_are_quarantined(self):
+        """Test that rows with malformed counts go to the rejects table with a reason code"""
+        test_rows = [
+            ['prj1', 'sbj001', 'melanoma', '57', 'M', 'drug_a', 'yes',
+             'sample001', 'PBMC', '0', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj002', 'melanoma', '60', 'F', 'drug_a', 'no',
+             'sample002', 'PBMC', '0', '1O0', '200', '300', '150', '250'],
+            ['prj1', 'sbj003', 'melanoma', '61', 'F', 'drug_a', 'no',
+             '', 'PBMC', '0', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj004', 'melanoma'],
+        ]
+        self.create_and_load_csv(test_rows)
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT sample, typeof(b_cell) FROM {self.table_name}")
+        loaded = cursor.fetchall()
+        cursor.execute(f"SELECT reason, raw_row FROM {self.table_name}_rejects ORDER BY reason")
+        rejects = cursor.fetchall()
+        conn.close()
+
+        self.assertEqual(loaded, [('sample001', 'integer')])
+        self.assertEqual([reason for reason, _ in rejects],
+                         ['field_count', 'invalid_b_cell', 'missing_sample'])
+        self.assertIn('1O0', rejects[1][1], "The raw row should be kept for inspection")
+
+    def test_non_ascii_digits_are_quarantined(self):
+        """Test that Unicode decimal digits SQLite cannot convert are rejected instead of stored as TEXT"""
+        test_rows = [
+            ['prj1', 'sbj001', 'melanoma', '٥٠', 'M', 'drug_a', 'yes',
+             'sample001', 'PBMC', '0', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj002', 'melanoma', '60', 'F', 'drug_a', 'no',
+             'sample002', 'PBMC', '-٧', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj003', 'melanoma', '61', 'F', 'drug_a', 'no',
+             'sample003', 'PBMC', '-7', '100', '200', '300', '150', '２５０'],
+            ['prj1', 'sbj004', 'melanoma', '62', 'M', 'drug_a', 'yes',
+             'sample004', 'PBMC', '-7', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj005', 'melanoma', '57\xa0', 'M', 'drug_a', 'yes',
+             'sample005', 'PBMC', '0', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj006', 'melanoma', '\u200357', 'M', 'drug_a', 'yes',
+             'sample006', 'PBMC', '0', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj007', 'melanoma', ' 57\t', 'M', 'drug_a', 'yes',
+             'sample007', 'PBMC', '0', '100', '200', '300', '150', '250'],
+        ]
+        with open(self.csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(teiko_technical.CSV_COLUMNS)
+            writer.writerows(test_rows)
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name)
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT sample, typeof(age), time_from_treatment_start FROM {self.table_name}")
+        loaded = cursor.fetchall()
+        cursor.execute(f"SELECT reason FROM {self.table_name}_rejects ORDER BY reason")
+        reasons = [row[0] for row in cursor.fetchall()]
+        conn.close()
+
+        self.assertEqual(loaded, [('sample004', 'integer', -7), ('sample007', 'integer', 0)])
+        self.assertEqual(reasons, ['invalid_age', 'invalid_age', 'invalid_age', 'invalid_monocyte',
+                                   'invalid_time_from_treatment_start'])
+
+    def test_overview_arithmetic_after_rejects(self):
+        """Test that quarantined rows cannot leak TEXT counts into the overview"""
+        test_rows = [
+            ['prj1', 'sbj001', 'melanoma', '57', 'M', 'drug_a', 'yes',
+             'sample001', 'PBMC', '0', '100', '200', '300', '150', '250'],
+            ['prj1', 'sbj002', 'melanoma', '60', 'F', 'drug_a', 'no',
+             'sample002', 'PBMC', '0', 'n/a', '200', '300', '150', '250'],
+        ]
+        self.create_and_load_csv(test_rows)
+
+        overview(self.db_path, self.table_name, self.overview_table)
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT DISTINCT sample, total_count FROM {self.overview_table}")
+        totals = cursor.fetchall()
+        conn.close()
+
+        self.assertEqual(totals, [('sample001', 1000)])
+
+    def test_validation_can_be_disabled(self):
+        """Test that validate=False keeps relying on SQLite type affinity"""
+        test_rows = [
+            ['prj1', 'sbj001', 'melanoma', '57', 'M', 'drug_a', 'yes',
+             'sample001', 'PBMC', '0', 'n/a', '200', '300', '150', '250'],
+        ]
+        with open(self.csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['project', 'subject', 'condition', 'age', 'sex', 'treatment',
+                             'response', 'sample', 'sample_type', 'time_from_treatment_start',
+                             'b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte'])
+            writer.writerows(test_rows)
+
+        load_csv_to_sqlite(self.csv_path, self.db_path, self.table_name, validate=False)
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT typeof(b_cell) FROM {self.table_name}")
+        b_cell_type = cursor.fetchone()[0]
+        conn.close()
+
+        self.assertEqual(b_cell_type, 'text')
+
 
 class TestFilter(unittest.TestCase):
     """Test cases for the filter function"""